@@ -3,7 +3,6 @@
 """
 import sys  # still useful ? yes if not it would be grey
 import os
-import struct
 import re
 
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget,
@@ -19,15 +18,20 @@ from PyQt5 import QtCore
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure  # better do not use pyplot (but it's possible)
-import matplotlib.pyplot as plt
 # import matplotlib as mpl
 from scipy import ndimage as ndi
-from scipy.optimize import minimize, leastsq   # use minimize_skalar ?
 from scipy.stats import sem, t  # t is the student t distribution (all sorts in the object)
 from skimage.measure import block_reduce as SkiMeasBR
-from skimage.morphology import (erosion, dilation, binary_opening, disk)
 
 from fitting_module_v2 import gauss2D_cst_offs, sot_r_gau, gaussEll2D_cst_offs
+from beam_engine import (BeamSettings, WarmStart, analyze_frame, analyze_stack, aeff_curve_basic, backg_modes,
+                         max_methods, warm_start_modes)
+from beam_locator import coordinate_grid
+from beam_moments import moment_columns
+from pixel_mask import PixelMask
+from wcf_reader import read_wcf_info, read_wcf_stack, wcf_crop_margin
+from image_stack import ImageStack, FileImageStack
+from stack_readers import read_image_folder, open_stack_file, list_stack_files, FolderReader, ArrayReader
 
 import numpy as np
 import datetime as dt
@@ -44,11 +48,13 @@ auto_crop_ulx = 0
 auto_crop_uly = 0
 frame_width = 0
 analyze_all_files_check = False
+z_warm_start = None  # WarmStart (beam_engine.py) shared by the stacks of analyze_all_files
 ti0 = 0  # time in secs used for analyzing one image
 good_idx = []  # list of indices of the images to analyze in the stack
 roiS = np.ones((3, 4))*np.nan  # each line is: xfrom, xto, yfrom, yto (include all indices)
+masked = PixelMask()  # masked pixels in absolute coordinates (see modify_mask)
 history_length = 10  # history_length : keep history_length sets of fit parameters (initialisations and results)
-b_fits = history_length * [[None, None, None]]  # (history_length, 3) list of lists with elements dict (later)
+b_fits = [[None, None, None] for _ in range(history_length)]  # (history_length, 3) list of lists of dicts (later)
 results = {}
 mywb = xl.Workbook()  # workbook
 f_name = ""
@@ -193,6 +199,15 @@ class MyTableWidget(QWidget):
             #    '  Select a wcf-file with 64 images or an image file in a folder of similar images.  ')  # label (actif)
             self.LbImageSize = QLabel('Image resolution before crop')  # label (actif) - for image size information
 
+            # For huge stacks: read the frames only when they are used (kept in a cache of limited size)
+            self.CbLazy = QCheckBox("Lazy loading")
+            self.CbLazy.setToolTip("Read the frames on demand (for huge stacks), multi-page tiff and hdf5 always")
+            self.LbCacheMB = QLabel("Frame cache (MB):")
+            self.SbCacheMB = QSpinBox()
+            self.SbCacheMB.setRange(16, 65536)
+            self.SbCacheMB.setValue(512)
+            self.SbCacheMB.setSingleStep(128)
+
             # For defining the pixel size (replace by combo box?)
             self.LbPiSi = QLabel("Pixel size:")  # label
             self.EdPiSi = QLineEdit('3.45')
@@ -341,6 +356,9 @@ class MyTableWidget(QWidget):
             grid1.addWidget(self.BtLoadFile1, 0, 0)  # (object, row, column, rowSpan, colSpan)
             grid1.addWidget(self.LbFolderName, 0, 1, 1, 5)
             grid1.addWidget(self.LbImageSize, 0, 6, 1, 3)  # For image size information
+            grid1.addWidget(self.CbLazy, 1, 0)
+            grid1.addWidget(self.LbCacheMB, 1, 1)
+            grid1.addWidget(self.SbCacheMB, 1, 2)
 
             # For defining the pixel size (replace by combo box?)
             grid1.addWidget(self.LbPiSi, 2, 0)
@@ -485,9 +503,7 @@ class MyTableWidget(QWidget):
             self.CbShowBMax.stateChanged.connect(self.display2)
 
             self.cob_max = QComboBox()
-            self.cob_max.addItems(['Max pixel', 'Max pixel (3x3 mean)', 'Max pixel (5x5 mean)',
-                                   'Cap fit 95%', 'Cap fit 90%', 'Cap fit 80%', 'Cap fit 70%',
-                                   'Centroid', 'Centroid (3x3 mean)', 'Centroid (5x5 mean)'])
+            self.cob_max.addItems(max_methods)
             tab2_upper_grid2.addWidget(self.cob_max, 1, 11)
             self.cob_max.currentIndexChanged.connect(self.onImageChange)
 
@@ -665,6 +681,23 @@ class MyTableWidget(QWidget):
 
             right_wi_lay.addLayout(sot_grid_lay)
 
+            # Add the second moments (D4σ widths, see beam_moments.py)
+            d4s_grid_lay = QGridLayout()
+            self.LbD4sTitle = QLabel('Second-moment widths (D4σ, ISO 11146):')
+            self.LbD4sTitle.setFont(section_h_font)
+            d4s_grid_lay.addWidget(self.LbD4sTitle, 0, 0, 1, 2)
+
+            self.cbMakeD4sCalc = QCheckBox('Calculate the D4σ widths')
+            self.cbMakeD4sCalc.stateChanged.connect(self.onImageChange)
+            d4s_grid_lay.addWidget(self.cbMakeD4sCalc, 1, 0, 1, 2)
+
+            self.LbD4sResult = QLabel('D4σ: XX x XX px')
+            d4s_grid_lay.addWidget(self.LbD4sResult, 2, 0)
+            self.LbD4sAngle = QLabel('Angle: XX °, ellipticity: XX')
+            d4s_grid_lay.addWidget(self.LbD4sAngle, 2, 1)
+
+            right_wi_lay.addLayout(d4s_grid_lay)
+
             # Add a bit of space
             # right_wi_lay.addStretch(1)
 
@@ -674,13 +707,14 @@ class MyTableWidget(QWidget):
             right_wi_lay.addWidget(self.LbFitTitle)
 
             aefftext= "Use for A<sup>1</sup> \n(if activated above)"
-            self.TbFit2 = QTableWidget(11, 3)
+            self.TbFit2 = QTableWidget(12, 3)
             
             self.TbFit2.setHorizontalHeaderLabels(["Round G.", "Same SOT G.", "Ell. G."])
             self.TbFit2.setVerticalHeaderLabels(['Make fit?', "fit limit (rel.)",
                                                  aefftext,
-                                                 'status', 'Which GOF?', 'w_1 (px)', 'Max val (rel.)',
-                                                 'x_0 (px)', 'y_0 (px)', 'w_2 (px)', 'Angle (°)'])
+                                                 'status', 'GOF (R²)', 'w_1 (px)', 'Max val (rel.)',
+                                                 'x_0 (px)', 'y_0 (px)', 'w_2 (px)', 'Angle (°)',
+                                                 'Pixel budget (0: all)'])
 
             def fill_fit_tb():
                 self.rdbtgroup_for_aeff = QButtonGroup(self.rdBtwidgetMedFi)
@@ -728,6 +762,9 @@ class MyTableWidget(QWidget):
 
                     ed_y_0 = QLineEdit('100')
                     self.TbFit2.setCellWidget(8, col_idx, ed_y_0)
+
+                    ed_budget = QLineEdit('0')  # multiresolution fit on about this number of pixels
+                    self.TbFit2.setCellWidget(11, col_idx, ed_budget)
                     """for x in [ed_x_0, ed_y_0]:
                         if col_idx == 0:
                             x.setFixedWidth(65)
@@ -759,6 +796,21 @@ class MyTableWidget(QWidget):
             self.TbFit2.resizeRowsToContents()
             right_wi_lay.addWidget(self.TbFit2)
 
+            self.cbLogInit = QCheckBox('Start the 2D fits from a log-quadratic fit (else from the table)')
+            self.cbLogInit.setChecked(True)
+            self.cbLogInit.stateChanged.connect(self.onImageChange)
+            right_wi_lay.addWidget(self.cbLogInit)
+
+            warm_line_widg = QWidget()
+            warm_line_lay = QHBoxLayout()
+            warm_line_lay.addWidget(QLabel("Stack analysis: start the fits from the"))
+            self.cob_warm_start = QComboBox()  # see WarmStart in beam_engine.py
+            self.cob_warm_start.addItems(warm_start_modes)
+            self.cob_warm_start.setCurrentText("previous frame")
+            warm_line_lay.addWidget(self.cob_warm_start)
+            warm_line_widg.setLayout(warm_line_lay)
+            right_wi_lay.addWidget(warm_line_widg)
+
             # Things below the fit table
             low_line_widg = QWidget()
             # this will be a VBox layout
@@ -1122,7 +1174,7 @@ class MyTableWidget(QWidget):
 
     def display_up(self):
         print('display_up called')
-        if self.SlNum.value() < imStack.shape[2]:
+        if self.SlNum.value() < imStack.n_frames:
             self.SlNum.setValue(self.SlNum.value() + 1)
             self.rdbtFbF.setChecked(True)  # to refresh the display
 
@@ -1140,7 +1192,8 @@ class MyTableWidget(QWidget):
             self,
             "Open file",
             "",  # default folder of wcf files. "" for local folder
-            "All files (*.*);; Dataray files (*.wcf);; image files (*.tif *.tiff *.png *.jpg) ")
+            "All files (*.*);; Dataray files (*.wcf);; image files (*.tif *.tiff *.png *.jpg) ;; "
+            "stack files (*.tif *.tiff *.h5 *.hdf5)")
 
         if not f_name[0]:
             return  # function continues if a file was chosen
@@ -1179,34 +1232,31 @@ class MyTableWidget(QWidget):
             main.statBar.showMessage('Reading images... please wait')
         file_res_info = "Image size (horiz, vert) in pixels: "
 
-        if file_type.upper() == "WCF":  # read wcf file that contains 64 images (taken in identic cond.)
-            # get image resolution from filesize
-            fi_size = os.path.getsize(f_name)
-            print("fi_size = ", fi_size, " Bytes")
-            pix_num_est = int(np.round((fi_size - 934 - 5592) / 64 / 2 / 1000))  # kpixels
-            #  934 was found by trial and error in comparison to Dataray software
-            #  5592 can be read in the first header
-            #  64 images
-            #  2 bytes per pixel
-            print("pix_num_est = ", pix_num_est, " kpixels")
-            std_image_reslS = {  # key in in kpixels, tuple in pixels
-                int(np.round(64 * 64 / 1000)): (64, 64),
-                int(np.round(128 * 128 / 1000)): (128, 128),
-                int(np.round(256 * 256 / 1000)): (256, 256),
-                int(np.round(384 * 384 / 1000)): (384, 384),
-                int(np.round(512 * 512 / 1000)): (512, 512),
-                int(np.round(752 * 752 / 1000)): (752, 752),
-                int(np.round(1024 * 1024 / 1000)): (1024, 1024),
-                int(np.round(1200 * 1024 / 1000)): (1200, 1024)
-            }
+        stack_reader = None  # multi-page tiff or hdf5 file: frames are read on demand
+        if file_type.upper() != "WCF":
             try:
-                im1_height = std_image_reslS[pix_num_est][1]
-                im1_width = std_image_reslS[pix_num_est][0]
-                file_res_info = file_res_info + "{:d}, {:d}; uint16".format(im1_width, im1_height)
-                self.LbImageSize.setText(file_res_info)
-                sat_value = 2**16 - 1
+                stack_reader = open_stack_file(f_name)  # None for a single image (folder stack)
+            except ValueError:
+                if analyze_all_files_check:
+                    main.statBar.showMessage(statusbarmessage + '\tThe selected file is not readable')
+                else:
+                    main.statBar.showMessage('The selected file is not readable')
+                self.LbFolderName.setText('The selected file is not a readable stack file')
+                return
 
-            except KeyError:
+        if file_type.upper() == "WCF":  # read wcf file that contains 64 images (taken in identic cond.)
+            # get image resolution from the file header (cached per file)
+            try:
+                wcf_info = read_wcf_info(f_name)
+                print(wcf_info)
+                im1_height = wcf_info.height
+                im1_width = wcf_info.width
+                sat_value = wcf_info.sat_value
+                # start loading: map the file (no copy) and convert all frames in one call
+                cm = wcf_crop_margin  # pixel (crop margin, because the nominal image size contains a saturated pixel)
+                wcf_frames = read_wcf_stack(f_name, im1_width, im1_height, frames=wcf_info.frames,
+                                            offset=wcf_info.header_length, crop_margin=cm)  # (64, H, W) view
+            except ValueError:  # no frame size in the header or file shorter than the geometry
                 im1_width = np.nan
                 im1_height = np.nan
                 file_res_info = file_res_info + "NAN, NAN"
@@ -1218,82 +1268,56 @@ class MyTableWidget(QWidget):
                     main.statBar.showMessage('The selected file is not readable')
                 self.LbFolderName.setText('The selected file is not a readable wcf-file')
                 return   # exit this function, if image size estimation not successful
+            file_res_info = file_res_info + "{:d}, {:d}; uint{:d}".format(im1_width, im1_height, wcf_info.bit_depth)
+            self.LbImageSize.setText(file_res_info)
 
-            # start loading
-            im_size_in_bytes = im1_width * im1_height * 2  # 2 bytes per pixel (uint16)
-            main.progBar.setMinimum(0)
-            main.progBar.setMaximum(64)
-            cm = 2  # pixel (crop margin, because the nominal image size contains a saturated pixel)
-            imStack = np.ndarray((im1_height - 2 * cm, im1_width - 2 * cm, 64))  # reserve memory for stack
-            with open(f_name, mode="rb") as f:
-                f.seek(934 + 5592)
-                #  934 was found by trial and error in comparison to Dataray software
-                #  5592 can be read in the first header
-                im_data = f.read(im_size_in_bytes)
-                main.progBar.setValue(1)
-                QApplication.processEvents()
-                for im_num in range(64):  # 64 images
-                    # extract the image from the array of bytes and store it (except the outer frame)
-                    im_data = struct.unpack("H" * ((len(im_data)) // 2), im_data)  # "H" is uint16
-                    imStack[:, :, im_num] = np.reshape(im_data, (im1_height, im1_width))[cm:-cm, cm:-cm]
-                    #imStack[:, :, im_num] = np.reshape(im_data, (im1_height, im1_width))
-
-                    main.progBar.setValue(im_num + 1)
-                    QApplication.processEvents()
-
-                    # read the next array of bytes
-                    im_data = f.read(im_size_in_bytes)
-            # f.close() is not needed after with block
+            if self.CbLazy.isChecked():  # keep the mapping, frames are read when they are used
+                imStack = FileImageStack(ArrayReader(wcf_frames), sat_value,
+                                         cache_bytes=self.SbCacheMB.value() * 2**20)
+            else:  # copy to memory in the native uint16 (conversion to float is done frame by frame)
+                imStack = ImageStack(np.array(wcf_frames), sat_value)  # (64, H, W)
+            del wcf_frames  # releases the file mapping (if not lazy)
             im1_height = im1_height - 2 * cm  # for the global variable to reflect the size on imstack
             im1_width = im1_width - 2 * cm
             main.progBar.setValue(0)
 
+        elif stack_reader is not None:  # one file contains the stack, nothing is read here
+            imStack = FileImageStack(stack_reader, cache_bytes=self.SbCacheMB.value() * 2**20)
+            sat_value = imStack.sat_value
+            imStack_fns = ["{} (frame {:d})".format(f_name, idx + 1) for idx in range(imStack.n_frames)]
+            im1_height = imStack.height
+            im1_width = imStack.width
+            file_res_info = file_res_info + "{:d}, {:d}; ".format(im1_width, im1_height) + str(imStack.dtype)
+            self.LbImageSize.setText(file_res_info)
+
         else:  # Is this a folder of valid files?  globals:  dirname, baseName, f_name
-            imStack = []  # start as list, will be transformed to
-            imStack_fns = []
-            try:  # check if the selected image works
-                im = plt.imread(f_name)  # read selected file first ATTENTION MAY BE skimage reader is better
-                # there are cases where the plt reader does not keep the right data format
-                imSi = im.shape
-                imTy = str(im.dtype)
-                sat_value = np.iinfo(im.dtype).max  # give feed back on image dtype
-                imStack.append(im)
-                imStack_fns.append(f_name)
-            except:  # the selected file is not a readable image
+            main.progBar.setMinimum(0)
+            try:  # check if the selected image works, then read the images of same size and type (threads)
+                if self.CbLazy.isChecked():  # only the first image is decoded now
+                    imStack_fns = list_stack_files(f_name)
+                    st_frames = FolderReader(imStack_fns)
+                else:
+                    st_frames, imStack_fns = read_image_folder(f_name, progress=self.show_load_progress)
+                imTy = str(st_frames.dtype)
+                sat_value = np.iinfo(st_frames.dtype).max  # give feed back on image dtype
+            except ValueError:  # the selected file is not a readable image (or not an integer image)
                 if analyze_all_files_check:
                     main.statBar.showMessage(statusbarmessage+'\tThe selected file is not a readable image')
                 else:
                     main.statBar.showMessage('The selected file is not a readable image')
                 self.LbFolderName.setText('The selected file is not a readable image or wcf-file')
                 return
-            # get the list of filenames
-            dirname = os.path.normpath(os.path.split(f_name)[0])
-            filenames = next(os.walk(dirname))[2]
-            main.progBar.setMinimum(0)
-            main.progBar.setMaximum(len(filenames))
-            for im_num, this_file in enumerate(filenames):
-                this_file = '/'.join([dirname, this_file])
-
-                main.progBar.setValue(im_num + 1)
-                QApplication.processEvents()
-
-                if os.path.normpath(this_file) == os.path.normpath(f_name):
-                    continue  # Do not read again the file that is already in imStack
-                try:
-                    im = plt.imread(this_file)
-                    if (imSi == im.shape) and (str(im.dtype) == imTy):
-                        imStack.append(im)
-                        imStack_fns.append(this_file)
-                except:
-                    pass
-            imStack = np.dstack(imStack)  # convert to numpy array
-            imStack = imStack.astype(np.float64)  # convert to float type
-            im1_height = imSi[0]  # for the global variable to reflect the size on imstack
-            im1_width = imSi[1]
+            if self.CbLazy.isChecked():
+                imStack = FileImageStack(st_frames, sat_value, cache_bytes=self.SbCacheMB.value() * 2**20)
+            else:
+                imStack = ImageStack(st_frames, sat_value)  # (N, H, W) array in the native dtype
+            del st_frames
+            im1_height = imStack.height  # for the global variable to reflect the size on imstack
+            im1_width = imStack.width
             file_res_info = file_res_info + "{:d}, {:d}; ".format(im1_width, im1_height) + imTy
             self.LbImageSize.setText(file_res_info)
 
-        self.SlNum.setMaximum(imStack.shape[2])
+        self.SlNum.setMaximum(imStack.n_frames)
         if analyze_all_files_check:
             main.statBar.showMessage(statusbarmessage+'\tFinished loading images', 5000)
         else:
@@ -1301,11 +1325,10 @@ class MyTableWidget(QWidget):
         main.progBar.setValue(0)
 
         # for setting the maximum value of the vertical scale spin boxes
-        vMaxMax = 0  # for setting the maximum value of the vertical scale spin boxes
-        for im_num in range(imStack.shape[2]):
-            vMaxNow = imStack[:, :, im_num].max()
-            if vMaxNow > vMaxMax:
-                vMaxMax = vMaxNow
+        if isinstance(imStack, FileImageStack):  # do not read the whole stack before showing the first frame
+            vMaxMax = imStack.frame(0).max()
+        else:
+            vMaxMax = imStack.stats(sat_value * rel_sat_limit).vmax  # also used by get_sat_pixels, get_dark_images
 
         # initialize the spinboxes for cropping
         self.SbUpper.setRange(0, im1_height - 1)
@@ -1335,23 +1358,30 @@ class MyTableWidget(QWidget):
 
             # Spinbox initialisation for image choice
             self.SbImFrom.setValue(1)
-            self.SbImTo.setValue(imStack.shape[2])
+            self.SbImTo.setValue(imStack.n_frames)
 
             roiS = np.ones((3, 4))*np.nan  # xfrom, xto, yfrom, yto (include all indices)
             # has to be float if not, there is no "nan"
-            masked = []
+            masked = PixelMask((im1_height, im1_width))  # absolute coordinates
             mask_during_modif = False
 
         if self.CbCrop.isChecked():  # this case is for using more than one wcf file without closing the program
             # keep the cropping, if it was on
-            imStack = imStack[self.SbUpper.value():(im1_height - 1 - self.SbLower.value()),
-                              self.SbLeft.value():(im1_width - 1 - self.SbRight.value()), :]
+            imStack = imStack.crop(slice(self.SbUpper.value(), im1_height - 1 - self.SbLower.value()),
+                                   slice(self.SbLeft.value(), im1_width - 1 - self.SbRight.value()))
+        self.showRoiS()
+        self.display()  # show the first frame before scanning the stack (lazy stacks read all frames here)
+        QApplication.processEvents()
         self.get_sat_pixels()
         self.get_dark_images()
-        self.showRoiS()
-        self.display()
 
 
+    def show_load_progress(self, done, total):
+        """progress callback of read_image_folder"""
+        main.progBar.setMaximum(total)
+        main.progBar.setValue(done)
+        QApplication.processEvents()
+
     def get_sat_pixels(self):
         print("get_sat_pixels called")
 
@@ -1363,13 +1393,9 @@ class MyTableWidget(QWidget):
         global imStack
         abs_sat_limit = sat_value * rel_sat_limit
 
-        sat_pix_count = 0
-        sat_im_count = 0
-        for im_nb in range(imStack.shape[2]):
-            new_sat_pix_count = np.count_nonzero(imStack[:, :, im_nb] > abs_sat_limit)
-            sat_pix_count += new_sat_pix_count
-            if new_sat_pix_count > 0:
-                sat_im_count += 1
+        st_stats = imStack.stats(abs_sat_limit)  # cached on the stack
+        sat_pix_count = st_stats.sat_pix_count
+        sat_im_count = st_stats.sat_im_count
 
         if sat_pix_count > 0:
             # Display bold red text:
@@ -1386,25 +1412,20 @@ class MyTableWidget(QWidget):
         global imStack
         # global dark_im_list
 
-        # find dark limit in imStack
-        im_max_arr = np.ndarray((imStack.shape[2]))
-        for im_idx in range(imStack.shape[2]):
-            im_max_arr[im_idx] = imStack[:, :, im_idx].max()
-
-        dark_limit = np.median(im_max_arr) - 3 * (im_max_arr.max() - np.median(im_max_arr))
+        # dark limit and dark images from the (cached) per-frame maxima of imStack
+        st_stats = imStack.stats(sat_value * rel_sat_limit)
 
         # find dark images number
         dark_im_list = []
         mess = ""
-        for im_idx in range(imStack.shape[2]):
-            if imStack[:, :, im_idx].max() < dark_limit:
-                dark_im_list.append(im_idx + 1)
-                mess += "{:d}, ".format(im_idx + 1)
+        for im_idx in st_stats.dark_frames:
+            dark_im_list.append(int(im_idx) + 1)
+            mess += "{:d}, ".format(im_idx + 1)
         if len(mess) == 0:
             mess = "No dark image found"
             self.SbDark.setValue(1)
             self.SbImFrom.setValue(1)
-            self.SbImTo.setValue(imStack.shape[2])
+            self.SbImTo.setValue(imStack.n_frames)
         else:
             mess = "Number of possible dark images : " + mess[:-2]
             self.SbDark.setValue(dark_im_list[0])
@@ -1424,7 +1445,7 @@ class MyTableWidget(QWidget):
         if im_from <= im_to:
             good_idx = list(range(im_from - 1, im_to))
         elif im_from > im_to:
-            good_idx = list(range(im_to)) + list(range(im_from - 1, imStack.shape[2]))
+            good_idx = list(range(im_to)) + list(range(im_from - 1, imStack.n_frames))
         # print("good_id : ", good_idx)
 
     def view_changed(self):
@@ -1436,29 +1457,35 @@ class MyTableWidget(QWidget):
             self.display()
         elif ViewBtIdx == 1:  # Display grid of all (downscaled) images
             ti1 = ti.time()
-            st_copy = imStack.copy()
             max_im_size = 2048  # 4096 -> 1.1 sec # pixels in both directions
+            n_frames = imStack.n_frames
 
-            # Downscaling loop (if necessary)
-            x_num = max_im_size // st_copy.shape[1]  # how many images would fit into max_im_size
-            y_num = max_im_size // st_copy.shape[0]
-            while x_num * y_num < st_copy.shape[2]:
+            # Downscaling factor (if necessary): the frames are read one by one (lazy stacks are not loaded at once)
+            factor = 1
+            im1_height, im1_width = imStack.height, imStack.width
+            while (max_im_size // im1_width) * (max_im_size // im1_height) < n_frames:
                 # it does not fit -> downscale by a factor of 2
-                st_copy = SkiMeasBR(st_copy, block_size=(2, 2, 1), func=np.max)  # block_reduce
-                x_num = max_im_size // st_copy.shape[1]  # how many images would fit into max_im_size
-                y_num = max_im_size // st_copy.shape[0]
+                factor *= 2
+                im1_height = -(-imStack.height // factor)  # size of the block_reduce result
+                im1_width = -(-imStack.width // factor)
 
             # make a close-to-square tile image
-            im1_height = st_copy.shape[0]
-            im1_width = st_copy.shape[1]
-            x_num = int(np.sqrt(st_copy.shape[2] * im1_height / im1_width))
-            y_num = int(np.ceil(st_copy.shape[2] / x_num))
-            im_to_show = -st_copy.max()/10 * np.ones((im1_height*y_num, im1_width*x_num))  # adaptive nonsense
-            for row in range(y_num):
-                for col in range(x_num):
-                    if col + x_num * row < st_copy.shape[2]:
-                        im_to_show[row*im1_height:(row+1)*im1_height,
-                                   col*im1_width:(col+1)*im1_width] = st_copy[:, :, col + x_num * row]
+            x_num = int(np.sqrt(n_frames * im1_height / im1_width))
+            y_num = int(np.ceil(n_frames / x_num))
+            im_to_show = np.zeros((im1_height*y_num, im1_width*x_num))
+            tiles_max = -np.inf
+            for im_idx in range(n_frames):
+                tile = imStack.frame(im_idx)
+                if factor > 1:
+                    tile = SkiMeasBR(tile, block_size=(factor, factor), func=np.max)  # block_reduce
+                row, col = divmod(im_idx, x_num)
+                im_to_show[row*im1_height:(row+1)*im1_height, col*im1_width:(col+1)*im1_width] = tile
+                tiles_max = max(tiles_max, float(tile.max()))  # float: no wrap around of unsigned types
+            empty = np.ones(im_to_show.shape, dtype=bool)  # the places without tile are dark
+            empty[:(n_frames // x_num) * im1_height] = False
+            empty[(n_frames // x_num) * im1_height:(n_frames // x_num + 1) * im1_height,
+                  :(n_frames % x_num) * im1_width] = False
+            im_to_show[empty] = -tiles_max / 10  # adaptive nonsense
             # Clear the figure from earlier uses
             self.figureIM1.clear()
             # prepare the axis
@@ -1520,8 +1547,9 @@ class MyTableWidget(QWidget):
             else:  # just show the stack
                 number = self.SlNum.value()  # read present slider value
                 self.LbImNo.setText("Image " + "\n" + "    " + str(number))
-                ImDisp1 = imStack[:, :, number - 1]  # make a view of the right image
+                ImDisp1 = imStack.frame(number - 1)  # make a view of the right image
                 self.showIm1(ImDisp1)  # show the image
+                imStack.prefetch(number - 1)  # lazy stacks: read the neighbours in the background
             self.LbFolderName.setLongText(imStack_fns[self.SlNum.value() - 1])
             self.rdbtFbF.setChecked(True)  # for refresh display
         except NameError:  # necessary because the method is executed on initialisation
@@ -1545,26 +1573,11 @@ class MyTableWidget(QWidget):
             vma1 = im_to_show.max()
 
         # mark masked pixels if wished
-        im_modified = im_to_show.copy()  # modify a copy of im_to_show
         if self.cbMaskShow.isChecked():
-            # calculate the values of the color switch limits and the
-            # replacement values (for the masked pixels to become visible)
-            MiniVal = np.min(im_to_show)
-            MaxiVal = np.max(im_to_show)
-            infernoLimits = [0.35, 0.82]
-            infernoColVals = [0.66, 1]
-            # change the values (colors) of the pixels in the list
-            for count in range(len(masked)):
-                try:
-                    if (masked[count][1] - crop_uly >= 0) and (masked[count][0] - crop_ulx >= 0):  # no neg indices
-                        IsVal = im_to_show[masked[count][1] - crop_uly, masked[count][0] - crop_ulx]
-                        if infernoLimits[0] < IsVal / (MaxiVal - MiniVal) < infernoLimits[1]:  # light color
-                            putVal = infernoColVals[1] * (MaxiVal - MiniVal) + MiniVal
-                        else:
-                            putVal = infernoColVals[0] * (MaxiVal - MiniVal) + MiniVal
-                        im_modified[masked[count][1] - crop_uly, masked[count][0] - crop_ulx] = putVal
-                except IndexError:
-                    pass  # does not crash if pixels outside the present crop are part of the mask
+            # pixels outside the present crop are ignored
+            im_modified = masked.overlay(im_to_show, crop_ulx, crop_uly)
+        else:
+            im_modified = im_to_show
 
         cax = axIM1.imshow(im_modified, cmap=self.CoboCmap.currentText(), vmin=vmi1, vmax=vma1)
         # common color maps: jet, gray, hot, hsv, inferno, gist_ncar
@@ -1600,8 +1613,8 @@ class MyTableWidget(QWidget):
             axIM1.plot([ulx, lrx, lrx, ulx, ulx], [uly, uly, lry, lry, uly],
                        color=col, linestyle='--', linewidth=linew)
 
-        maxX = imStack[:, :, 0].shape[1]-1
-        maxY = imStack[:, :, 0].shape[0]-1
+        maxX = imStack.width - 1
+        maxY = imStack.height - 1
 
         if xM == -10 and yM == -10:  # was not called by mouse event
             if (not(np.any(np.isnan(roiS[0, :])))
@@ -1653,29 +1666,16 @@ class MyTableWidget(QWidget):
 
         """ Adds or removes the third line of 'roiS' to 'masked'
         """
-        global masked  # list of tuples
-
-        # Generate list of selected points
-        points_new = []  # list of tuples
         ulx = int(np.round(roiS[roiNo, 0]))
         lrx = int(np.round(roiS[roiNo, 1]))
         uly = int(np.round(roiS[roiNo, 2]))
         lry = int(np.round(roiS[roiNo, 3]))
-        # fill columnwise
-        for xCoo in range(ulx, lrx + 1):  # from left to right
-            # column loop
-            for yCoo in range(uly, lry + 1):  # from upper to lower
-                # line loop
-                points_new.append((xCoo, yCoo))  # (x, y) coordinates
-
-        # add or remove points_new to masked
+
+        # add or remove the rectangle to masked
         if self.CoboMaskMode.currentText() == "Add pixels":
-            #             # add really new points to MaskList
-            masked = list(set(masked + points_new))  # sorts at the same time
+            masked.add_rect(ulx, lrx, uly, lry)
         elif self.CoboMaskMode.currentText() == "Remove pixels":
-            # remove entries of newPoints that existed in MaskList
-            masked = list(set(masked) - set(points_new))  # sorts at the same time
-        # TODO: move to absolute coords (is it simply a + as for a numpy array?)
+            masked.remove_rect(ulx, lrx, uly, lry)
 
         print('len masked = ', len(masked))
         self.lbMaskInfo.setText("{:.0f} pixels masked".format(len(masked)))
@@ -1687,7 +1687,7 @@ class MyTableWidget(QWidget):
         try:
             for col_idx in range(self.TbFit2.columnCount()):
                 self.TbFit2.cellWidget(3, col_idx).setText(b_fits[hist_idx][col_idx]["status"])
-                self.TbFit2.cellWidget(4, col_idx).setText("{:.2f}".format(b_fits[hist_idx][col_idx]["GOF"]))
+                self.TbFit2.cellWidget(4, col_idx).setText("{:.4f}".format(b_fits[hist_idx][col_idx]["GOF"]))
                 self.TbFit2.cellWidget(5, col_idx).setText("{:.3f}".format(b_fits[hist_idx][col_idx]["w1"]))
                 self.TbFit2.cellWidget(6, col_idx).setText("{:.2f}".format(b_fits[hist_idx][col_idx]["max"]))
 
@@ -1701,14 +1701,20 @@ class MyTableWidget(QWidget):
         except (TypeError, AttributeError):
             pass
 
+    def shift_b_fits(self):
+        """Save the present fits in the history: drop the last entry, b_fits[0] becomes a copy of b_fits[1]
+        (a new list, the dicts are replaced and not modified, thus the history keeps its values)
+        """
+        b_fits[1:] = b_fits[:-1]
+        b_fits[0] = list(b_fits[0])
+
     def read_to_b_fits(self):
         print("read_to_b_fits called")
 
         global b_fits  # (history_length, 3) array with elements dict (later)
 
         #try:
-        # save old values
-        b_fits[1:] = b_fits[:-1]  # drop the last entry. Fist entry is now double
+        self.shift_b_fits()  # save old values
 
         for col_idx in range(self.TbFit2.columnCount()):
             if col_idx in [0, 2]:
@@ -1720,7 +1726,8 @@ class MyTableWidget(QWidget):
                     "w1": float(self.TbFit2.cellWidget(5, col_idx).text()),
                     "max": float(self.TbFit2.cellWidget(6, col_idx).text()),
                     "x_0": float(self.TbFit2.cellWidget(7, col_idx).text()),
-                    "y_0": float(self.TbFit2.cellWidget(8, col_idx).text())
+                    "y_0": float(self.TbFit2.cellWidget(8, col_idx).text()),
+                    "budget": int(float(self.TbFit2.cellWidget(11, col_idx).text()))  # only input, 0: all pixels
                 }  # dict["b"] - dict["a"]
 
                 if col_idx == 2:
@@ -1740,167 +1747,6 @@ class MyTableWidget(QWidget):
         #    return
 
 
-    def make_fits(self):
-        print("make_fits called")
-
-        """
-        Makes the fits
-        :return:
-        """
-        global b_fits  # (history_length, 3) array with elements dict (later)
-
-        self.read_to_b_fits()
-        # print(b_fits)
-        if analyze_all_files_check:
-            main.statBar.showMessage(statusbarmessage + '\tFitting in progress (slow for elliptic Gaussian', 5000)
-        else:
-            main.statBar.showMessage('Fitting in progress (slow for elliptic Gaussian)')
-
-        for col_idx in range(self.TbFit2.columnCount()):
-            if self.TbFit2.cellWidget(0, col_idx).currentText() == "No":
-                continue
-            print("yes: " + self.TbFit2.horizontalHeaderItem(col_idx).text())
-
-            # write initialization using .guess method of fit model (see fitting module) ?
-            # no not here at least. In onTabChange?
-
-            # initialize the beam position with b_max data if launched from z-evolution
-            if analyze_all_files_check:
-                b_fits[0][col_idx]["x_0"] = b_max[0]
-                b_fits[0][col_idx]["y_0"] = b_max[1]
-
-            if col_idx == 0:  # col_idx in [0, 2]  # round Gaussian: gauss2D_cst_offs
-                p_ini = [b_fits[0][col_idx]["max"] * b_max[2],  # because the max is relative
-                         b_fits[0][col_idx]["x_0"],
-                         b_fits[0][col_idx]["y_0"],
-                         b_fits[0][col_idx]["w1"]]
-                # As the table displays the fit result this initializes with the last result (if not edited)
-
-                XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
-                # resid_2D(self, p, x, y, z, **kwargs):
-                p_fit, success = leastsq(
-                    gauss2D_cst_offs.resid_2D,
-                    p_ini,
-                    args=(XX[(im_to_show2 > b_fits[0][col_idx]["lim"] * b_max[2])
-                             & (im_to_show2 < rel_sat_limit * sat_value - backg)],
-                          YY[(im_to_show2 > b_fits[0][col_idx]["lim"] * b_max[2])
-                             & (im_to_show2 < rel_sat_limit * sat_value - backg)],
-                          im_to_show2[(im_to_show2 > b_fits[0][col_idx]["lim"] * b_max[2])
-                                      & (im_to_show2 < rel_sat_limit * sat_value - backg)]),
-                    full_output=False)
-                if success in [1, 2, 3, 4]:  # If success is equal to 1, 2, 3 or 4, the solution was found.
-                    # save old values
-                    b_fits[1:] = b_fits[:-1]  # drop the last entry. Fist entry is now double
-                    b_fits[0][col_idx]["status"] = "OK: {:d}".format(success)
-                    b_fits[0][col_idx]["max"] = p_fit[0] / b_max[2]  # TODO: HERE it modifies b_fits[0, ..][] AND b_fits[1, ..][]
-                    b_fits[0][col_idx]["x_0"] = p_fit[1]
-                    b_fits[0][col_idx]["y_0"] = p_fit[2]
-                    b_fits[0][col_idx]["w1"] = np.abs(p_fit[3])
-                    self.sb_hist.setValue(0)
-                    self.TbFit2.cellWidget(3, col_idx).setText(b_fits[0][col_idx]["status"])
-                    self.TbFit2.cellWidget(4, col_idx).setText("{:.2f}".format(b_fits[0][col_idx]["GOF"]))
-                    self.TbFit2.cellWidget(5, col_idx).setText("{:.3f}".format(b_fits[0][col_idx]["w1"]))
-                    self.TbFit2.cellWidget(6, col_idx).setText("{:.4f}".format(b_fits[0][col_idx]["max"]))
-                    self.TbFit2.cellWidget(7, col_idx).setText("{:.2f}".format(b_fits[0][col_idx]["x_0"]))
-                    self.TbFit2.cellWidget(8, col_idx).setText("{:.2f}".format(b_fits[0][col_idx]["y_0"]))
-                else:
-                    b_fits[0][col_idx]["status"] = "Problem: {:d}".format(success)
-                    print("Round Gaussian: Fitting problem encountered")
-
-            elif col_idx == 2:  # elliptic gau: gaussEll2D_cst_offs
-                # paras = [vert_factor, cent_x, cent_y, waist_rad_a, waist_rad_b, theta]
-                p_ini = [b_fits[0][col_idx]["max"] * b_max[2],  # because the max is relative
-                         b_fits[0][col_idx]["x_0"],
-                         b_fits[0][col_idx]["y_0"],
-                         b_fits[0][col_idx]["w1"],
-                         b_fits[0][col_idx]["w2"],
-                         b_fits[0][col_idx]["angle"]]
-                # As the table displays the fit result this initializes with the last result (if not edited)
-
-                XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
-                # resid_2D(self, p, x, y, z, **kwargs):
-                p_fit, success = leastsq(
-                    gaussEll2D_cst_offs.resid_2D,  # gaussEll2D_cst_offs
-                    p_ini,
-                    args=(XX[(im_to_show2 > b_fits[0][col_idx]["lim"] * b_max[2])
-                             & (im_to_show2 < rel_sat_limit * sat_value - backg)],
-                          YY[(im_to_show2 > b_fits[0][col_idx]["lim"] * b_max[2])
-                             & (im_to_show2 < rel_sat_limit * sat_value - backg)],
-                          im_to_show2[(im_to_show2 > b_fits[0][col_idx]["lim"] * b_max[2])
-                                      & (im_to_show2 < rel_sat_limit * sat_value - backg)]),
-                    full_output=False)
-                # saturated values are not used for the fit, thus even saturated pictures
-                # may be fitted reasonably well.
-                if success in [1, 2, 3, 4]:  # If success is equal to 1, 2, 3 or 4, the solution was found.
-                    # save old values
-                    b_fits[1:] = b_fits[:-1]  # drop the last entry. First entry is now double
-                    b_fits[0][col_idx]["status"] = "OK: {:d}".format(success)
-                    b_fits[0][col_idx]["max"] = p_fit[0] / b_max[
-                        2]  # TODO: HERE it modifies b_fits[0, ..][] AND b_fits[1, ..][]
-                    b_fits[0][col_idx]["x_0"] = p_fit[1]
-                    b_fits[0][col_idx]["y_0"] = p_fit[2]
-                    # Reduce the angle to (-90°, 90°] and set w1 as the long half axis.
-                    red_angle = p_fit[5] % 180
-                    if red_angle > 90:
-                        red_angle = -(180 - red_angle)
-                    w1 = np.abs(p_fit[3])
-                    w2 = np.abs(p_fit[4])
-                    if np.abs(p_fit[3]) < np.abs(p_fit[4]):  # if w1 < w2: exchange and rotate angle by 90°
-                        w1, w2 = w2, w1
-                        if red_angle < 0:
-                            red_angle += 90
-                        else:
-                            red_angle -= 90
-                    b_fits[0][col_idx]["w1"] = w1
-                    b_fits[0][col_idx]["w2"] = w2
-                    b_fits[0][col_idx]["angle"] = red_angle
-                    self.sb_hist.setValue(0)
-                    self.TbFit2.cellWidget(3, col_idx).setText(b_fits[0][col_idx]["status"])
-                    self.TbFit2.cellWidget(4, col_idx).setText("{:.2f}".format(b_fits[0][col_idx]["GOF"]))
-                    self.TbFit2.cellWidget(5, col_idx).setText("{:.3f}".format(b_fits[0][col_idx]["w1"]))
-                    self.TbFit2.cellWidget(6, col_idx).setText("{:.4f}".format(b_fits[0][col_idx]["max"]))
-                    self.TbFit2.cellWidget(7, col_idx).setText("{:.2f}".format(b_fits[0][col_idx]["x_0"]))
-                    self.TbFit2.cellWidget(8, col_idx).setText("{:.2f}".format(b_fits[0][col_idx]["y_0"]))
-                    self.TbFit2.cellWidget(9, col_idx).setText("{:.3f}".format(b_fits[0][col_idx]["w2"]))
-                    self.TbFit2.cellWidget(10, col_idx).setText("{:.1f}".format(b_fits[0][col_idx]["angle"]))
-                else:
-                    b_fits[0][col_idx]["status"] = "Problem: {:d}".format(success)
-                    print("Elliptic Gaussian: Fitting problem encountered")
-
-            elif col_idx == 1:  # sot_r_gau
-                p_ini = [b_fits[0][col_idx]["max"], b_fits[0][col_idx]["w1"]]
-                # As the table displays the fit result this initializes with the last result (if not edited)
-
-                # residuals(self, p, x, y, z, **kwargs):
-                p_fit, success = leastsq(sot_r_gau.residuals, p_ini,
-                                         args=(sot_x[(sot_x > b_fits[0][col_idx]["lim"])
-                                                     & (sot_x < (rel_sat_limit * sat_value - backg)/b_max[2])],
-                                               sot_y[(sot_x > b_fits[0][col_idx]["lim"])
-                                                     & (sot_x < (rel_sat_limit * sat_value - backg)/b_max[2])]),
-                    full_output=False)
-                if success in [1, 2, 3, 4]:  # If success is equal to 1, 2, 3 or 4, the solution was found.
-                    # save old values
-                    b_fits[1:] = b_fits[:-1]  # drop the last entry. Fist entry is now double
-                    b_fits[0][col_idx]["status"] = "OK: {:d}".format(success)
-                    b_fits[0][col_idx]["max"] = p_fit[0]  # HERE it modifies b_fits[0][..][] AND b_fits[1][..][]
-                    b_fits[0][col_idx]["w1"] = np.abs(p_fit[1])
-                    self.sb_hist.setValue(0)
-                    self.TbFit2.cellWidget(3, col_idx).setText(b_fits[0][col_idx]["status"])
-                    self.TbFit2.cellWidget(4, col_idx).setText("{:.2f}".format(b_fits[0][col_idx]["GOF"]))
-                    self.TbFit2.cellWidget(5, col_idx).setText("{:.3f}".format(b_fits[0][col_idx]["w1"]))
-                    self.TbFit2.cellWidget(6, col_idx).setText("{:.2f}".format(b_fits[0][col_idx]["max"]))
-                else:
-                    b_fits[0][col_idx]["status"] = "Problem: {:d}".format(success)
-                    print("SOT curve: Fitting problem encountered")
-
-        if analyze_all_files_check:
-            main.statBar.showMessage(statusbarmessage + '\tFitting finished', 5000)
-        else:
-            main.statBar.showMessage('Fitting finished', 5000)
-
-        self.TbFit2.resizeColumnsToContents()
-        self.TbFit2.resizeRowsToContents()
-
     def roi_def(self):  # called by checkbox
         print("roi1_def called")
         global roiS, roiNo
@@ -2340,11 +2186,10 @@ class MyTableWidget(QWidget):
         if self.CbCrop.isChecked():  # take a view
             crop_ulx = self.SbLeft.value()
             crop_uly = self.SbUpper.value()
-            imStack = imStack[crop_uly:(im1_height - 1 - self.SbLower.value()),
-                              crop_ulx:(im1_width - 1 - self.SbRight.value()),
-                              :]
-            im1_height = imStack.shape[0]
-            im1_width = imStack.shape[1]
+            imStack = imStack.crop(slice(crop_uly, im1_height - 1 - self.SbLower.value()),
+                                   slice(crop_ulx, im1_width - 1 - self.SbRight.value()))
+            im1_height = imStack.height
+            im1_width = imStack.width
             self.SbLower.setEnabled(False)
             self.SbRight.setEnabled(False)
             self.SbLeft.setEnabled(False)
@@ -2388,8 +2233,8 @@ class MyTableWidget(QWidget):
                 main.statBar.showMessage(statusbarmessage + '\tProcessing ...  please wait', 5000)
             else:
                 main.statBar.showMessage('Processing ...  please wait')
-            for Nb in range(1, imStack.shape[2] + 1):
-                imStack[:, :, Nb - 1] = ndi.median_filter(imStack[:, :, Nb - 1], MedFiPara)
+            for Nb in range(1, imStack.n_frames + 1):
+                imStack.set_frame(Nb - 1, ndi.median_filter(imStack.frame(Nb - 1), MedFiPara))
                 main.progBar.setValue(Nb)
                 QApplication.processEvents()
             if analyze_all_files_check:
@@ -2428,13 +2273,13 @@ class MyTableWidget(QWidget):
                     main.statBar.showMessage(statusbarmessage + '\tProcessing', 5000)
                 else:
                     main.statBar.showMessage('Processing')
-                ImDisp1 = ndi.median_filter(imStack[:, :, number - 1], self.SbMedFi.value())
+                ImDisp1 = ndi.median_filter(imStack.frame(number - 1), self.SbMedFi.value())
                 if analyze_all_files_check:
                     main.statBar.showMessage(statusbarmessage + '\tReady', 5000)
                 else:
                     main.statBar.showMessage('Ready')
             else:
-                ImDisp1 = imStack[:, :, number - 1]
+                ImDisp1 = imStack.frame(number - 1)
             self.showIm1(ImDisp1)  # show the image
         except NameError:
             return
@@ -2487,364 +2332,145 @@ class MyTableWidget(QWidget):
     def onImageChange(self):
         print("onImageChange called")
 
-        global ti0
+        global ti0, im_to_show2, step, frame_width, auto_crop_ulx, auto_crop_uly
+        global backg, energy, b_max, sot_x, sot_y, soft_val, b_fits, Aeffg, slope
         ti0 = ti.time()
-        self.get_step()
-        self.make_auto_crop()  # generates im_to_show2
-        self.get_backg()  # calls make_auto_crop_dark if needed; updates im_to_show2
-        self.get_beam_max()
-        self.get_sot_data()
-        self.make_fits()
-        self.display2()  # show the 2D images of measurement model or residual
-        self.plot2_1D()  # show the cross sections, the Aeff-curve or the SOT-curve
-        self.get_aeffg()  # can use b_max[2] or b_fit value as max
-        ti0 = ti.time() - ti0
-
-    def vertical_to_horizontal(self, mountain, lower_limit):
-        """
-        Returns the indices to use like mountain[idxs] to address the pixels of
-        mountain that are higher than threshold and the ones that are in the same
-        region. vertical_to_horizontal uses erosion and dilation to close holes in the region.
-        Thus hopefully the noise problems close to problems are minimized. Execution takes about
-        10 ms for 400 x 400 pixel images
-        :param mountain: Grayscale image (numpy array)
-        :param lower_limit: A real number
-        :return idxs: Binary array to be used as index for numy array
-        """
-        idxs = np.zeros(mountain.shape, dtype='bool')
-        idxs[mountain > lower_limit] = True
-
-        idxs = dilation(idxs, disk(2))  # , square(3) is better than standard cross
-        idxs = erosion(idxs, disk(2))  # diamond(2) is not better than standard cross
-        idxs = binary_opening(idxs)
-        return idxs
-
-    def get_beam_max(self):
-        print("get_beam_max called")
-
-        global b_max
-        fit_pb = False
-        """, 'Cap fit 80%', 'Cap fit 70%',"""
-        if 'Cap fit' in self.cob_max.currentText():
-            # Initialize the (round) Gaussian fit with the 3x3 mean around the maximal pixel
-            # The cap_factor will be defined with respect to the 3x3 mean too.
-            (b_max[1], b_max[0]) = np.unravel_index(im_to_show2.argmax(), im_to_show2.shape)
-            (bmx, bmy) = b_max[0:2].round().astype("int")  # b_max[0] = x-position
-            b_max[2] = im_to_show2[bmy - 1: bmy + 2, bmx - 1: bmx + 2].mean()
-            p_ini = [b_max[2]*0.99,  # max_ini = 99% of max pixel
-                     b_max[0]-1.5,  # x_0 = a bit away from the max pixel
-                     b_max[1]-1.5,  # y_0 = a bit away from the max pixel
-                     np.mean(im_to_show2.shape)/10]  #  supposing there are 5 beam diameters on the image
-            XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
-
-            # resid_2D(self, p, x, y, z, **kwargs):
-            if self.cob_max.currentText() == 'Cap fit 95%':
-                cap_factor = 0.95
-            elif self.cob_max.currentText() == 'Cap fit 90%':
-                cap_factor = 0.9
-            elif self.cob_max.currentText() == 'Cap fit 80%':
-                cap_factor = 0.8
-            elif self.cob_max.currentText() == 'Cap fit 70%':
-                cap_factor = 0.7
-            upper_zone_idxs = self.vertical_to_horizontal(im_to_show2, b_max[2] * cap_factor)
-            # upper_zone_idxs = im_to_show2 > b_max[2] * cap_factor  # uses vertical criterion
-            p_fit, success = leastsq(
-                gauss2D_cst_offs.resid_2D,
-                p_ini,
-                args=(XX[upper_zone_idxs],
-                      YY[upper_zone_idxs],
-                      im_to_show2[upper_zone_idxs]),
-                full_output=False)
-
-            if success in [1, 2, 3, 4]:  # If success is equal to 1, 2, 3 or 4, the solution was found.
-                b_max[2] = p_fit[0]
-                b_max[0] = p_fit[1]
-                b_max[1] = p_fit[2]
-            else:
-                fit_pb = True  # and use: 'Max pixel (3x3 mean)'
-                (b_max[1], b_max[0]) = np.unravel_index(im_to_show2.argmax(), im_to_show2.shape)
-                (bmx, bmy) = b_max[0:2].round().astype("int")  # b_max[0] = x-position
-                b_max[2] = im_to_show2[bmy - 1: bmy + 2, bmx - 1: bmx + 2].mean()
-
-        elif self.cob_max.currentText() == 'Max pixel':
-            b_max[2] = im_to_show2.max()
-            (b_max[1], b_max[0]) = np.unravel_index(im_to_show2.argmax(), im_to_show2.shape)
-        elif self.cob_max.currentText() == 'Max pixel (3x3 mean)':
-            (b_max[1], b_max[0]) = np.unravel_index(im_to_show2.argmax(), im_to_show2.shape)
-            (bmx, bmy) = b_max[0:2].round().astype("int")  # b_max[0] = x-position
-            b_max[2] = im_to_show2[bmy - 1: bmy + 2, bmx - 1: bmx + 2].mean()
-        elif self.cob_max.currentText() == 'Max pixel (5x5 mean)':
-            (b_max[1], b_max[0]) = np.unravel_index(im_to_show2.argmax(), im_to_show2.shape)
-            (bmx, bmy) = b_max[0:2].round().astype("int")  # b_max[0] = x-position
-            b_max[2] = im_to_show2[bmy - 2: bmy + 3, bmx - 2: bmx + 3].mean()
-        elif self.cob_max.currentText() == 'Centroid':
-            # TODO test : scipy.ndimage.center_of_mass
-            ti1 = ti.time()
-            XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
-            b_max[0] = (XX * im_to_show2).sum() / im_to_show2.sum()
-            b_max[1] = (YY * im_to_show2).sum() / im_to_show2.sum()
-            b_max[2] = im_to_show2[int(np.round(b_max[1])), int(np.round(b_max[0]))]
-            print('Manual centroid b_max = ', b_max)
-            print("Centroid calc took {:f} sec.".format(ti.time()-ti1))
-        elif self.cob_max.currentText() == 'Centroid (3x3 mean)':
-            XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
-            b_max[0] = (XX * im_to_show2).sum() / im_to_show2.sum()
-            b_max[1] = (YY * im_to_show2).sum() / im_to_show2.sum()
-            b_max[2] = im_to_show2[int(np.round(b_max[1])) - 1: int(np.round(b_max[1])) + 2,
-                       int(np.round(b_max[0])) - 1: int(np.round(b_max[0])) + 2].mean()
-        elif self.cob_max.currentText() == 'Centroid (5x5 mean)':
-            XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
-            b_max[0] = (XX * im_to_show2).sum() / im_to_show2.sum()
-            b_max[1] = (YY * im_to_show2).sum() / im_to_show2.sum()
-            b_max[2] = im_to_show2[int(np.round(b_max[1])) - 2: int(np.round(b_max[1])) + 3,
-                       int(np.round(b_max[0])) - 2: int(np.round(b_max[0])) + 3].mean()
-
-        if not fit_pb:
-            self.LbMax.setText('Found max.: {:.2f} GL'.format(b_max[2]))
-            self.LbMaxPos.setText('Found max. position: ({:.2f}/{:.2f}) (x/y) in px'.format(b_max[0], b_max[1]))
-            print('b_max = ', b_max)
-        else:
-            self.LbMax.setText('Fit pb, used max.: {:.2f} GL'.format(b_max[2]))
-            print('Fit pb, used b_max = ', b_max)
-
-        if backg + im_to_show2.max() > sat_value * rel_sat_limit:
-            self.LbSaturation.setText('<b> <span style="color:#f00;">SATURATED IMAGE</span> </b>')
-        else:
-            self.LbSaturation.setText('This image is not saturated')
-
-
-    def make_auto_crop(self):  # only for the stack imge
-        print("make_auto_crop called")
-
-        global im_to_show2  # to avoid multiple execution
-        global auto_crop_uly, auto_crop_ulx
-
         im_idx = good_idx[self.SlNum2.value() - 1]  # read present slider value
         self.LbImInfo.setText("Image " + str(im_idx + 1))  # display it in the label right of the slider button
 
-        im_to_show = imStack[:, :, im_idx].copy()  # make a view of the right image
-        # auto crop to square around ROI if not disabled
-        if not self.cb_no_auto_crop.isChecked() \
-                and (self.cob_roi.currentText() == "Outside ROI"
-                     or self.cob_use_mean.currentText() == "Use A<sub>eff</sub>-curve fit"):
-            roi_li = np.round(roiS[0]).astype(int)  # extract good roi line and convert to int
-            roi_li[:2] -= crop_ulx  # switch to relative coords (with respect to crop)
-            roi_li[2:] -= crop_uly  # xfrom, xto, yfrom, yto
-            auto_crop_uly = roi_li[2] - frame_width
-            auto_crop_ulx = roi_li[0] - frame_width
-            im_to_show = im_to_show[
-                         auto_crop_uly:roi_li[3] + frame_width,
-                         auto_crop_ulx:roi_li[1] + frame_width]
-        else:
-            auto_crop_uly = 0
-            auto_crop_ulx = 0
-        im_to_show2 = im_to_show  # .copy()  ???
-
+        self.read_to_b_fits()  # the fits are initialized with the table values
+        settings = self.get_beam_settings()
+        dark = None
+        if self.cob_dark_im.currentText() == 'Use a dark image':
+            dark = imStack.frame(self.SbDark.value() - 1)
+        if any(fit is not None for fit in settings.fits):
+            if analyze_all_files_check:
+                main.statBar.showMessage(statusbarmessage + '\tFitting in progress', 5000)
+            else:
+                main.statBar.showMessage('Fitting in progress')
+
+        res = analyze_frame(imStack.frame(im_idx), dark, settings)
+        imStack.prefetch(im_idx)  # lazy stacks: read the next frames in the background
+
+        # publish the results for display, plots and export
+        im_to_show2 = res.image
+        (step, frame_width) = (res.step, res.frame_width)
+        (auto_crop_ulx, auto_crop_uly) = (res.auto_crop_ulx, res.auto_crop_uly)
+        (backg, energy, b_max) = (res.backg, res.energy, res.b_max)
+        (sot_x, sot_y, soft_val) = (res.sot_x, res.sot_y, res.soft_val)
+        (Aeffg, slope) = (res.aeffg, res.slope)
+        if any(fit is not None and fit["status"].startswith("OK") for fit in res.fits):
+            self.shift_b_fits()  # save old values (the initial values of read_to_b_fits)
+        for col_idx, fit in enumerate(res.fits):
+            if fit is not None:
+                b_fits[0][col_idx] = fit
+        self.show_frame_result(res)
 
-    def make_auto_crop_dark(self):  # only for the stack imge
-        print("make_auto_crop_dark called")
+        self.display2()  # show the 2D images of measurement model or residual
+        self.plot2_1D()  # show the cross sections, the Aeff-curve or the SOT-curve
+        self.LbTi2.setText('Last used time {:.3f} ms'.format((ti.time() - ti0) / 1e-3))
+        ti0 = ti.time() - ti0
 
-        global auto_crop_uly, auto_crop_ulx
+    def get_beam_settings(self):
+        """Return the BeamSettings (beam_engine.py) defined by the controls of tab 2"""
+        print("get_beam_settings called")
 
-        darkim_cropped = imStack[:, :, self.SbDark.value() - 1].copy()  # make a view of the right image
-        # auto crop to square around ROI if not disabled
-        if not self.cb_no_auto_crop.isChecked() \
-                and (self.cob_roi.currentText() == "Outside ROI"
-                     or self.cob_use_mean.currentText() == "Use A<sub>eff</sub>-curve fit"):
+        if np.any(np.isnan(roiS[0])):  # check if ROI is OK
+            roi = None
+        else:
             roi_li = np.round(roiS[0]).astype(int)  # extract good roi line and convert to int
             roi_li[:2] -= crop_ulx  # switch to relative coords (with respect to crop)
             roi_li[2:] -= crop_uly  # xfrom, xto, yfrom, yto
-            auto_crop_uly = roi_li[2] - frame_width
-            auto_crop_ulx = roi_li[0] - frame_width
-            darkim_cropped = darkim_cropped[
-                             auto_crop_uly:roi_li[3] + frame_width,
-                             auto_crop_ulx:roi_li[1] + frame_width]
-        else:
-            auto_crop_uly = 0
-            auto_crop_ulx = 0
-        return darkim_cropped  # .copy()  ???
+            roi = tuple(roi_li)
 
-
-    def cost_aeff_slope_sq(self, offset, PixMax):
-        print("cost_aeff_slope_sq called")
-
-        NbPoint = self.sbNbPoint.value()
-        Aeff_vec, _ = self.AeffCurveBasic(im_to_show2 - offset, PixMax=PixMax, step=step)
-        x_bidon = np.arange(len(Aeff_vec))  # use amplified slope by putting the points closer together
-        p = np.polyfit(x_bidon[-NbPoint:], Aeff_vec[-NbPoint:], 1)
-        # print('slope = ', p[0])
-        return p[0]**2
-
-    def get_backg(self):
-        print("get_backg called")
-
-        print('get_backg called')
-        global backg
-        global energy
-        global im_to_show2
-
-        if self.cob_dark_im.currentText() == 'Use a dark image':
-            im_to_show2 -= self.make_auto_crop_dark()
-
-        if np.any(np.isnan(roiS[0])):
-            self.LbOffSet.setText("The ROI is not defined")
+        fits = [None, None, None]  # the initial values of the activated fits
+        for col_idx in range(self.TbFit2.columnCount()):
+            if self.TbFit2.cellWidget(0, col_idx).currentText() == "Yes":
+                fits[col_idx] = b_fits[0][col_idx]
+        aeff_fit_idx = None  # use b_max[2] for Aeff
+        rdbt_no = self.rdbtgroup_for_aeff.checkedId()  # the button id is the fit column
+        if self.cbUseModMax.isChecked() and rdbt_no >= 0 and fits[rdbt_no] is not None:
+            aeff_fit_idx = rdbt_no  # the chosen fit is activated
+
+        return BeamSettings(
+            roi=roi,
+            roi_outside=self.cob_roi.currentText() == "Outside ROI",
+            backg_mode=backg_modes[self.cob_use_mean.currentIndex()],
+            auto_crop=not self.cb_no_auto_crop.isChecked(),
+            max_method=self.cob_max.currentText(),
+            n_steps=self.SbSteps.value(),
+            n_points=self.sbNbPoint.value(),
+            sat_limit=rel_sat_limit * sat_value,
+            sot_threshold=self.sb_sot_thresh.value() if self.cbMakeSotCalc.isChecked() else None,
+            moments=self.cbMakeD4sCalc.isChecked(),
+            fits=fits,
+            fits_at_max=analyze_all_files_check,  # initialize the beam position with b_max in the z-evolution
+            fits_log_init=self.cbLogInit.isChecked(),
+            aeff_fit_idx=aeff_fit_idx,
+            mask=masked if len(masked) else None,  # masked pixels are filled and not used for the fits
+            mask_offset=(crop_ulx, crop_uly))
+
+    def show_frame_result(self, res):
+        """Show a FrameResult (beam_engine.py) in the labels and the fit table of tab 2"""
+        print("show_frame_result called")
+
+        if res.message:
+            self.LbOffSet.setText(res.message)
             if analyze_all_files_check:
-                main.statBar.showMessage(statusbarmessage + '\tThe ROI is not defined', 5000)
+                main.statBar.showMessage(statusbarmessage + '\t' + res.message, 5000)
             else:
-                main.statBar.showMessage("The ROI is not defined", 4000)
-            return
-
-        if self.cob_use_mean.currentText() == "Use mean from ROI":  # calculate mean of ROI
-            # Create boolean mask 'ma' using 'ROI1', 'Out/In' and 'Mask' information
-            ma = np.zeros(im_to_show2.shape, dtype=bool)  # use a roi
-            # ma de base
-            roi_li = self.get_local_roi_line()
-            # count roi borders as inside
-            ma[roi_li[2]:roi_li[3] + 1, roi_li[0]:roi_li[1] + 1] = np.ones(
-                (roi_li[3] + 1 - roi_li[2], roi_li[1] + 1 - roi_li[0]), dtype=bool)
-            # print("taille ma de base: ", np.sum(ma))
-            # outside?
-            if ((self.cob_roi.currentText() == "Outside ROI")
-                    or (self.cob_use_mean.currentText() == "Use A<sub>eff</sub>-curve fit")):
-                ma = ~ma  # or use  np.logical_not
-            backg = im_to_show2[ma].mean()
-
-        elif self.cob_use_mean.currentText() == "Use A<sub>eff</sub>-curve fit":  # get offset from Aeff-curve fit
-            # aeffvec et imsize vec(données)
-            result = minimize(self.cost_aeff_slope_sq, x0=backg, args=(b_max[2]))
-            # init with good value: x0=backg (last image) is fast (0.55s/63i); x0=0 is slow (0.8s/63i)
-            # cost_aeff_slope_sq(self, offset, PixMax):
-            backg = result.x[0]  # result.x is an array-like
-            print(result.message)
-
+                main.statBar.showMessage(res.message, 4000)
         else:
-            self.LbOffSet.setText("PROBLEM WITH BACKGROUND CORRECTION.")
-            print("PROBLEM WITH BACKGROUND CORRECTION.")
-            return
-
-        # use backg
-        self.LbOffSet.setText("Found offset: {:3.2f} GL".format(backg))
-        im_to_show2 -= backg
-
-        # get energy of the corrected image
-        energy = im_to_show2.sum()
-        self.LbEng.setText('Found energy: {:0.4e} GL'.format(energy))
-        print('energy = ', energy)
+            self.LbOffSet.setText("Found offset: {:3.2f} GL".format(res.backg))
+            self.LbEng.setText('Found energy: {:0.4e} GL'.format(res.energy))
 
-
-    def AeffCurveBasic(self, image, PixMax=-100, points=20, step=5):
-        print("AeffCurveBasic called")
-
-        """ Returns only the outermost points of the Aeff curve.
-        :param image:
-        :param PixMax: use this maximum, if not given use maximum pixel in remaining image
-        :param points: length of curve, should be passed, should be the same as in calling function
-        :param step: cropping step in pixels, should be passed, should be the same as in calling function
-        :return: 
-           AeffS - vector of length 'points' (or less)
-           ImSizeS - vector of length 'points' (or less)
-        """
-        # print('AeffCurveBasic called')
-        if PixMax == -100:
-            PixMax = image.max()  # Pixel maximal
-
-        AeffS = np.zeros(points)  # line vector
-        ImSizeS = np.zeros(points)  # line vector
-        Taille = image.shape
-        while (Taille[0] - step > step) & (Taille[1] - step > step) & (points > 0):
-            usedimage = image[step:Taille[0] - step, step:Taille[1] - step]
-            # on enleve une partie de l'image
-
-            Taille = usedimage.shape
-            ImSizeS[points - 1] = np.array(Taille).prod()
-            AeffS[points - 1] = np.sum(usedimage) / PixMax
-
-            points = points - 1
-        return AeffS, ImSizeS
-
-    def get_aeffg(self):
-        print("get_aeffg called")
-
-        global Aeffg
-        global slope
-        # global straightness
-        # Should I replace b_max by the beam fit values if those are used for Aeffg? # global b_max
-        # print('get_aeffg called')
-
-        if self.cbUseModMax.isChecked() and self.rdbtgroup_for_aeff.checkedId() >= 0:
-            print(self.rdbtgroup_for_aeff.checkedId())
-            rdbt_no = self.rdbtgroup_for_aeff.checkedId()
-            if self.TbFit2.cellWidget(0, rdbt_no + 1).currentText() == "Yes":
-                # the chosen fit is activated
-                max_for_aeff = b_fits[0][rdbt_no]["max"] * b_max[2]
-                # possibly modify b_max here (copy the beam fit values of the max (x, y, z))
-            else:
-                max_for_aeff = b_max[2]
+        if not res.max_fit_pb:
+            self.LbMax.setText('Found max.: {:.2f} GL ({:.2f} ms)'.format(res.b_max[2], res.max_time * 1e3))
+            self.LbMaxPos.setText('Found max. position: ({:.2f}/{:.2f}) (x/y) in px'.format(
+                res.b_max[0], res.b_max[1]))
         else:
-            max_for_aeff = b_max[2]
-
-        NbPoint = self.sbNbPoint.value()
-        Aeff_vec, ImSize_vec = self.AeffCurveBasic(im_to_show2, PixMax=max_for_aeff, step=step)
-
-        Aeffg = Aeff_vec[-NbPoint:].mean()
-        print('Aeffg = ', Aeffg)
-        self.LbAeffg.setText('A<sub>eff</sub> : {:.2f} px.'.format(Aeffg))
-
-        self.LbAeffg_to_gau_w.setText('-> w_1 of G.: {:.2f} px.'.format(np.sqrt(2*Aeffg/np.pi)))
-
-        slope = np.polyfit(ImSize_vec[-NbPoint:], Aeff_vec[-NbPoint:], 1)[0]
-        self.LbSlope.setText('Slope : {:1.4e}'.format(slope))
-
-        # self.LbStraightness.setText('Straightness : {:1.4e}'.format(straightness))
-
-        self.LbTi2.setText('Last used time {:.3f} ms'.format((ti.time() - ti0) / 1e-3))
-
-    def get_sot_data(self):
-        print("get_sot_data called")
-
-        global sot_x, sot_y, soft_val
-        # sot fit-model has parameters max_sot and w_sot
-        hi_edges = np.linspace(-0.01, 1.2, num=122)  # makes steps of 1%, needs more than 1 due to smoothing
-        # hi_count, _ = np.histogram(im_to_show2 / sat_value, bins=hi_edges)  # normalized to image saturation
-        hi_count, _ = np.histogram(im_to_show2 / b_max[2], bins=hi_edges)  # normalized to b_max[2]
-        sot_x = hi_edges[:-1] + 0.005
-        sot_y = hi_count[::-1].cumsum()[::-1]
-
-        # res = plt.hist(x, bins) -> res[0] 1D-arr of counts; res[1] 1D-arr of bin limits;
-        # Data outside the bins (> last limit or < first limit) is not counted.
-        # The first intervals includes the first limit but not the second, the last int includes both limits.
-        # plt.hist trace immediately; np.histogram only calculates (same as above) for only one series
-        # the np version always returns 2 1D-arrays -> can be called by: counts, edges = np.histogram(...
-        # bins = number  and  bins = 'auto' are also possible
-
-        if self.cbMakeSotCalc.isChecked():  # calculates additionally the sot for a fixed threshold
-            soft_val = (im_to_show2 / b_max[2] > self.sb_sot_thresh.value()).sum()
-            self.LbSotResult.setText(
-                f'The SOT is: {soft_val} px²')
-
-    def get_step(self, minstep=2):
-        print("get_step called")
-
-        global step
-        global frame_width
+            self.LbMax.setText('Fit pb, used max.: {:.2f} GL'.format(res.b_max[2]))
+        if res.saturated:
+            self.LbSaturation.setText('<b> <span style="color:#f00;">SATURATED IMAGE</span> </b>')
+        else:
+            self.LbSaturation.setText('This image is not saturated')
+        if not np.isnan(res.soft_val):
+            self.LbSotResult.setText(f'The SOT is: {res.soft_val} px²')
+        if res.d4sigma is not None:
+            x_c, y_c, d_x, d_y, angle, ellipticity = res.d4sigma
+            self.LbD4sResult.setText('D4σ: {:.2f} x {:.2f} px'.format(d_x, d_y))
+            self.LbD4sAngle.setText('Angle: {:.1f} °, ellipticity: {:.3f}'.format(angle, ellipticity))
+
+        for col_idx, fit in enumerate(res.fits):
+            if fit is None:
+                continue
+            if not fit["status"].startswith("OK"):
+                print(self.TbFit2.horizontalHeaderItem(col_idx).text() + ": Fitting problem encountered")
+                continue
+            self.sb_hist.setValue(0)
+            self.TbFit2.cellWidget(3, col_idx).setText(fit["status"])
+            self.TbFit2.cellWidget(4, col_idx).setText("{:.4f}".format(fit["GOF"]))
+            self.TbFit2.cellWidget(5, col_idx).setText("{:.3f}".format(fit["w1"]))
+            if col_idx == 1:
+                self.TbFit2.cellWidget(6, col_idx).setText("{:.2f}".format(fit["max"]))
+                continue
+            self.TbFit2.cellWidget(6, col_idx).setText("{:.4f}".format(fit["max"]))
+            self.TbFit2.cellWidget(7, col_idx).setText("{:.2f}".format(fit["x_0"]))
+            self.TbFit2.cellWidget(8, col_idx).setText("{:.2f}".format(fit["y_0"]))
+            if col_idx == 2:
+                self.TbFit2.cellWidget(9, col_idx).setText("{:.3f}".format(fit["w2"]))
+                self.TbFit2.cellWidget(10, col_idx).setText("{:.1f}".format(fit["angle"]))
+        if any(fit is not None for fit in res.fits):
+            if analyze_all_files_check:
+                main.statBar.showMessage(statusbarmessage + '\tFitting finished', 5000)
+            else:
+                main.statBar.showMessage('Fitting finished', 5000)
+            self.TbFit2.resizeColumnsToContents()
+            self.TbFit2.resizeRowsToContents()
 
-        if np.any(np.isnan(roiS[0])):  # check if ROI is OK
-            self.LbOffSet.setText("The ROI is not defined")
-            return
-        roi_li = np.round(roiS[0]).astype(int)  # extract good roi line and convert to int
-        roi_li[:2] -= crop_ulx  # switch to relative coords (with respect to crop)
-        roi_li[2:] -= crop_uly
-        frame_width = np.min([roi_li[0], imStack.shape[1] - roi_li[1],
-                              roi_li[2], imStack.shape[0] - roi_li[3]])
-        if ((self.cob_use_mean.currentText() == "Use mean from ROI"  # is there a reasonable frame ?
-             and self.cob_roi.currentText() == "Outside ROI") or
-                (self.cob_use_mean.currentText() == "Use A<sub>eff</sub>-curve fit")):
-            step = int(frame_width / (self.SbSteps.value() - 1))
-            if step < minstep:  # set minimum step to 2
-                step = minstep
-        else:  # no reasonable frame present
-            step = minstep
-        return
+        self.LbAeffg.setText('A<sub>eff</sub> : {:.2f} px.'.format(res.aeffg))
+        self.LbAeffg_to_gau_w.setText('-> w_1 of G.: {:.2f} px.'.format(np.sqrt(2*res.aeffg/np.pi)))
+        self.LbSlope.setText('Slope : {:1.4e}'.format(res.slope))
 
     def plot2_1D(self):
         print("plot2_1D called")
@@ -2921,17 +2547,17 @@ class MyTableWidget(QWidget):
             axPlt2.legend()
 
         elif self.Cob1Ddisp.currentText() == "A<sub>eff</sub> curves":
-            # AeffCurveBasic(self, image, PixMax=-100, points=5, step=5)
+            # aeff_curve_basic(image, PixMax=-100, points=20, step=5)
             # return AeffS, ImSizeS
 
             # # The curve before any correction using Pixmax - but later the plot gets scaled on the corrected curve
             # im_idx = good_idx[self.SlNum2.value() - 1]  # read present slider value
-            # Aeff_vec, ImSize_vec = self.AeffCurveBasic(imStack[:, :, im_idx], step=step)
+            # Aeff_vec, ImSize_vec = aeff_curve_basic(imStack.frame(im_idx), step=step)
             # axPlt2.plot(ImSize_vec/1000, Aeff_vec, '--', color="grey", label="no offset")
             # # removed because autocrop was not taken into account
 
             # the curve after offset correction using the b_max for the max
-            Aeff_vec, ImSize_vec = self.AeffCurveBasic(im_to_show2, PixMax=b_max[2], step=step)
+            Aeff_vec, ImSize_vec = aeff_curve_basic(im_to_show2, PixMax=b_max[2], step=step)
             Aeff_corr_max = Aeff_vec.max()
             Aeff_corr_min = Aeff_vec.min()
             axPlt2.plot(ImSize_vec/1000, Aeff_vec, '.r', label="with offset")
@@ -2967,7 +2593,7 @@ class MyTableWidget(QWidget):
 
     def display_up2(self):
         print('display_up2 called')
-        if self.SlNum2.value() < imStack.shape[2]:
+        if self.SlNum2.value() < imStack.n_frames:
             self.SlNum2.setValue(self.SlNum2.value() + 1)
 
     def display2(self):
@@ -2984,7 +2610,7 @@ class MyTableWidget(QWidget):
 
         elif self.Cob2Ddisp.currentText() == "Round G. model":
             # calculate model data (slow version)
-            XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
+            XX, YY = coordinate_grid(im_to_show2.shape)
             try:
                 col_idx = 0
                 paras = [b_fits[0][col_idx]["max"], b_fits[0][col_idx]["x_0"],
@@ -2997,7 +2623,7 @@ class MyTableWidget(QWidget):
         elif self.Cob2Ddisp.currentText() == "Round G. residual (measurement - model)":
             # calculate model data (slow version)
             ti_mod = ti.time()
-            XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
+            XX, YY = coordinate_grid(im_to_show2.shape)
             # try:
             col_idx = 0
             paras = [b_fits[0][col_idx]["max"], b_fits[0][col_idx]["x_0"],
@@ -3008,7 +2634,7 @@ class MyTableWidget(QWidget):
             self.show_image2(im=resi, cmap="seismic", vmi2=-max_resi, vma2=max_resi)
 
         elif self.Cob2Ddisp.currentText() == "Elliptic G. model":
-            XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
+            XX, YY = coordinate_grid(im_to_show2.shape)
             try:
                 col_idx = 2
                 paras = [b_fits[0][col_idx]["max"], b_fits[0][col_idx]["x_0"],
@@ -3031,7 +2657,7 @@ class MyTableWidget(QWidget):
 
         elif self.Cob2Ddisp.currentText() == "Elliptic G. residual (measurement - model)":
             ti_mod = ti.time()
-            XX, YY = np.meshgrid(range(im_to_show2.shape[1]), range(im_to_show2.shape[0]))
+            XX, YY = coordinate_grid(im_to_show2.shape)
             # try:
             col_idx = 2
             paras = [b_fits[0][col_idx]["max"], b_fits[0][col_idx]["x_0"],
@@ -3071,26 +2697,11 @@ class MyTableWidget(QWidget):
         axIM2.axis("off")
 
         # mark masked pixels if wished
-        im_modified = im.copy()  # modify a copy of im
         if self.cbMaskShow.isChecked():
-            # calculate the values of the color switch limits and the
-            # replacement values (for the masked pixels to become visible)
-            MiniVal = np.min(im)
-            MaxiVal = np.max(im)
-            infernoLimits = [0.35, 0.82]
-            infernoColVals = [0.66, 1]
-            # change the values (colors) of the pixels in the list
-            for count in range(len(masked)):
-                try:
-                    if (masked[count][1] - crop_uly >= 0) and (masked[count][0] - crop_ulx >= 0):  # no neg indices
-                        IsVal = im[masked[count][1] - crop_uly, masked[count][0] - crop_ulx]
-                        if infernoLimits[0] < IsVal / (MaxiVal - MiniVal) < infernoLimits[1]:  # light color
-                            putVal = infernoColVals[1] * (MaxiVal - MiniVal) + MiniVal
-                        else:
-                            putVal = infernoColVals[0] * (MaxiVal - MiniVal) + MiniVal
-                        im_modified[masked[count][1] - crop_uly, masked[count][0] - crop_ulx] = putVal
-                except IndexError:
-                    pass  # does not crash if pixels outside the present crop are part of the mask
+            # im is the auto-cropped part of the cropped frame
+            im_modified = masked.overlay(im, crop_ulx + auto_crop_ulx, crop_uly + auto_crop_uly)
+        else:
+            im_modified = im
 
         cax = axIM2.imshow(im_modified, cmap=cmap, vmin=vmi2, vmax=vma2)
         # common color maps: jet, gray, hot, hsv, inferno, gist_ncar
@@ -3146,6 +2757,7 @@ class MyTableWidget(QWidget):
         res_backg = np.ones(len(good_idx)) * np.nan
         res_energy = np.ones(len(good_idx)) * np.nan
         res_soft = np.ones(len(good_idx)) * np.nan  # SOT for fixed threshold
+        res_d4s = np.ones((len(good_idx), len(moment_columns))) * np.nan  # D4σ values (see beam_moments.py)
 
         # Prepare the variables for the fit results
         if ((self.TbFit2.cellWidget(0, 0).currentText() == "Yes") or
@@ -3164,32 +2776,48 @@ class MyTableWidget(QWidget):
         QApplication.processEvents()
         ti_stack_0 = ti.time()
 
-        for idx in range(len(good_idx)):
-            self.SlNum2.setValue(idx + 1)  # triggers the calculations using the settings defined on tab2
+        # run the numerical pipeline only, tab 2 is redrawn once at the end
+        self.read_to_b_fits()  # the first frame is initialized with the table values
+        settings = self.get_beam_settings()
+        dark = None
+        if self.cob_dark_im.currentText() == 'Use a dark image':
+            dark = imStack.frame(self.SbDark.value() - 1)
+
+        def show_progress(done, total):
+            main.progBar.setValue(done)
+            QApplication.processEvents()
+
+        if analyze_all_files_check:  # the stacks of the z-scan predict the fits of each other
+            warm_start = z_warm_start
+        else:
+            warm_start = WarmStart(self.cob_warm_start.currentText())
+        frame_results = analyze_stack(imStack, good_idx, dark, settings, progress=show_progress,
+                                      warm_start=warm_start)
 
+        for idx, res in enumerate(frame_results):
             res_imno[idx] = good_idx[idx] + 1  # image number in initial stack (wcf-file)
-            res_aeff[idx] = Aeffg
-            res_slope[idx] = slope
+            res_aeff[idx] = res.aeffg
+            res_slope[idx] = res.slope
             res_straightn[idx] = np.nan
-            res_max[idx] = b_max  # takes x, y, z
-            res_backg[idx] = backg
-            res_energy[idx] = energy
+            res_max[idx] = res.b_max  # takes x, y, z
+            res_backg[idx] = res.backg
+            res_energy[idx] = res.energy
 
             if self.cbMakeSotCalc.isChecked():
-                res_soft[idx] = soft_val
-
-            if self.TbFit2.cellWidget(0, 0).currentText() == "Yes":  # Round Gauss fit done
-                res_b_fit[idx, 0] = b_fits[0][0]
-                res_b_fit[idx, 0]["max"] *= b_max[2]  # remove normalization
-            if self.TbFit2.cellWidget(0, 1).currentText() == "Yes":  # SOT fit done
-                res_b_fit[idx, 1] = b_fits[0][1]
-                res_b_fit[idx, 1]["max"] *= b_max[2]  # remove normalization
-            if self.TbFit2.cellWidget(0, 2).currentText() == "Yes":  # Elliptic Gauss fit done
-                res_b_fit[idx, 2] = b_fits[0][2]
-                res_b_fit[idx, 2]["max"] *= b_max[2]  # remove normalization
-
-            main.progBar.setValue(idx + 1)
-            QApplication.processEvents()
+                res_soft[idx] = res.soft_val
+            if res.d4sigma is not None:
+                res_d4s[idx] = res.d4sigma
+
+            for col_idx, fit in enumerate(res.fits):  # Round Gauss, SOT and Elliptic Gauss fits
+                if fit is not None:
+                    res_b_fit[idx, col_idx] = dict(fit, max=fit["max"] * res.b_max[2])  # remove normalization
+
+        # show the last frame on tab 2 (not during the z-evolution, the next stack follows)
+        if not analyze_all_files_check:
+            if self.SlNum2.value() != len(good_idx):
+                self.SlNum2.setValue(len(good_idx))  # triggers onImageChange
+            else:
+                self.onImageChange()
 
         # Fill the results-dict using the values above and define the keys at the same time
         # The keys will be used as headers of the Excel sheet and the cobos fpr plotting the histograms
@@ -3203,7 +2831,13 @@ class MyTableWidget(QWidget):
         results["SOfT (px²)"] = res_soft
         results["Max pos X (px)"] = res_max[:, 0]
         results["Max pos Y (px)"] = res_max[:, 1]
+        if self.cbMakeD4sCalc.isChecked():  # second moments, d_x is the principal axis closer to x
+            results["D4σx (px)"] = res_d4s[:, moment_columns.index("d_x")]
+            results["D4σy (px)"] = res_d4s[:, moment_columns.index("d_y")]
+            results["D4σ angle (°)"] = res_d4s[:, moment_columns.index("angle")]
+            results["D4σ ellipticity"] = res_d4s[:, moment_columns.index("ellipticity")]
         # "status" "GOF" "w1" "max" "x_0" "y_0" "w2" "angle" (useful entries of fit parameter dicts)
+        # "GOF" is R², "AICc" "BIC" "red_chi2" are the other fit_quality values (fitting_module_v2.py)
         if self.TbFit2.cellWidget(0, 0).currentText() == "Yes":  # Round Gauss fit done
             results["RG beam radius w1 (px)"] = np.array([res_b_fit[row, 0]["w1"] for row in range(len(good_idx))])
             results["RG Max value (GL)"] = np.array([res_b_fit[row, 0]["max"] for row in range(len(good_idx))])
@@ -3211,11 +2845,19 @@ class MyTableWidget(QWidget):
             results["RG Max pos Y (px)"] = np.array([res_b_fit[row, 0]["y_0"] for row in range(len(good_idx))])
             results["RG status"] = list([res_b_fit[row, 0]["status"] for row in range(len(good_idx))])
             results["RG GOF"] = np.array([res_b_fit[row, 0]["GOF"] for row in range(len(good_idx))])
+            results["RG AICc"] = np.array([res_b_fit[row, 0]["AICc"] for row in range(len(good_idx))])
+            results["RG BIC"] = np.array([res_b_fit[row, 0]["BIC"] for row in range(len(good_idx))])
+            results["RG red. chi²"] = np.array([res_b_fit[row, 0]["red_chi2"] for row in range(len(good_idx))])
+            results["RG evaluations"] = np.array([res_b_fit[row, 0]["n_eval"] for row in range(len(good_idx))])
         if self.TbFit2.cellWidget(0, 1).currentText() == "Yes":  # SOT fit done
             results["Gsot beam radius w1 (px)"] = np.array([res_b_fit[row, 1]["w1"] for row in range(len(good_idx))])
             results["Gsot Max value (GL)"] = np.array([res_b_fit[row, 1]["max"] for row in range(len(good_idx))])
             results["Gsot status"] = list([res_b_fit[row, 1]["status"] for row in range(len(good_idx))])
             results["Gsot GOF"] = np.array([res_b_fit[row, 1]["GOF"] for row in range(len(good_idx))])
+            results["Gsot AICc"] = np.array([res_b_fit[row, 1]["AICc"] for row in range(len(good_idx))])
+            results["Gsot BIC"] = np.array([res_b_fit[row, 1]["BIC"] for row in range(len(good_idx))])
+            results["Gsot red. chi²"] = np.array([res_b_fit[row, 1]["red_chi2"] for row in range(len(good_idx))])
+            results["Gsot evaluations"] = np.array([res_b_fit[row, 1]["n_eval"] for row in range(len(good_idx))])
         if self.TbFit2.cellWidget(0, 2).currentText() == "Yes":  # Elliptic Gauss fit done
             results["EllG beam radius w1 (px)"] = np.array([res_b_fit[row, 2]["w1"] for row in range(len(good_idx))])
             results["EllG beam radius w2 (px)"] = np.array([res_b_fit[row, 2]["w2"] for row in range(len(good_idx))])
@@ -3225,6 +2867,10 @@ class MyTableWidget(QWidget):
             results["EllG Max pos Y (px)"] = np.array([res_b_fit[row, 2]["y_0"] for row in range(len(good_idx))])
             results["EllG status"] = list([res_b_fit[row, 2]["status"] for row in range(len(good_idx))])
             results["EllG GOF"] = np.array([res_b_fit[row, 2]["GOF"] for row in range(len(good_idx))])
+            results["EllG AICc"] = np.array([res_b_fit[row, 2]["AICc"] for row in range(len(good_idx))])
+            results["EllG BIC"] = np.array([res_b_fit[row, 2]["BIC"] for row in range(len(good_idx))])
+            results["EllG red. chi²"] = np.array([res_b_fit[row, 2]["red_chi2"] for row in range(len(good_idx))])
+            results["EllG evaluations"] = np.array([res_b_fit[row, 2]["n_eval"] for row in range(len(good_idx))])
         # probably there is a better way to do this
 
         # populate combo boxes for display of histograms and x-y-scatter
@@ -3516,7 +3162,7 @@ class MyTableWidget(QWidget):
 
     def analyze_all_files(self):
         global f_name, list_z_positions, final_results_list, thisFile_type, list_files
-        global analyze_all_files_check, statusbarmessage, dirname2, baseName2, baseName
+        global analyze_all_files_check, statusbarmessage, dirname2, baseName2, baseName, z_warm_start
 
         final_results_list = []
         all_tab4_cobo_items = []
@@ -3533,9 +3179,10 @@ class MyTableWidget(QWidget):
             z = float(zz)
             return z
 
-        # generate list of filenames for files of (i) same type as the initial file, (ii) same file size,
-        # (iii) containing information on the z position.
-        fi_size = os.path.getsize(f_name)
+        # generate list of filenames for files of (i) same type as the initial file, (ii) same frame
+        # geometry (wcf header), (iii) containing information on the z position.
+        if file_type == "wcf":
+            fi_info = read_wcf_info(f_name)
         list_files = []  # just for short output of the filenames
         list_z_positions = []
         list_f_names = []
@@ -3545,8 +3192,11 @@ class MyTableWidget(QWidget):
             if thisFile_type != file_type:  # wrong file type
                 continue
             if thisFile_type == "wcf":
-                thisFileSize = os.path.getsize(os.path.join(dirname, filename))
-                if thisFileSize != fi_size:  # wrong file size
+                try:
+                    thisFileInfo = read_wcf_info(os.path.join(dirname, filename))
+                except ValueError:  # not a readable wcf file
+                    continue
+                if thisFileInfo != fi_info:  # other frame geometry
                     continue
                 z_pos = extract_z_from_filename(thisBaseName)
                 if z_pos == -20e20:  # or error in position extraction
@@ -3576,8 +3226,15 @@ class MyTableWidget(QWidget):
                 break  # exit filename loop in initial directory
                 #TODO restructure to avoid double break
 
+        # process the files in the order of z (the warm start of a stack is predicted from the previous ones)
+        z_sorted = sorted(zip(list_z_positions, list_files, list_f_names), key=lambda item: item[0])
+        list_z_positions = [item[0] for item in z_sorted]
+        list_files = [item[1] for item in z_sorted]
+        list_f_names = [item[2] for item in z_sorted]
+
         # Make the processing and save in final_results_list
         final_results_list = []
+        z_warm_start = WarmStart(self.cob_warm_start.currentText())
         if file_type == "wcf":
             for i in range(len(list_f_names)):
                 # print("File: ", list_files[i], '; z-val : ', list_z_positions[i])
@@ -3585,6 +3242,7 @@ class MyTableWidget(QWidget):
                 # main.statBar.showMessage("", 3000)
                 text1 = "Analyzing file {} out of {}: "
                 statusbarmessage = text1.format(i+1, len(list_f_names))
+                z_warm_start.next_stack(list_z_positions[i])
                 self.load_stack()
                 self.make_result_dict()
                 if self.CbExport.isChecked():
@@ -3598,6 +3256,7 @@ class MyTableWidget(QWidget):
                 f_name = list_f_names[i]
                 text1 = "Analyzing stack {} out of {} (z = {:.2f}) "
                 statusbarmessage = text1.format(i + 1, len(list_f_names), list_z_positions[i])
+                z_warm_start.next_stack(list_z_positions[i])
                 self.load_stack()
                 self.make_result_dict()
                 if self.CbExport.isChecked():
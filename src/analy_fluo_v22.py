@@ -19,6 +19,7 @@ from scipy import ndimage as ndi
 from scipy import stats as st
 
 import numpy as np
+from pixel_mask import PixelMask
 import datetime as ti
 import openpyxl as xl  # for writing excel files with multi line header
 import csv  # for reading more easily the text file with the mask data
@@ -26,6 +27,7 @@ import csv  # for reading more easily the text file with the mask data
 roi_3_width = 4  # pixels
 hole_start_ringmean = -10
 hole_start_maxpos = -10
+masked = PixelMask()  # masked pixels in the coordinates of the cropped stack (see load_mask, modify_mask)
 
 class MainWindow(QMainWindow):
     def __init__(self, parent=None):
@@ -492,10 +494,9 @@ class MyTableWidget(QWidget):
             fi_handle.write("\t{:5d}\t\n".format(self.SbUpper.value()))  # for safety use 5 digits
             fi_handle.write("{:5d}\t\t{:5d}\n".format(self.SbLeft.value(), self.SbRight.value()))
             fi_handle.write("\t{:5d}\t\n".format(self.SbLower.value()))
-            # masked is a list of tuples
+            # masked is a PixelMask (coordinates in the cropped stack)
             fi_handle.write("\nCoordinates of masked pixels (pixels):\n")
-            for masked_pixel in masked:
-                fi_handle.write("{:5d}\t{:5d}\n".format(masked_pixel[0], masked_pixel[1]))
+            np.savetxt(fi_handle, np.column_stack(masked.pixels()), fmt="%5d", delimiter="\t")
         return
 
     def load_mask(self):
@@ -528,9 +529,8 @@ class MyTableWidget(QWidget):
             for count in range(2):  # jump 2 lines
                 _ = next(reader)
 
-            masked = []  # empty masked
-            for row in reader:  # fill masked
-                masked.append((int(row[0]), int(row[1])))
+            coords = np.array([(int(row[0]), int(row[1])) for row in reader], dtype=int).reshape(-1, 2)
+            masked = PixelMask.from_pixels(coords[:, 0], coords[:, 1])
         return
 
     def Load_File1(self):
@@ -643,7 +643,7 @@ class MyTableWidget(QWidget):
                 roiS = np.ones((4, 4))*np.nan  # xfrom, xto, yfrom, yto (include all indices)
                 # has to be float if not, there is no "nan"
                 # first index = RoiNo, second index = xfrom, xto, yfrom, yto
-                masked = []
+                masked = PixelMask((im1_height, im1_width))
                 mask_during_modif = False
 
             if self.CbCrop.isChecked():  # keep the cropping, if it was on
@@ -748,23 +748,11 @@ class MyTableWidget(QWidget):
             vma1 = im_to_show.max()
             
         # mark masked pixels if wished
-        im_modified = im_to_show.copy()  # modify a copy of im_to_show
         if self.cbMaskShow.isChecked():
-            # calculate the values of the color switch limits and the
-            # replacement values (for the masked pixels to become visible)
-            MiniVal = np.min(im_to_show)
-            MaxiVal = np.max(im_to_show)
-            infernoLimits = [0.35, 0.82]
-            infernoColVals = [0.66, 1]
-            # change the values (colors) of the pixels in the list
-            for count in range(len(masked)):
-                IsVal = im_to_show[masked[count][1], masked[count][0]]
-                if infernoLimits[0] < IsVal / (MaxiVal - MiniVal) < infernoLimits[1]:  # light color
-                    putVal = infernoColVals[1] * (MaxiVal - MiniVal) + MiniVal
-                else:
-                    putVal = infernoColVals[0] * (MaxiVal - MiniVal) + MiniVal
-                im_modified[masked[count][1], masked[count][0]] = putVal
-        
+            im_modified = masked.overlay(im_to_show)
+        else:
+            im_modified = im_to_show
+
         cax = axIM1.imshow(im_modified, cmap=self.CoboCmap.currentText(), vmin=vmi1, vmax=vma1)
         # common color maps: jet, gray, hot, hsv, inferno, gist_ncar
         self.figureIM1.colorbar(cax, orientation='vertical')
@@ -858,28 +846,16 @@ class MyTableWidget(QWidget):
     def modify_mask(self):
         """ Adds or removes the third line of 'roiS' to 'masked'
         """
-        global masked  # list of tuples
-
-        # Generate list of selected points
-        points_new = []  # list of tuples
         ulx = int(np.round(roiS[roiNo, 0]))
         lrx = int(np.round(roiS[roiNo, 1]))
         uly = int(np.round(roiS[roiNo, 2]))
         lry = int(np.round(roiS[roiNo, 3]))
-        # fill columnwise
-        for xCoo in range(ulx, lrx + 1):  # from left to right
-            # column loop
-            for yCoo in range(uly, lry + 1):  # from upper to lower
-                # line loop
-                points_new.append((xCoo, yCoo))  # (x, y) coordinates
-
-        # add or remove points_new to masked
+
+        # add or remove the rectangle to masked
         if self.CoboMaskMode.currentText() == "Add pixels":
-            #             # add really new points to MaskList
-            masked = list(set(masked + points_new))  # sorts at the same time
+            masked.add_rect(ulx, lrx, uly, lry)
         elif self.CoboMaskMode.currentText() == "Remove pixels":
-            # remove entries of newPoints that existed in MaskList
-            masked = list(set(masked) - set(points_new))  # sorts at the same time
+            masked.remove_rect(ulx, lrx, uly, lry)
 
         print('len masked = ', len(masked))
         self.lbMaskInfo.setText("{:.0f} pixels masked".format(len(masked)))
@@ -940,8 +916,7 @@ class MyTableWidget(QWidget):
                     ma = ~ma  # or use  np.logical_not
                 # print("taille ma apres out in: ", np.sum(ma))
             if self.TbTasks.cellWidget(line, 2).currentText() == "Ignore masked pixels":  # remove masked pixels from ma
-                for masked_pixel in masked:  # would a try: except: continue slow down a lot? ? put for safety
-                    ma[masked_pixel[1], masked_pixel[0]] = False
+                ma &= ~masked.crop_view(0, 0, ma.shape)
             # print("taille ma apres tout: ", np.sum(ma))
 
             # Evaluate values (later also positions) using 'Value':"Mean Value", "Max Value", "Min Value", "Max Position"
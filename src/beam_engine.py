@@ -0,0 +1,946 @@
+"""
+Beam analysis of one frame, without any Qt widget (headless)
+
+This is the pipeline of tab 2 of AeffGUIv6 (get_step, make_auto_crop, mask_stage,
+get_backg, get_beam_max, get_sot_data, d4sigma, make_fits, get_aeffg) as plain functions. All
+settings are given in a BeamSettings object and all results are returned in a
+FrameResult object, there are no global variables:
+
+    settings = BeamSettings(roi=(150, 250, 150, 250), max_method='Max pixel (3x3 mean)')
+    res = analyze_frame(frame, None, settings)
+    print(res.aeffg, res.b_max, res.fits)
+
+The GUI is one client (see MyTableWidget.onImageChange), batch jobs can use
+the same functions without a display.
+"""
+import time
+from dataclasses import dataclass, field, replace
+
+import numpy as np
+from scipy.optimize import leastsq
+from skimage.morphology import (erosion, dilation, binary_opening, disk)
+from skimage.measure import block_reduce
+
+from fitting_module_v2 import (gauss2D_cst_offs, sot_r_gau, gaussEll2D_cst_offs, log_quadratic_guess, batch_leastsq,
+                               fit_quality)
+from beam_locator import (roi_mask, roi_indices, selected_pixels, stratified_pixels, marginal_centroid, window_mean,
+                          peak_3point)
+from pixel_mask import fill_masked
+from beam_moments import d4sigma
+
+# The texts of the combo box for the maximum (cob_max)
+max_methods = ('Max pixel', 'Max pixel (3x3 mean)', 'Max pixel (5x5 mean)',
+               'Cap fit 95%', 'Cap fit 90%', 'Cap fit 80%', 'Cap fit 70%',
+               'Centroid', 'Centroid (3x3 mean)', 'Centroid (5x5 mean)',
+               'Peak (parabolic 3-point)', 'Peak (Gaussian 3-point)')
+# The background modes, in the order of the combo box cob_use_mean
+backg_modes = ("roi mean", "aeff fit")
+# The solvers of the offset in the "aeff fit" mode (see aeff_fit_offset)
+backg_fit_methods = ("lsq", "weighted", "median")
+stack_chunk_bytes = 2**24  # analyze_stack converts about 16 MB of frames at once (without cap fit)
+fit_batch_bytes = 2**26  # make_fits_batch solves the 2D fits of frames with about 64 MB of Jacobians at once
+# The beam models of the fit table (TbFit2 columns)
+fit_names = ("Round G.", "Same SOT G.", "Ell. G.")
+# The fitted values of the fit dicts ("max" relative to b_max[2]), the SOT fit has only max and w1
+fit_value_keys = ("max", "x_0", "y_0", "w1", "w2", "angle")
+# The statistics of the fit dicts (see fit_stats), "GOF" is R²
+fit_stat_keys = ("n_eval", "GOF", "AICc", "BIC", "red_chi2")
+# The initial values of the fits of analyze_stack (see WarmStart)
+warm_start_modes = ("table", "previous frame", "stack median", "z neighbours")
+
+
+@dataclass
+class BeamSettings:
+    """Settings of the analysis of one frame (the controls of tab 2)
+    roi: (xfrom, xto, yfrom, yto) of ROI 1 in frame coordinates (borders included), None if not defined
+    roi_outside: the background is taken outside the ROI (else inside)
+    backg_mode: one of backg_modes
+    backg_fit: one of backg_fit_methods (only for the "aeff fit" mode)
+    auto_crop: crop the frame to the ROI and its dark frame (only for outside ROI or aeff fit)
+    max_method: one of max_methods
+    n_steps: number of Aeff-curve steps in the dark frame (SbSteps)
+    min_step: smallest Aeff-curve step in pixels
+    n_points: number of points of the Aeff-curve used for Aeffg and the slope (sbNbPoint)
+    aeff_points: length of the Aeff curve
+    sat_limit: grey level above which a pixel is saturated (rel_sat_limit * sat_value)
+    sot_threshold: relative threshold for the surface over threshold, None: not calculated
+    moments: calculate the D4σ widths (beam_moments.py)
+    fits: for every beam model of fit_names None (no fit) or a dict with the initial values
+        like b_fits ("lim", "max" (relative), "w1", "x_0", "y_0", "w2", "angle"), for the 2D fits
+        optionally "budget": the number of pixels of a multiresolution fit (see fit_selection), 0: all
+    fits_at_max: initialize the fit centers at the found maximum (z-scan)
+    fits_log_init: initialize the 2D fits with log_quadratic_guess of the used pixels
+        (the values of fits are used if the pixels are not a bump)
+    aeff_fit_idx: use the maximum of this fit for Aeff (index in fit_names), None: use b_max
+    mask: PixelMask (pixel_mask.py) of the pixels to ignore, None: no masking
+    mask_offset: position (x, y) of the frame in the coordinates of mask (the user crop)
+    """
+    roi: tuple = None
+    roi_outside: bool = True
+    backg_mode: str = "roi mean"
+    backg_fit: str = "lsq"
+    auto_crop: bool = True
+    max_method: str = 'Max pixel'
+    n_steps: int = 10
+    min_step: int = 2
+    n_points: int = 5
+    aeff_points: int = 20
+    sat_limit: float = np.inf
+    sot_threshold: float = None
+    moments: bool = False
+    fits: list = field(default_factory=lambda: [None, None, None])
+    fits_at_max: bool = False
+    fits_log_init: bool = True
+    aeff_fit_idx: int = None
+    mask: object = None
+    mask_offset: tuple = (0, 0)
+
+
+@dataclass
+class FrameResult:
+    """Results of analyze_frame
+    image: background corrected float image (auto-cropped), im_to_show2 in the GUI
+    auto_crop_ulx, auto_crop_uly: position of the auto-crop in the frame
+    step, frame_width: Aeff-curve step and width of the dark frame around the ROI (pixels)
+    backg, energy: found offset and energy (sum of the corrected image) in grey levels
+    b_max: array (x, y, value) of the beam maximum
+    max_fit_pb: the cap fit failed, the 3x3 mean was used
+    max_time: time used by get_beam_max in seconds (per frame in analyze_frames)
+    saturated: the frame contains saturated pixels
+    sot_x, sot_y: surface over threshold curve, soft_val: SOT for sot_threshold (or nan)
+    d4sigma: None or array with the D4σ values of beam_moments.moment_columns (centroid, widths, angle, ellipticity)
+    fits: list of dicts (like b_fits[0]) with the fit results, None for models not fitted
+    aeff_vec, imsize_vec: Aeff curve, max_for_aeff: maximum used for it
+    aeffg, slope: Aeff and slope of the last n_points of the curve
+    message: "" or the reason why the analysis is incomplete
+    """
+    image: np.ndarray = None
+    auto_crop_ulx: int = 0
+    auto_crop_uly: int = 0
+    step: int = 2
+    frame_width: int = 0
+    backg: float = 0.0
+    energy: float = np.nan
+    b_max: np.ndarray = field(default_factory=lambda: np.zeros(3))
+    max_fit_pb: bool = False
+    max_time: float = np.nan
+    saturated: bool = False
+    sot_x: np.ndarray = None
+    sot_y: np.ndarray = None
+    soft_val: float = np.nan
+    d4sigma: np.ndarray = None
+    fits: list = field(default_factory=lambda: [None, None, None])
+    aeff_vec: np.ndarray = None
+    imsize_vec: np.ndarray = None
+    max_for_aeff: float = np.nan
+    aeffg: float = np.nan
+    slope: float = np.nan
+    message: str = ""
+
+
+def get_step(frame_shape, settings):
+    """Return (step, frame_width) of the Aeff curve for a frame of frame_shape (height, width)"""
+    if settings.roi is None:
+        return settings.min_step, 0
+    roi_li = settings.roi
+    frame_width = int(np.min([roi_li[0], frame_shape[1] - roi_li[1],
+                              roi_li[2], frame_shape[0] - roi_li[3]]))
+    if ((settings.backg_mode == "roi mean" and settings.roi_outside)  # is there a reasonable frame ?
+            or settings.backg_mode == "aeff fit"):
+        step = max(int(frame_width / (settings.n_steps - 1)), settings.min_step)
+    else:  # no reasonable frame present
+        step = settings.min_step
+    return step, frame_width
+
+
+def auto_crop_slices(settings, frame_width):
+    """Return (rows, cols) slices of the auto-crop: a square frame of frame_width around the ROI"""
+    if (settings.roi is not None and settings.auto_crop
+            and (settings.roi_outside or settings.backg_mode == "aeff fit")):
+        roi_li = settings.roi
+        return (slice(roi_li[2] - frame_width, roi_li[3] + frame_width),
+                slice(roi_li[0] - frame_width, roi_li[1] + frame_width))
+    return slice(None), slice(None)
+
+
+def nested_crop_sums(image, points=20, step=5):
+    """ Sums and pixel numbers of the nested crops of the Aeff curve, from a summed-area table.
+    Like the original loop, the crop k (k = 1, 2, ...) is image[step:-(2k-1)*step, step:-(2k-1)*step]
+    (each crop is taken from the previous crop size). After one cumulative sum every crop sum takes
+    4 table values, instead of a new sum over the crop.
+    :param image: one image (height, width) or a stack of images (frames, height, width)
+    :param points: length of curve
+    :param step: cropping step in pixels
+    :return:
+       sums - vector of length 'points' (for a stack: array (frames, points)), the crop sums
+           (the smallest crop is the first, zeros if it doesn't fit)
+       sizes - vector of length 'points', the number of pixels of the crops
+    """
+    height, width = image.shape[-2:]
+    sat = np.zeros(image.shape[:-2] + (height + 1, width + 1))  # sat[..., y, x] = image[..., :y, :x].sum()
+    np.cumsum(image, axis=-2, dtype=np.float64, out=sat[..., 1:, 1:])
+    np.cumsum(sat[..., 1:, 1:], axis=-1, out=sat[..., 1:, 1:])
+
+    k = np.arange(1, points + 1)
+    k = k[(height - 2 * k * step > 0) & (width - 2 * k * step > 0)]
+    y1 = height - (2 * k - 1) * step  # end of the crop (excluded)
+    x1 = width - (2 * k - 1) * step
+    sums = np.zeros(image.shape[:-2] + (points,))
+    sizes = np.zeros(points)
+    sums[..., points - k] = sat[..., y1, x1] - sat[..., step, x1] - sat[..., y1, step] + sat[..., step, step, None]
+    sizes[points - k] = (y1 - step) * (x1 - step)
+    return sums, sizes
+
+
+def mask_stage(images, settings, auto_crop_ulx=0, auto_crop_uly=0):
+    """Fill the masked pixels of the image(s) in place and return the masked pixels
+    images: auto-cropped float image (height, width) or stack (frames, height, width)
+    The filled values (normalized convolution, see pixel_mask.py) are used for the energy, the maximum,
+    the SOT and the Aeff curve. The masked pixels are excluded from the ROI mean and the fits.
+    return: boolean array of the image shape (True = masked, read only), None if nothing is masked
+    """
+    if settings.mask is None:
+        return None
+    part, operator = settings.mask.analysis_part(settings.mask_offset[0] + auto_crop_ulx,
+                                                 settings.mask_offset[1] + auto_crop_uly, images.shape[-2:])
+    if not part.any():
+        return None
+    fill_masked(images, operator)
+    return part
+
+
+def aeff_curve_basic(image, PixMax=-100, points=20, step=5):
+    """ Returns only the outermost points of the Aeff curve.
+    :param image:
+    :param PixMax: use this maximum, if not given use maximum pixel in remaining image
+    :param points: length of curve
+    :param step: cropping step in pixels
+    :return:
+       AeffS - vector of length 'points' (or less)
+       ImSizeS - vector of length 'points' (or less)
+    """
+    if PixMax == -100:
+        PixMax = image.max()  # Pixel maximal
+
+    sums, ImSizeS = nested_crop_sums(image, points, step)
+    AeffS = sums / PixMax
+    return AeffS, ImSizeS
+
+
+def aeff_fit_offset(sums, sizes, n_points, method="lsq"):
+    """Return the offset that makes the slope of the last n_points of the Aeff curve zero
+    The Aeff of the offset corrected crops is (sums - offset * sizes) / PixMax, linear in the offset,
+    thus the offset is found without iterations (and without the maximum, it only scales the slope).
+    sums, sizes: nested_crop_sums of the image (or of a stack: one offset per frame)
+    method: one of backg_fit_methods
+        "lsq": least squares slope against the point index (as np.polyfit)
+        "weighted": weights 1 / sizes (the noise variance of a crop sum grows with its pixel number)
+        "median": median of the offsets that make the slope between two points zero (robust to one bad point)
+    return: offset (nan if the curve has less than 2 different crops)
+    """
+    sums = sums[..., -n_points:]
+    sizes = sizes[-n_points:]
+    x_bidon = np.arange(len(sizes))  # the slope is taken against the index, like before
+    if method == "median":
+        ii, jj = np.triu_indices(len(sizes), k=1)
+        d_sizes = sizes[jj] - sizes[ii]
+        ok = d_sizes != 0
+        if not np.any(ok):
+            return np.full(sums.shape[:-1], np.nan)[()]
+        return np.median((sums[..., jj] - sums[..., ii])[..., ok] / d_sizes[ok], axis=-1)
+    if method == "lsq":
+        weights = np.ones(len(sizes))
+    elif method == "weighted":
+        weights = 1 / np.maximum(sizes, 1)
+    else:
+        raise ValueError("Unknown background fit method: " + str(method))
+    x_dev = x_bidon - np.average(x_bidon, weights=weights)
+    cov_sizes = np.sum(weights * x_dev * sizes)  # the slope is (cov_sums - offset * cov_sizes) / var_x
+    if cov_sizes == 0:
+        return np.full(sums.shape[:-1], np.nan)[()]
+    return np.sum(weights * x_dev * sums, axis=-1) / cov_sizes
+
+
+def get_backg(image, settings, step, roi_local, excluded=None):
+    """Return the background (offset) of the auto-cropped image
+    roi_local: ROI in the coordinates of image
+    excluded: None or boolean array of the image shape, pixels not used for the ROI mean (mask_stage)
+    """
+    if settings.backg_mode == "roi mean":  # calculate mean of ROI (count roi borders as inside)
+        indices = roi_indices(image.shape, tuple(int(val) for val in roi_local), settings.roi_outside)
+        if excluded is not None:
+            indices = indices[~excluded.ravel()[indices]]
+        return image.ravel()[indices].mean()
+    elif settings.backg_mode == "aeff fit":  # get offset from Aeff-curve fit
+        sums, sizes = nested_crop_sums(image, settings.aeff_points, step)
+        return aeff_fit_offset(sums, sizes, settings.n_points, settings.backg_fit)
+    raise ValueError("Unknown background mode: " + str(settings.backg_mode))
+
+
+def vertical_to_horizontal(mountain, lower_limit):
+    """
+    Returns the indices to use like mountain[idxs] to address the pixels of
+    mountain that are higher than threshold and the ones that are in the same
+    region. vertical_to_horizontal uses erosion and dilation to close holes in the region.
+    Thus hopefully the noise problems close to problems are minimized. Execution takes about
+    10 ms for 400 x 400 pixel images
+    :param mountain: Grayscale image (numpy array)
+    :param lower_limit: A real number
+    :return idxs: Binary array to be used as index for numy array
+    """
+    idxs = mountain > lower_limit
+    idxs = dilation(idxs, disk(2))  # , square(3) is better than standard cross
+    idxs = erosion(idxs, disk(2))  # diamond(2) is not better than standard cross
+    idxs = binary_opening(idxs)
+    return idxs
+
+
+def get_beam_max(image, method):
+    """Return (b_max, fit_pb): b_max array (x, y, value) found with method (one of max_methods)
+    and fit_pb True if the cap fit failed (the 3x3 mean around the max pixel is used instead)
+    """
+    b_max = np.zeros(3)
+    fit_pb = False
+    if 'Cap fit' in method:
+        # Initialize the (round) Gaussian fit with the 3x3 mean around the maximal pixel
+        # The cap_factor will be defined with respect to the 3x3 mean too.
+        (b_max[1], b_max[0]) = np.unravel_index(image.argmax(), image.shape)
+        (bmx, bmy) = b_max[0:2].round().astype("int")  # b_max[0] = x-position
+        b_max[2] = image[bmy - 1: bmy + 2, bmx - 1: bmx + 2].mean()
+        p_ini = [b_max[2]*0.99,  # max_ini = 99% of max pixel
+                 b_max[0]-1.5,  # x_0 = a bit away from the max pixel
+                 b_max[1]-1.5,  # y_0 = a bit away from the max pixel
+                 np.mean(image.shape)/10]  # supposing there are 5 beam diameters on the image
+        cap_factor = int(method[-3:-1]) / 100  # 'Cap fit 95%' -> 0.95
+        upper_zone_idxs = vertical_to_horizontal(image, b_max[2] * cap_factor)
+        p_fit, success = leastsq(
+            gauss2D_cst_offs.resid_2D,
+            p_ini,
+            args=selected_pixels(image, upper_zone_idxs),
+            Dfun=gauss2D_cst_offs.resid_2D_jac, col_deriv=True,  # analytic Jacobian
+            full_output=False)
+
+        if success in [1, 2, 3, 4]:  # If success is equal to 1, 2, 3 or 4, the solution was found.
+            b_max[2] = p_fit[0]
+            b_max[0] = p_fit[1]
+            b_max[1] = p_fit[2]
+        else:
+            fit_pb = True  # and use: 'Max pixel (3x3 mean)'
+            (b_max[1], b_max[0]) = np.unravel_index(image.argmax(), image.shape)
+            (bmx, bmy) = b_max[0:2].round().astype("int")  # b_max[0] = x-position
+            b_max[2] = image[bmy - 1: bmy + 2, bmx - 1: bmx + 2].mean()
+
+    elif method == 'Max pixel':
+        b_max[2] = image.max()
+        (b_max[1], b_max[0]) = np.unravel_index(image.argmax(), image.shape)
+    elif method in ('Max pixel (3x3 mean)', 'Max pixel (5x5 mean)'):
+        hw = 1 if '3x3' in method else 2  # half width of the mean
+        (b_max[1], b_max[0]) = np.unravel_index(image.argmax(), image.shape)
+        (bmx, bmy) = b_max[0:2].round().astype("int")  # b_max[0] = x-position
+        b_max[2] = image[bmy - hw: bmy + hw + 1, bmx - hw: bmx + hw + 1].mean()
+    elif method.startswith('Centroid'):
+        b_max[0], b_max[1] = marginal_centroid(image)
+        (bmx, bmy) = (int(np.round(b_max[0])), int(np.round(b_max[1])))
+        if method == 'Centroid':
+            b_max[2] = image[bmy, bmx]
+        else:
+            hw = 1 if '3x3' in method else 2  # half width of the mean
+            b_max[2] = image[bmy - hw: bmy + hw + 1, bmx - hw: bmx + hw + 1].mean()
+    elif method.startswith('Peak'):
+        b_max = peak_3point(image, "gaussian" if 'Gaussian' in method else "parabolic")
+    else:
+        raise ValueError("Unknown maximum method: " + str(method))
+    return b_max, fit_pb
+
+
+def time_max_methods(image, methods=max_methods, repeat=3):
+    """Return a dict method: mean time in seconds of get_beam_max(image, method)"""
+    timings = {}
+    for method in methods:
+        t1 = time.perf_counter()
+        for _ in range(repeat):
+            get_beam_max(image, method)
+        timings[method] = (time.perf_counter() - t1) / repeat
+    return timings
+
+
+def get_sot_data(image, b_max, sot_threshold=None):
+    """Return (sot_x, sot_y, soft_val): the surface over threshold curve of image normalized by b_max[2]
+    and the SOT for sot_threshold (nan if None)
+    """
+    hi_edges = np.linspace(-0.01, 1.2, num=122)  # makes steps of 1%, needs more than 1 due to smoothing
+    hi_count, _ = np.histogram(image / b_max[2], bins=hi_edges)  # normalized to b_max[2]
+    sot_x = hi_edges[:-1] + 0.005
+    sot_y = hi_count[::-1].cumsum()[::-1]
+    soft_val = np.nan
+    if sot_threshold is not None:  # calculates additionally the sot for a fixed threshold
+        soft_val = (image / b_max[2] > sot_threshold).sum()
+    return sot_x, sot_y, soft_val
+
+
+def fit_selection(image, b_max, backg, lim, settings, excluded=None, budget=0):
+    """Return (selection, coarse), the pixels used by the 2D fits with the lower limit lim (relative to b_max[2])
+    Saturated pixels (sat_limit) and the excluded pixels (mask_stage) are not used.
+    selection: (x, y, values) of the used pixels. If there are more than budget (> 0) used pixels,
+        a stratified sample of about budget of them: one pixel per block of block x block pixels
+        (block = ceil(sqrt(used / budget))).
+    coarse: None if all used pixels are selected, else the multiresolution start (x, y, values) for fit_2d:
+        the means of the blocks of the image (block_reduce) that contain only used pixels, at the block centers
+    Tolerance of the budget (elliptic fit, 180 x 120 px beam, about 50000 used pixels): with a peak signal
+    to noise ratio of 300 the widths and the center stay within 0.1 % of the fit of all pixels down to a
+    budget of 2000, with a ratio of 30 the widths differ by 1 to 4 % (the statistical error of fewer pixels).
+    If the model does not describe the beam (round fit of an elliptic beam) the difference is larger.
+    """
+    used = (image > lim * b_max[2]) & (image < settings.sat_limit - backg)
+    if excluded is not None:
+        used &= ~excluded
+    n_used = np.count_nonzero(used)
+    if not budget or n_used <= budget:
+        return selected_pixels(image, used), None
+    block = int(np.ceil(np.sqrt(n_used / budget)))
+    # the border blocks are padded with False, they are not used
+    x_c, y_c, z_c = selected_pixels(block_reduce(image, (block, block), np.mean),
+                                    block_reduce(used, (block, block), np.min))
+    center = (block - 1) / 2
+    return stratified_pixels(image, used, block), (x_c * block + center, y_c * block + center, z_c)
+
+
+def fit_stats(n_eval, residuals, values, n_paras, valid=None):
+    """Return the statistics of a fit (fit_stat_keys) for its result dict, from the final residuals of the solver
+    n_eval: number of evaluations of the residuals, the goodness of fit is that of fit_quality (no model evaluation)
+    For the arrays (frames, points) of batch_leastsq (n_eval (frames,), valid) a list of dicts, one per frame.
+    """
+    quality = fit_quality(residuals, values, n_paras, valid)
+    if np.ndim(n_eval) == 0:
+        return dict(zip(fit_stat_keys, [int(n_eval)] + [float(val) for val in quality]))
+    return [dict(zip(fit_stat_keys, [int(n_eval[idx])] + [float(val[idx]) for val in quality]))
+            for idx in range(len(n_eval))]
+
+
+def fit_2d(model, p_ini, selection, coarse=None):
+    """Fit the 2D model to the pixels selection (x, y, values) of fit_selection, return (p_fit, success, stats)
+    like leastsq (stats: fit_stats, the goodness of fit of the selection)
+    coarse: None or the block means of fit_selection, fitted first (if there are more of them than parameters)
+        to start the fit of the selection near the result. The block means widen the beam (w**2 grows
+        by about block**2 / 3), the fit of the selection removes this bias.
+    """
+    n_eval = 0
+    if coarse is not None and len(coarse[0]) > len(p_ini):
+        p_coarse, _, info, _, success = leastsq(model.resid_2D, p_ini, args=coarse,
+                                                Dfun=model.resid_2D_jac, col_deriv=True, full_output=True)
+        n_eval = info["nfev"]
+        if success in [1, 2, 3, 4]:
+            p_ini = p_coarse
+    p_fit, _, info, _, success = leastsq(model.resid_2D, p_ini, args=selection,
+                                         Dfun=model.resid_2D_jac, col_deriv=True, full_output=True)
+    return p_fit, success, fit_stats(n_eval + info["nfev"], info["fvec"], selection[2], len(p_ini))
+
+
+def fit_start(fit, col_idx, b_max, guess=None):
+    """Return the initial parameters of the 2D fit col_idx (0: round, 2: elliptic)
+    fit: the initial values (dict like b_fits), guess: log_quadratic_guess of the used pixels or None
+    """
+    if guess is not None:  # closed-form start: amplitude, center, widths and angle
+        p_ini = guess[:3] + ([np.sqrt(guess[3] * guess[4])] if col_idx == 0 else guess[3:])
+    else:
+        p_ini = [fit["max"] * b_max[2],  # because the max is relative
+                 fit["x_0"],
+                 fit["y_0"],
+                 fit["w1"]]
+        if col_idx == 2:
+            p_ini += [fit["w2"], fit["angle"]]
+    if col_idx == 2 and p_ini[3] == p_ini[4]:  # the angle of a round start has a zero derivative
+        p_ini[4] *= 0.95  # break the symmetry
+    return p_ini
+
+
+def fit_sot(fit, sot_x, sot_y, b_max, backg, settings):
+    """Fit sot_r_gau to the SOT curve, return (p_fit, success, stats) like fit_2d"""
+    p_ini = [fit["max"], fit["w1"]]
+    used = (sot_x > fit["lim"]) & (sot_x < (settings.sat_limit - backg) / b_max[2])
+    p_fit, _, info, _, success = leastsq(sot_r_gau.residuals, p_ini, args=(sot_x[used], sot_y[used]),
+                                         Dfun=sot_r_gau.residuals_jac, col_deriv=True, full_output=True)
+    return p_fit, success, fit_stats(info["nfev"], info["fvec"], sot_y[used], len(p_ini))
+
+
+def fit_result(fit, col_idx, p_fit, success, b_max, stats):
+    """Put the fitted parameters p_fit of the model col_idx into the dict fit (modified) with the status
+    stats: fit_stats of the solver (number of evaluations and goodness of fit)
+    """
+    fit.update(stats)
+    if success in [1, 2, 3, 4]:  # If success is equal to 1, 2, 3 or 4, the solution was found.
+        fit["status"] = "OK: {:d}".format(success)
+        if col_idx == 1:
+            fit["max"] = p_fit[0]
+            fit["w1"] = np.abs(p_fit[1])
+        else:
+            fit["max"] = p_fit[0] / b_max[2]
+            fit["x_0"] = p_fit[1]
+            fit["y_0"] = p_fit[2]
+            fit["w1"] = np.abs(p_fit[3])
+        if col_idx == 2:
+            # Reduce the angle to (-90°, 90°] and set w1 as the long half axis.
+            red_angle = p_fit[5] % 180
+            if red_angle > 90:
+                red_angle = -(180 - red_angle)
+            w1 = np.abs(p_fit[3])
+            w2 = np.abs(p_fit[4])
+            if w1 < w2:  # exchange and rotate angle by 90°
+                w1, w2 = w2, w1
+                if red_angle < 0:
+                    red_angle += 90
+                else:
+                    red_angle -= 90
+            fit["w1"] = w1
+            fit["w2"] = w2
+            fit["angle"] = red_angle
+    else:
+        fit["status"] = "Problem: {:d}".format(success)
+    return fit
+
+
+def fit_initial_values(fit_ini, b_max, settings):
+    """Return a copy of the initial values fit_ini, with the center at b_max if settings.fits_at_max"""
+    fit = dict(fit_ini)  # do not modify the initial values
+    if settings.fits_at_max:  # initialize the beam position with b_max data
+        fit["x_0"] = b_max[0]
+        fit["y_0"] = b_max[1]
+    return fit
+
+
+def make_fits(image, b_max, backg, sot_x, sot_y, settings, excluded=None):
+    """Fit the beam models of settings.fits (None: no fit)
+    Return the list of the result dicts (same keys as the initial dicts, "max" relative to b_max[2],
+    and the fit_stats: "n_eval", the number of evaluations of the residuals, and the goodness of fit)
+    Saturated pixels (sat_limit) are not used, thus even saturated pictures may be fitted reasonably well.
+    excluded: None or boolean array of the image shape, pixels not used by the 2D fits (mask_stage)
+    """
+    fits = [None, None, None]
+    selections = {}  # fit_selection for every (lower limit, budget), the same for both 2D models
+    guesses = {}  # the log_quadratic_guess of every selection (None: use the initial values)
+    for col_idx, fit_ini in enumerate(settings.fits):
+        if fit_ini is None:
+            continue
+        fit = fit_initial_values(fit_ini, b_max, settings)
+        if col_idx in [0, 2]:  # round Gaussian: gauss2D_cst_offs, elliptic Gaussian: gaussEll2D_cst_offs
+            key = (fit["lim"], fit.get("budget", 0))
+            if key not in selections:
+                selections[key] = fit_selection(image, b_max, backg, key[0], settings, excluded, key[1])
+                guesses[key] = log_quadratic_guess(*selections[key][0]) if settings.fits_log_init else None
+            p_ini = fit_start(fit, col_idx, b_max, guesses[key])
+            model = gauss2D_cst_offs if col_idx == 0 else gaussEll2D_cst_offs
+            p_fit, success, stats = fit_2d(model, p_ini, *selections[key])
+        else:  # sot_r_gau
+            p_fit, success, stats = fit_sot(fit, sot_x, sot_y, b_max, backg, settings)
+        fits[col_idx] = fit_result(fit, col_idx, p_fit, success, b_max, stats)
+    return fits
+
+
+def make_fits_batch(images, b_max, backg, sot_x, sot_y, settings, excluded=None):
+    """make_fits for all frames of images (frames, height, width) at once
+    The 2D fits of all frames are solved together by batch_leastsq (the used pixels of every frame
+    are padded to the same length), in groups of frames of about fit_batch_bytes. The SOT fits are
+    small, they are made frame by frame.
+    b_max: (frames, 3), backg: (frames,), sot_y: (frames, bins) (only used for the SOT fit)
+    return: list (one per frame) of lists of fit dicts like make_fits
+    """
+    n_frames = len(images)
+    fits = [[None, None, None] for _ in range(n_frames)]
+    padded = {}  # for every (lower limit, budget): the selections and coarse starts of all frames (see pad), guesses
+
+    def pad(selections):
+        """Return the arrays (3, frames, points) of the selections (x, y, values) and valid (frames, points)"""
+        n_used = max(len(sel[0]) for sel in selections)
+        data = np.zeros((3, n_frames, n_used))
+        valid = np.zeros((n_frames, n_used), dtype=bool)
+        for idx, sel in enumerate(selections):
+            data[:, idx, :len(sel[0])] = sel
+            valid[idx, :len(sel[0])] = True
+        return data, valid
+    for col_idx, fit_ini in enumerate(settings.fits):
+        if fit_ini is None:
+            continue
+        if col_idx == 1:
+            for idx in range(n_frames):
+                fit = fit_initial_values(fit_ini, b_max[idx], settings)
+                p_fit, success, stats = fit_sot(fit, sot_x, sot_y[idx], b_max[idx], backg[idx], settings)
+                fits[idx][1] = fit_result(fit, 1, p_fit, success, b_max[idx], stats)
+            continue
+
+        key = (fit_ini["lim"], fit_ini.get("budget", 0))
+        if key not in padded:
+            selections, coarse = zip(*[fit_selection(images[idx], b_max[idx], backg[idx], key[0], settings,
+                                                     excluded, key[1]) for idx in range(n_frames)])
+            empty = (np.zeros(0),) * 3  # the frames without coarse start (not more used pixels than the budget)
+            multires = any(sel is not None for sel in coarse)
+            coarse = pad([empty if sel is None else sel for sel in coarse]) if multires else None
+            guesses = [log_quadratic_guess(*sel) if settings.fits_log_init else None for sel in selections]
+            padded[key] = pad(selections) + (coarse, guesses)
+        data, valid, coarse, guesses = padded[key]
+
+        model = gauss2D_cst_offs if col_idx == 0 else gaussEll2D_cst_offs
+        fit_dicts = [fit_initial_values(fit_ini, b_max[idx], settings) for idx in range(n_frames)]
+        p_ini = np.array([fit_start(fit_dicts[idx], col_idx, b_max[idx], guesses[idx]) for idx in range(n_frames)])
+        group = max(1, fit_batch_bytes // (8 * (p_ini.shape[1] + 4) * max(data.shape[2], 1)))  # frames per solve
+        for start in range(0, n_frames, group):
+            part = slice(start, start + group)
+            n_coarse = 0
+            if coarse is not None:  # multiresolution: start from the fits of the block means (see fit_2d)
+                c_valid = coarse[1][part] & (coarse[1][part].sum(axis=1, keepdims=True) > p_ini.shape[1])
+                p_coarse, c_status, _, c_info = batch_leastsq(model, p_ini[part], *coarse[0][:, part],
+                                                              valid=c_valid)
+                p_ini[part] = np.where(np.isin(c_status, (1, 2, 3))[:, None], p_coarse, p_ini[part])
+                n_coarse = c_info["nfev"]
+            p_fit, status, _, info = batch_leastsq(model, p_ini[part], *data[:, part], valid=valid[part])
+            stats = fit_stats(info["nfev"] + n_coarse, info["fvec"], data[2, part], p_ini.shape[1], valid[part])
+            for idx in range(start, min(start + group, n_frames)):
+                fits[idx][col_idx] = fit_result(fit_dicts[idx], col_idx, p_fit[idx - start], status[idx - start],
+                                                b_max[idx], stats[idx - start])
+    return fits
+
+
+def get_aeffg(image, max_for_aeff, step, settings):
+    """Return (aeffg, slope, Aeff_vec, ImSize_vec) using the last n_points of the Aeff curve"""
+    Aeff_vec, ImSize_vec = aeff_curve_basic(image, PixMax=max_for_aeff, points=settings.aeff_points, step=step)
+    NbPoint = settings.n_points
+    aeffg = Aeff_vec[-NbPoint:].mean()
+    slope = np.polyfit(ImSize_vec[-NbPoint:], Aeff_vec[-NbPoint:], 1)[0]
+    return aeffg, slope, Aeff_vec, ImSize_vec
+
+
+def analyze_frame(frame, dark, settings):
+    """Analyze one frame
+    frame: image (any dtype, it is not modified), already cropped by the user crop
+    dark: dark image of the same shape (subtracted) or None
+    settings: BeamSettings
+    return: FrameResult
+    """
+    res = FrameResult()
+    res.step, res.frame_width = get_step(frame.shape, settings)
+    rows, cols = auto_crop_slices(settings, res.frame_width)
+    res.auto_crop_uly = rows.start or 0
+    res.auto_crop_ulx = cols.start or 0
+    image = frame[rows, cols].astype(np.float64)  # float copy of the cropped frame only
+    if dark is not None:
+        image -= dark[rows, cols]
+    excluded = mask_stage(image, settings, res.auto_crop_ulx, res.auto_crop_uly)
+
+    if settings.roi is None:
+        res.message = "The ROI is not defined"
+    else:
+        roi_local = np.array(settings.roi)
+        roi_local[:2] -= res.auto_crop_ulx  # xfrom, xto, yfrom, yto
+        roi_local[2:] -= res.auto_crop_uly
+        res.backg = get_backg(image, settings, res.step, roi_local, excluded)
+        image -= res.backg
+    res.energy = image.sum()  # energy of the corrected image
+    res.image = image
+
+    t1 = time.perf_counter()
+    res.b_max, res.max_fit_pb = get_beam_max(image, settings.max_method)
+    res.max_time = time.perf_counter() - t1
+    res.saturated = res.backg + image.max() > settings.sat_limit
+    res.sot_x, res.sot_y, res.soft_val = get_sot_data(image, res.b_max, settings.sot_threshold)
+    if settings.moments:
+        res.d4sigma = d4sigma(image)
+    res.fits = make_fits(image, res.b_max, res.backg, res.sot_x, res.sot_y, settings, excluded)
+
+    res.max_for_aeff = res.b_max[2]
+    if settings.aeff_fit_idx is not None and res.fits[settings.aeff_fit_idx] is not None:
+        res.max_for_aeff = res.fits[settings.aeff_fit_idx]["max"] * res.b_max[2]
+    res.aeffg, res.slope, res.aeff_vec, res.imsize_vec = get_aeffg(image, res.max_for_aeff, res.step, settings)
+    return res
+
+
+def stack_vectorizable(settings):
+    """True if analyze_frames can be used: no cap fit (it needs one leastsq per frame)"""
+    return 'Cap fit' not in settings.max_method
+
+
+def get_beam_max_stack(images, method):
+    """get_beam_max for all images of images (frames, height, width) at once (not for the cap fits)
+    return: array (frames, 3) with (x, y, value) of the maximum of every frame
+    """
+    n_frames, height, width = images.shape
+    b_max = np.zeros((n_frames, 3))
+    if method.startswith('Peak'):
+        return peak_3point(images, "gaussian" if 'Gaussian' in method else "parabolic")
+    elif method.startswith('Centroid'):
+        b_max[:, 0], b_max[:, 1] = marginal_centroid(images)
+    elif method.startswith('Max pixel'):
+        b_max[:, 1], b_max[:, 0] = np.unravel_index(images.reshape(n_frames, -1).argmax(axis=1), (height, width))
+    else:
+        raise ValueError("No vectorized version of the maximum method: " + str(method))
+    (bx, by) = (np.round(b_max[:, 0]).astype(int), np.round(b_max[:, 1]).astype(int))
+    if method == 'Max pixel':
+        b_max[:, 2] = images.reshape(n_frames, -1).max(axis=1)
+    else:
+        hw = 1 if '3x3' in method else 2 if '5x5' in method else 0  # half width of the mean
+        b_max[:, 2] = window_mean(images, bx, by, hw)
+    return b_max
+
+
+def get_sot_curves(images, max_values, sot_threshold=None, curves=True):
+    """get_sot_data for all images of images (frames, height, width) at once
+    max_values: the maximum of every frame (b_max[:, 2])
+    curves: if False only soft_val is calculated (the histograms are the slowest part)
+    return: sot_x, sot_y (array (frames, bins) or None), soft_val (one value per frame, nan if sot_threshold is None)
+    """
+    n_frames = len(images)
+    hi_edges = np.linspace(-0.01, 1.2, num=122)  # same bins as get_sot_data
+    n_bins = len(hi_edges) - 1
+    sot_x = hi_edges[:-1] + 0.005
+    sot_y = np.zeros((n_frames, n_bins), dtype=np.int64) if curves else np.full(n_frames, None)
+    soft_val = np.full(n_frames, np.nan)
+    for idx in range(n_frames if curves else 0):  # np.histogram has a fast path for uniform bins, faster than one bincount
+        hi_count, _ = np.histogram(images[idx] / max_values[idx], bins=hi_edges)
+        sot_y[idx] = hi_count[::-1].cumsum()[::-1]
+    if sot_threshold is not None:
+        soft_val = (images / max_values[:, None, None] > sot_threshold).sum(axis=(1, 2))
+    return sot_x, sot_y, soft_val
+
+
+def analyze_frames(frames, dark, settings, sot_curves=True):
+    """Analyze all frames of an array (frames, height, width) at once, with the same
+    results as analyze_frame for every frame. Only for stack_vectorizable(settings).
+    All quantities are reductions over the frames: the background (ROI mean or aeff fit),
+    energy, maximum, SOT curve and Aeff curve (from one summed-area table per frame).
+    The beam fits of all frames are solved together (make_fits_batch).
+    sot_curves: if False the SOT curves are not calculated (sot_y is None), only the SOT for the threshold
+        (they are always calculated for the SOT fit)
+    return: list of FrameResult (their images are views on one array)
+    """
+    if not stack_vectorizable(settings):
+        raise ValueError("The cap fits need analyze_frame")
+    n_frames = len(frames)
+    step, frame_width = get_step(frames.shape[1:], settings)
+    rows, cols = auto_crop_slices(settings, frame_width)
+    images = frames[:, rows, cols].astype(np.float64)  # float copy of the cropped frames only
+    if dark is not None:
+        images -= dark[rows, cols]
+    (auto_crop_uly, auto_crop_ulx) = (rows.start or 0, cols.start or 0)
+    excluded = mask_stage(images, settings, auto_crop_ulx, auto_crop_uly)
+
+    sums, sizes = nested_crop_sums(images, settings.aeff_points, step)  # before the background correction
+    total = images.sum(axis=(1, 2))
+    backg = np.zeros(n_frames)
+    message = ""
+    if settings.roi is None:
+        message = "The ROI is not defined"
+    elif settings.backg_mode == "roi mean":
+        roi_local = np.array(settings.roi)
+        roi_local[:2] -= auto_crop_ulx  # xfrom, xto, yfrom, yto
+        roi_local[2:] -= auto_crop_uly
+        if excluded is not None:  # mean of the pixels of the ROI that are not masked
+            used = roi_mask(images.shape[1:], tuple(int(val) for val in roi_local), settings.roi_outside) & ~excluded
+            backg = images.reshape(n_frames, -1)[:, np.flatnonzero(used)].mean(axis=1)
+        else:  # count roi borders as inside
+            inner = images[:, roi_local[2]:roi_local[3] + 1, roi_local[0]:roi_local[1] + 1]
+            inner_sum = inner.sum(axis=(1, 2))
+            if settings.roi_outside:
+                backg = (total - inner_sum) / (images[0].size - inner[0].size)
+            else:
+                backg = inner_sum / inner[0].size
+    elif settings.backg_mode == "aeff fit":
+        backg = aeff_fit_offset(sums, sizes, settings.n_points, settings.backg_fit)
+    else:
+        raise ValueError("Unknown background mode: " + str(settings.backg_mode))
+    images -= backg[:, None, None]
+    energy = total - backg * images[0].size
+    sums -= backg[:, None] * sizes
+
+    t1 = time.perf_counter()
+    b_max = get_beam_max_stack(images, settings.max_method)
+    max_time = (time.perf_counter() - t1) / n_frames
+    saturated = backg + images.reshape(n_frames, -1).max(axis=1) > settings.sat_limit
+    sot_x, sot_y, soft_val = get_sot_curves(images, b_max[:, 2], settings.sot_threshold,
+                                            sot_curves or settings.fits[1] is not None)
+    moments = d4sigma(images) if settings.moments else np.full(n_frames, None)
+    fits = [[None, None, None]] * n_frames
+    max_for_aeff = b_max[:, 2].copy()
+    if any(fit is not None for fit in settings.fits):
+        fits = make_fits_batch(images, b_max, backg, sot_x, sot_y, settings, excluded)
+        if settings.aeff_fit_idx is not None and settings.fits[settings.aeff_fit_idx] is not None:
+            max_for_aeff *= np.array([frame_fits[settings.aeff_fit_idx]["max"] for frame_fits in fits])
+    aeff = sums / max_for_aeff[:, None]
+    NbPoint = settings.n_points
+    aeffg = aeff[:, -NbPoint:].mean(axis=1)
+    slope = np.polyfit(sizes[-NbPoint:], aeff[:, -NbPoint:].T, 1)[0]
+
+    return [FrameResult(image=images[idx], auto_crop_ulx=auto_crop_ulx, auto_crop_uly=auto_crop_uly,
+                        step=step, frame_width=frame_width, backg=backg[idx], energy=energy[idx],
+                        b_max=b_max[idx], max_time=max_time, saturated=bool(saturated[idx]),
+                        sot_x=sot_x, sot_y=sot_y[idx],
+                        soft_val=soft_val[idx], d4sigma=moments[idx], fits=list(fits[idx]),
+                        aeff_vec=aeff[idx], imsize_vec=sizes,
+                        max_for_aeff=max_for_aeff[idx], aeffg=aeffg[idx], slope=slope[idx], message=message)
+            for idx in range(n_frames)]
+
+
+class WarmStart:
+    """Initial values of the fits of the frames of analyze_stack, predicted from the converged fits
+    mode: one of warm_start_modes
+        "table": no prediction, the initial values of the settings (or the log-quadratic guess)
+        "previous frame": the last converged fit (of the previous stack for the first frame of a z-scan stack)
+        "stack median": the median of the converged fits of the stack so far (one bad frame does not matter)
+        "z neighbours": like "stack median", but the first frames of a stack start from the medians of the
+            stacks at the nearest z positions, extrapolated to z: w1² and w2² by a parabola (the caustic
+            w² = w0² (1 + ((z - z0) / zR)²)), max, x_0 and y_0 linearly, the angle of the nearest stack.
+    A prediction replaces the values of settings.fits (the table), the log-quadratic guess of the 2D
+    fits (fits_log_init) is still used if it is on (it is the better start of a single frame).
+    The fits without prediction (the first frames) use the settings. Without cap fit the frames of a
+    chunk are fitted together (make_fits_batch), they all start from the prediction of the previous chunks.
+    For a z-scan use one WarmStart for all stacks and call next_stack(z) before every stack.
+    """
+
+    def __init__(self, mode="previous frame"):
+        if mode not in warm_start_modes:
+            raise ValueError("Unknown warm start mode: " + str(mode))
+        self.mode = mode
+        self.z = None
+        self.stack_fits = []  # the fit lists of the frames of the present stack
+        self.last_fits = [None, None, None]  # the last converged fit of every model
+        self.z_fits = []  # (z, medians) of the finished stacks
+
+    def next_stack(self, z=None):
+        """Start a new stack at the position z (used by "z neighbours")"""
+        if self.z is not None and self.stack_fits:
+            self.z_fits.append((self.z, [self.median(col_idx) for col_idx in range(len(fit_names))]))
+        self.z = z
+        self.stack_fits = []
+
+    def update(self, results):
+        """Add the fits of the FrameResult list results (in the order of the frames)"""
+        for res in results:
+            self.stack_fits.append(res.fits)
+            for col_idx, fit in enumerate(res.fits):
+                if fit is not None and fit["status"].startswith("OK"):
+                    self.last_fits[col_idx] = fit
+
+    def median(self, col_idx):
+        """Return the dict of the median values of the converged fits col_idx of the stack, None if there is none"""
+        converged = [fits[col_idx] for fits in self.stack_fits
+                     if fits[col_idx] is not None and fits[col_idx]["status"].startswith("OK")]
+        if not converged:
+            return None
+        return {key: float(np.median([fit[key] for fit in converged]))
+                for key in fit_value_keys if key in converged[0]}
+
+    def along_z(self, col_idx):
+        """Return the values of the fit col_idx extrapolated from the nearest z positions, None if there is none"""
+        if self.z is None:
+            return None
+        known = sorted(((z, medians[col_idx]) for z, medians in self.z_fits if medians[col_idx] is not None),
+                       key=lambda item: abs(item[0] - self.z))[:3]
+        if not known:
+            return None
+        z_vals = np.array([z for z, _ in known])
+        values = dict(known[0][1])
+        for key in values:
+            if key == "angle":
+                continue
+            squared = key in ("w1", "w2")  # along the caustic
+            used = len(known) if squared else 2
+            deg = min(used, len(np.unique(z_vals[:used]))) - 1
+            if deg < 1:
+                continue
+            vals = np.array([medians[key] for _, medians in known[:used]])
+            pred = np.polyval(np.polyfit(z_vals[:used], vals ** 2 if squared else vals, deg), self.z)
+            if squared:
+                if pred > 0:
+                    values[key] = float(np.sqrt(pred))
+            else:
+                values[key] = float(pred)
+        return values
+
+    def predict(self, settings):
+        """Return settings with the predicted initial values of the fits (a fit without prediction keeps the
+        values of settings)"""
+        if self.mode == "table":
+            return settings
+        fits = list(settings.fits)
+        for col_idx, fit_ini in enumerate(settings.fits):
+            if fit_ini is None:
+                continue
+            if self.mode == "previous frame":
+                last = self.last_fits[col_idx]
+                values = None if last is None else {key: last[key] for key in fit_value_keys if key in last}
+            else:
+                values = self.median(col_idx)
+                if values is None and self.mode == "z neighbours":
+                    values = self.along_z(col_idx)
+            if values is None:
+                continue
+            fits[col_idx] = dict(fit_ini, **values)
+        return replace(settings, fits=fits)
+
+
+def analyze_stack(stack, indices, dark, settings, progress=None, keep_images=False, sot_curves=False,
+                  warm_start=None):
+    """Analyze the frames indices of stack (an ImageStack) with the same settings
+    Without cap fit (stack_vectorizable), chunks of frames are analyzed at once by analyze_frames,
+    the beam fits of a chunk are solved together from the same initial values (make_fits_batch).
+    With the cap fit, every frame is analyzed by analyze_frame.
+    warm_start: WarmStart, predicts the initial values of the fits of every frame (chunk) and is
+        updated with the results. None: like scrolling through the stack in the GUI, the cap fit
+        analysis starts every frame from the fits of the previous one ("previous frame"), the chunks
+        start from the settings ("table").
+    dark: dark image or None (see analyze_frame)
+    progress: None or function progress(done, total), called after every frame (or chunk)
+    keep_images: keep the corrected images in the results (memory!), if not only the last one is kept
+    sot_curves: calculate the SOT curves without SOT fit too (they are not part of the stack results)
+    return: list of FrameResult (one per index)
+    """
+    results = []
+    if warm_start is None:
+        warm_start = WarmStart("table" if stack_vectorizable(settings) else "previous frame")
+    if stack_vectorizable(settings):
+        chunk = max(1, stack_chunk_bytes // (8 * int(np.prod(stack.frame_shape))))  # frames per chunk
+        for start in range(0, len(indices), chunk):
+            chunk_idxs = indices[start:start + chunk]
+            frames = np.stack([stack.frame(im_idx) for im_idx in chunk_idxs])
+            stack.prefetch(chunk_idxs[-1])  # lazy stacks: read the next frames in the background
+            chunk_results = analyze_frames(frames, dark, warm_start.predict(settings), sot_curves)
+            warm_start.update(chunk_results)
+            if not keep_images:
+                if results:
+                    results[-1].image = None
+                for res in chunk_results[:-1]:
+                    res.image = None
+                chunk_results[-1].image = chunk_results[-1].image.copy()  # do not keep the whole chunk
+            results += chunk_results
+            if progress is not None:
+                progress(len(results), len(indices))
+        return results
+
+    for done, im_idx in enumerate(indices, start=1):
+        res = analyze_frame(stack.frame(im_idx), dark, warm_start.predict(settings))
+        stack.prefetch(im_idx)  # lazy stacks: read the next frames in the background
+        warm_start.update([res])
+        if results and not keep_images:
+            results[-1].image = None
+        results.append(res)
+        if progress is not None:
+            progress(done, len(indices))
+    return results
+
+
+if __name__ == "__main__":
+    # Analyze a synthetic round Gaussian beam (w = 20 px, offset 100 GL) without GUI
+    from time import time as tic
+
+    rng = np.random.default_rng()
+    XX, YY = np.meshgrid(range(400), range(400))
+    frame = gauss2D_cst_offs.f(XX, YY, [3000, 201.3, 198.7, 20], offset=100)
+    frame = np.round(frame + rng.normal(0, 5, frame.shape)).astype(np.uint16)
+    ini = {"name": fit_names[0], "lim": 0.5, "status": "not launched", "GOF": np.nan,
+           "w1": 30, "max": 1, "x_0": 190, "y_0": 190}
+    for mode in backg_modes:
+        settings = BeamSettings(roi=(150, 250, 150, 250), backg_mode=mode, max_method='Max pixel (3x3 mean)',
+                                sat_limit=0.95 * 65535, fits=[ini, None, None])
+        t1 = tic()
+        res = analyze_frame(frame, None, settings)
+        print("{}: backg {:.2f}, Aeff {:.1f} (theory {:.1f}), w1 fit {:.2f}, took {:.3f} s".format(
+            mode, res.backg, res.aeffg, np.pi * 20**2 / 2 * 3000 / res.b_max[2], res.fits[0]["w1"], tic() - t1))
+    for method, used_time in time_max_methods(res.image).items():
+        print("{:25s} {:8.3f} ms".format(method, used_time * 1e3))
@@ -0,0 +1,191 @@
+"""
+Estimators of the beam position and maximum without full-frame coordinate arrays
+
+The functions take one image (height, width) or a stack of images (frames, height, width):
+marginal_centroid: centroid from the column and row sums (two 1D dot products
+    instead of two meshgrids multiplied with the image)
+peak_3point: sub-pixel maximum from the max pixel and its neighbours in x and in y,
+    "parabolic" (parabola through the 3 values) or "gaussian" (parabola through
+    their logarithms, exact for a Gaussian beam without noise)
+window_mean: mean of a (2*hw + 1)^2 window around a pixel
+
+Geometry shared by the frames of a stack (cached per frame shape, read only):
+coordinate_grid: the meshgrid of a frame shape, for the models shown on the whole image
+roi_mask, roi_indices: the pixels inside or outside a ROI (the background of "Use mean from ROI")
+selected_pixels: compact (x, y, value) arrays of the pixels of a mask, for the fits
+    (the coordinates come from the flat indices, no grid is needed)
+stratified_pixels: the same for one random pixel of the mask per block (fits on a pixel budget)
+"""
+from functools import lru_cache
+
+import numpy as np
+
+peak_kinds = ("parabolic", "gaussian")
+
+
+@lru_cache(maxsize=8)
+def coordinate_grid(shape):
+    """Return XX, YY = np.meshgrid(range(width), range(height)) for shape (height, width)
+    The arrays are cached per shape and read only (do not modify them).
+    """
+    XX, YY = np.meshgrid(range(shape[1]), range(shape[0]))
+    XX.setflags(write=False)
+    YY.setflags(write=False)
+    return XX, YY
+
+
+@lru_cache(maxsize=32)
+def roi_mask(shape, roi, outside=False):
+    """Return the boolean mask of shape (height, width) that is True inside roi (or outside if outside)
+    roi: tuple of int (xfrom, xto, yfrom, yto), the borders are inside
+    The mask is cached and read only.
+    """
+    mask = np.zeros(shape, dtype=bool)
+    mask[roi[2]:roi[3] + 1, roi[0]:roi[1] + 1] = True
+    if outside:
+        mask = ~mask
+    mask.setflags(write=False)
+    return mask
+
+
+@lru_cache(maxsize=32)
+def roi_indices(shape, roi, outside=False):
+    """Return the flat indices of roi_mask(shape, roi, outside) (cached and read only)"""
+    indices = np.flatnonzero(roi_mask(shape, roi, outside))
+    indices.setflags(write=False)
+    return indices
+
+
+def selected_pixels(image, mask):
+    """Return (x, y, values) of the pixels of image where mask is True, as 1D arrays"""
+    indices = np.flatnonzero(mask)
+    y_sel, x_sel = np.divmod(indices, image.shape[1])
+    return x_sel, y_sel, image.ravel()[indices]
+
+
+def stratified_pixels(image, mask, block, seed=0):
+    """Return (x, y, values) of one pixel of image where mask is True in every block x block square
+    The squares are the strata of the sample: the chosen pixels are spread like the mask (not only the
+    brightest ones), about count_nonzero(mask) / block**2 pixels. The choice is reproducible (seed).
+    """
+    indices = np.flatnonzero(mask)
+    y_sel, x_sel = np.divmod(indices, image.shape[1])
+    strata = (y_sel // block) * (image.shape[1] // block + 1) + x_sel // block
+    order = np.random.default_rng(seed).permutation(indices.size)
+    _, first = np.unique(strata[order], return_index=True)  # the first pixel of every stratum in random order
+    chosen = np.sort(order[first])
+    return x_sel[chosen], y_sel[chosen], image.ravel()[indices[chosen]]
+
+
+def _as_stack(images):
+    """Return (images as (frames, height, width), True if images was a single image)"""
+    if images.ndim == 2:
+        return images[None], True
+    return images, False
+
+
+def marginal_centroid(images):
+    """Return the centroid (x, y) of the image(s) (one value or one value per frame)"""
+    stack, single = _as_stack(images)
+    total = stack.sum(axis=(1, 2))
+    x_c = stack.sum(axis=1) @ np.arange(stack.shape[2]) / total  # column sums
+    y_c = stack.sum(axis=2) @ np.arange(stack.shape[1]) / total  # row sums
+    if single:
+        return x_c[0], y_c[0]
+    return x_c, y_c
+
+
+def window_mean(images, bx, by, hw):
+    """Return the mean of image[by-hw:by+hw+1, bx-hw:bx+hw+1] of the image(s)
+    bx, by: integer pixel positions (one per frame for a stack)
+    Windows cut by the border use the same slices (thus the same values) as numpy slicing.
+    """
+    stack, single = _as_stack(images)
+    bx = np.atleast_1d(bx)
+    by = np.atleast_1d(by)
+    n_frames, height, width = stack.shape
+    d = np.arange(-hw, hw + 1)
+    rows = np.clip(by[:, None, None] + d[None, :, None], 0, height - 1)
+    cols = np.clip(bx[:, None, None] + d[None, None, :], 0, width - 1)
+    means = stack[np.arange(n_frames)[:, None, None], rows, cols].mean(axis=(1, 2))
+    border = (by - hw < 0) | (by + hw >= height) | (bx - hw < 0) | (bx + hw >= width)
+    for idx in np.flatnonzero(border):
+        means[idx] = stack[idx, by[idx] - hw: by[idx] + hw + 1, bx[idx] - hw: bx[idx] + hw + 1].mean()
+    if single:
+        return means[0]
+    return means
+
+
+def _vertex(minus, center, plus):
+    """Position (in pixels from center) and value correction of the parabola through 3 points"""
+    den = minus - 2 * center + plus
+    ok = den < 0  # a maximum
+    pos = np.where(ok, 0.5 * (minus - plus) / np.where(ok, den, -1), 0)
+    pos = np.clip(pos, -0.5, 0.5)  # stay in the max pixel
+    return pos, 0.25 * (plus - minus) * pos
+
+
+def peak_3point(images, kind="parabolic"):
+    """Return the sub-pixel maximum of the image(s) as array (x, y, value) (one line per frame for a stack)
+    kind: one of peak_kinds. "gaussian" uses the logarithms of the 3 values, it falls back
+        to "parabolic" if one of them is not positive (noise at a small beam).
+    On the border of the image the position of the max pixel is kept for that axis.
+    """
+    stack, single = _as_stack(images)
+    n_frames, height, width = stack.shape
+    frame_idx = np.arange(n_frames)
+    by, bx = np.unravel_index(stack.reshape(n_frames, -1).argmax(axis=1), (height, width))
+    center = stack[frame_idx, by, bx].astype(np.float64)
+    left = stack[frame_idx, by, np.maximum(bx - 1, 0)]
+    right = stack[frame_idx, by, np.minimum(bx + 1, width - 1)]
+    up = stack[frame_idx, np.maximum(by - 1, 0), bx]
+    down = stack[frame_idx, np.minimum(by + 1, height - 1), bx]
+    inner_x = (bx > 0) & (bx < width - 1)
+    inner_y = (by > 0) & (by < height - 1)
+
+    b_max = np.zeros((n_frames, 3))
+    dx, corr_x = _vertex(left, center, right)
+    dy, corr_y = _vertex(up, center, down)
+    value = center + np.where(inner_x, corr_x, 0) + np.where(inner_y, corr_y, 0)
+    if kind == "gaussian":
+        positive = (np.minimum(np.minimum(left, right), np.minimum(up, down)) > 0) & (center > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_c = np.log(center)
+            gdx, gcorr_x = _vertex(np.log(left), log_c, np.log(right))
+            gdy, gcorr_y = _vertex(np.log(up), log_c, np.log(down))
+            g_value = np.exp(log_c + np.where(inner_x, gcorr_x, 0) + np.where(inner_y, gcorr_y, 0))
+        dx = np.where(positive, gdx, dx)
+        dy = np.where(positive, gdy, dy)
+        value = np.where(positive, g_value, value)
+    elif kind != "parabolic":
+        raise ValueError("Unknown peak kind: " + str(kind))
+    b_max[:, 0] = bx + np.where(inner_x, dx, 0)
+    b_max[:, 1] = by + np.where(inner_y, dy, 0)
+    b_max[:, 2] = value
+    if single:
+        return b_max[0]
+    return b_max
+
+
+if __name__ == "__main__":
+    # Compare the estimators with the meshgrid centroid on a Gaussian beam between the pixels
+    from time import time as tic
+
+    XX, YY = coordinate_grid((600, 800))
+    image = 3000 * np.exp(-2 * ((XX - 401.3) ** 2 + (YY - 297.8) ** 2) / 25 ** 2)
+    n_rep = 20
+
+    t1 = tic()
+    for _ in range(n_rep):
+        XXm, YYm = np.meshgrid(range(image.shape[1]), range(image.shape[0]))
+        c_mesh = ((XXm * image).sum() / image.sum(), (YYm * image).sum() / image.sum())
+    print("meshgrid centroid  {}: {:.3f} ms".format(np.round(c_mesh, 3), (tic() - t1) / n_rep * 1e3))
+    t1 = tic()
+    for _ in range(n_rep):
+        c_marg = marginal_centroid(image)
+    print("marginal centroid  {}: {:.3f} ms".format(np.round(c_marg, 3), (tic() - t1) / n_rep * 1e3))
+    for kind in peak_kinds:
+        t1 = tic()
+        for _ in range(n_rep):
+            peak = peak_3point(image, kind)
+        print("{:9s} 3-point {}: {:.3f} ms".format(kind, np.round(peak, 3), (tic() - t1) / n_rep * 1e3))
@@ -61,27 +61,52 @@ def goodness_of_fit(mes_x, mes_y, model, parameters):
     if not isinstance(mes_y, np.ndarray):
         mes_y = np.array(mes_y)
 
-    # rsquared
-    ss_res = model.chi2(parameters, mes_x, mes_y)  # I used : chi² = sum of squared residuals
-    ss_tot = ((mes_y - mes_y.mean()) ** 2).sum()
-    r_squ = 1 - (ss_res / ss_tot)
-
-    # rsquared corrected for different degrees of freedom (absolute value but insensitive)
+    # the model is evaluated once, all values come from the residuals (see fit_quality)
     num_mes = len(mes_x)
     num_par = len(parameters)
+    r_squ, AICc, BIC, _ = fit_quality(model.residuals(parameters, mes_x, mes_y), mes_y, num_par)
+
+    # rsquared corrected for different degrees of freedom (absolute value but insensitive)
     r_squ_c = 1 - (num_mes - 1) / (num_mes - num_par) * (1 - r_squ)
 
-    # Akaike Information Criterion: AIC (good for model comparisons, relative value)
-    log_likelyhood = -num_mes / 2 * (np.log(2 * np.pi * ss_res / num_mes) + 1)
-    AIC = 2 * (num_par + model.negated_log_likelihood(parameters, mes_x, mes_y))
+    # AIC without the correction for different degrees of freedom
+    AIC = AICc - (2 * num_par * (num_par + 1)) / (num_mes - num_par - 1)
 
-    # AIC corrected for different degrees of freedom
-    AICc = AIC + (2 * num_par * (num_par + 1)) / (num_mes - num_par - 1)
+    return AICc, r_squ_c, BIC, r_squ, AIC
 
-    # Bayesian Information Criterion: BIC (higher penalty on nb of params)
-    BIC = num_par * np.log(num_mes) + 2 * model.negated_log_likelihood(parameters, mes_x, mes_y)
 
-    return AICc, r_squ_c, BIC, r_squ, AIC
+def fit_quality(residuals, mes_y, num_par, valid=None):
+    """Goodness of fit from the final residuals of a fit (e.g. infodict["fvec"] of leastsq or of
+    batch_leastsq), without evaluating the model again. Normal statistics as in goodness_of_fit.
+    residuals, mes_y: arrays (..., points), the residuals and the measured values
+    num_par: number of fitted parameters
+    valid: None (all points) or boolean array of the same shape, the points used (padded data)
+    return: r_squ, AICc, BIC, red_chi2 (one value per fit, the last axis is reduced)
+        red_chi2 is the sum of squared residuals per degree of freedom (the data have no uncertainties,
+        it is the variance of the residuals). nan if there are not more points than num_par + 1.
+    """
+    residuals = np.asarray(residuals, dtype=float)
+    mes_y = np.asarray(mes_y, dtype=float)
+    if valid is None:
+        valid = np.ones(residuals.shape, dtype=bool)
+    num_mes = valid.sum(axis=-1)
+    ss_res = np.where(valid, residuals ** 2, 0).sum(axis=-1)  # I used : chi² = sum of squared residuals
+    mean_y = np.where(valid, mes_y, 0).sum(axis=-1) / np.maximum(num_mes, 1)
+    ss_tot = np.where(valid, (mes_y - np.expand_dims(mean_y, -1)) ** 2, 0).sum(axis=-1)
+    dof = np.where(num_mes > num_par + 1, num_mes - num_par, np.nan)  # degrees of freedom
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_squ = 1 - ss_res / ss_tot
+        # Akaike Information Criterion: AIC (good for model comparisons, relative value)
+        negated_log_likelihood = num_mes / 2 * (np.log(2 * np.pi * ss_res / num_mes) + 1)
+        AIC = 2 * (num_par + negated_log_likelihood)
+        # AIC corrected for different degrees of freedom
+        AICc = AIC + (2 * num_par * (num_par + 1)) / (dof - 1)
+        # Bayesian Information Criterion: BIC (higher penalty on nb of params)
+        BIC = num_par * np.log(num_mes) + 2 * negated_log_likelihood
+        red_chi2 = ss_res / dof
+    too_few = np.isnan(dof)
+    # [()]: scalars (not 0-d arrays) for the residuals of one fit
+    return np.where(too_few, np.nan, r_squ)[()], AICc, np.where(too_few, np.nan, BIC)[()], red_chi2
 
 
 """Demonstration functions that compare fits with different models:
@@ -606,6 +631,12 @@ class FitModel:
         print("Guess of initial parameters not implemented")
         return
 
+    def f_jac(self, x_values, paras):
+        """Derivatives of f with respect to paras, array of shape (len(paras),) + x_values.shape
+        (2D models: f_jac(x_values, y_values, paras, ...) like f)"""
+        print("No analytic Jacobian defined")
+        return
+
     def f_sep(self, x_values, *paras):  # uses many separate parameters
         """Helper function for fits with optimize.curve_fit"""
         return self.f(x_values, np.array(paras))
@@ -623,6 +654,16 @@ class FitModel:
         # If not all params in model shall be fitted define a new version of residuals
         return diff.ravel()  # leastsq expects 1D data from any model
 
+    def residuals_jac(self, p, x, y):
+        """Jacobian of residuals for optimize.leastsq without finite differences:
+        scipy.optimize.leastsq(model.residuals, paras0, args=(x, y), Dfun=model.residuals_jac, col_deriv=True)
+        """
+        return self.f_jac(x, p).reshape(len(p), -1)
+
+    def resid_2D_jac(self, p, x, y, z, **kwargs):
+        """Jacobian of resid_2D, use with optimize.leastsq(..., Dfun=model.resid_2D_jac, col_deriv=True)"""
+        return self.f_jac(x, y, p, **kwargs).reshape(len(p), -1)
+
     def chi2(self, p, x, y):
         """chi2(self, p, x, y) = residuals(p, x, y)**2).sum()
         where residuals(p, x, y) = f(x, p) - y_data"""
@@ -697,6 +738,19 @@ class SOT_round_gau(FitModel):
         y_values[x_values < peak_flu] = np.pi * w**2 / 2 * np.log(peak_flu / x_values[x_values < peak_flu])
         return y_values
 
+    def f_jac(self, x_values, paras):
+        """Derivatives of f with respect to peak_flu and w (zero where x_values >= peak_flu)"""
+        if not isinstance(x_values, np.ndarray):
+            x_values = np.array(x_values)
+
+        peak_flu = paras[0]
+        w = paras[1]
+        below = x_values < peak_flu
+        jac = np.zeros((2,) + x_values.shape)
+        jac[0][below] = np.pi * w**2 / (2 * peak_flu)
+        jac[1][below] = np.pi * w * np.log(peak_flu / x_values[below])
+        return jac
+
     def guess(self, x_values, y_values):
         """ maybe later a real function:
         Guess the flu_max from where the increase starts. highest index with y > average of highest 5 vals +
@@ -787,6 +841,55 @@ class Gauss1D(FitModel):
 gauss1D = Gauss1D()
 
 
+def log_quadratic_guess(x_values, y_values, z_values):
+    """Closed-form initial parameters of an elliptic Gaussian bump without offset (GaussEll2D_cst_offs)
+    log(z) = c0 + c1*x + c2*y + c3*x**2 + c4*x*y + c5*y**2 is fitted to the positive z_values by one
+    linear least squares solve, weighted with z**2 (the noise of log(z) is about noise / z).
+    return [vert_factor, cent_x, cent_y, waist_rad_a, waist_rad_b, theta] (waist_rad_a >= waist_rad_b,
+        theta in degrees in (-90, 90]), None if the data is not a bump (the quadratic form is not negative)
+    """
+    x_values, y_values, z_values = (np.ravel(values) for values in (x_values, y_values, z_values))
+    positive = z_values > 0
+    x_values, y_values, z_values = x_values[positive], y_values[positive], z_values[positive]
+    if z_values.size < 6:
+        return None
+    x_m, y_m = x_values.mean(), y_values.mean()
+    scale = max(x_values.std(), y_values.std(), 1.0)  # centered and scaled positions for the conditioning
+    u = (x_values - x_m) / scale
+    v = (y_values - y_m) / scale
+    design = np.stack([np.ones_like(u), u, v, u ** 2, u * v, v ** 2], axis=1)
+    weighted = design * (z_values ** 2)[:, None]
+    try:
+        c = np.linalg.solve(weighted.T @ design, weighted.T @ np.log(z_values))
+    except np.linalg.LinAlgError:
+        return None
+    quad = np.array([[c[3], c[4] / 2], [c[4] / 2, c[5]]])
+    eig_vals, eig_vecs = np.linalg.eigh(-quad)  # ascending: the long axis a first
+    if eig_vals[0] <= 0:
+        return None
+    cent = -0.5 * np.linalg.solve(quad, c[1:3])
+    vert_factor = np.exp(c[0] + 0.5 * c[1:3] @ cent)
+    waist_rad_a, waist_rad_b = scale * np.sqrt(2 / eig_vals)  # exp(-2 d**2 / w**2)
+    theta = np.arctan2(-eig_vecs[1, 0], eig_vecs[0, 0]) * 180 / np.pi  # axis a is (cos(theta), -sin(theta))
+    if theta > 90:
+        theta -= 180
+    elif theta <= -90:
+        theta += 180
+    return [vert_factor, x_m + scale * cent[0], y_m + scale * cent[1], waist_rad_a, waist_rad_b, theta]
+
+
+def round_gaussian_jac(x_values, y_values, paras):
+    """Derivatives of the round 2D Gaussian (Gauss2D) with respect to
+    [vert_factor, x_shift, y_shift, waist_radius], array of shape (4,) + shape of the positions
+    """
+    vert_factor, x_shift, y_shift, waist_radius = paras[:4]
+    d_x = np.asarray(x_values) - x_shift
+    d_y = np.asarray(y_values) - y_shift
+    gau = np.exp(-2 * (d_x ** 2 + d_y ** 2) / waist_radius ** 2)
+    fac = 4 * vert_factor * gau / waist_radius ** 2  # derivative of the exponent times vert_factor * gau
+    return np.array([gau, fac * d_x, fac * d_y, fac * (d_x ** 2 + d_y ** 2) / waist_radius])
+
+
 class Gauss2D(FitModel):
     """2D Gaussian with
     y_values = vert_factor *
@@ -808,6 +911,11 @@ class Gauss2D(FitModel):
         z_values = vert_factor * np.exp(-2 * r_sq / waist_radius ** 2) + offset
         return z_values
 
+    def f_jac(self, x_values, y_values, paras):
+        """Derivatives of f with respect to the 5 paras (the offset is the last)"""
+        return np.concatenate([round_gaussian_jac(x_values, y_values, paras),
+                               np.ones((1,) + np.broadcast(x_values, y_values).shape)])
+
     def guess(self, x_values, y_values, z_values):
         """for 'bumps' only     ******** ATTENTION WAS NEVER TESTED ***********
             offset is the last in paras
@@ -879,6 +987,10 @@ class Gauss2D_cst_offs(FitModel):
         z_values = vert_factor * np.exp(-2 * r_sq / waist_radius ** 2) + offset
         return z_values
 
+    def f_jac(self, x_values, y_values, paras, offset=0):
+        """Derivatives of f with respect to the 4 paras (they do not depend on the offset)"""
+        return round_gaussian_jac(x_values, y_values, paras)
+
     def guess(self, x_values, y_values, z_values, offset=0):
         """for 'bumps' only
             offset is the last in paras
@@ -929,6 +1041,44 @@ class Gauss2D_cst_offs(FitModel):
 gauss2D_cst_offs = Gauss2D_cst_offs()
 
 
+def elliptic_gaussian(x_values, y_values, paras, offset=0):
+    """Elliptic 2D Gaussian of GaussEll2D for x_values and y_values of any (broadcastable) shape
+    paras = [vert_factor, cent_x, cent_y, waist_rad_a, waist_rad_b, theta]
+    The rotation is calculated once per parameter vector, the positions are
+    rotated around the center into the (a,b) coord system with array operations.
+    """
+    vert_factor, cent_x, cent_y, waist_rad_a, waist_rad_b, theta = paras[:6]
+    cos_t = np.cos(theta / 180 * np.pi)  # theta in degrees
+    sin_t = np.sin(theta / 180 * np.pi)
+    d_x = np.asarray(x_values) - cent_x
+    d_y = np.asarray(y_values) - cent_y
+    d_a = cos_t * d_x - sin_t * d_y  # position relative to the center in the (a,b) coord system
+    d_b = sin_t * d_x + cos_t * d_y
+    return vert_factor * np.exp(-2 * (d_a ** 2 / waist_rad_a ** 2 + d_b ** 2 / waist_rad_b ** 2)) + offset
+
+
+def elliptic_gaussian_jac(x_values, y_values, paras):
+    """Derivatives of elliptic_gaussian with respect to the 6 paras (theta in degrees),
+    array of shape (6,) + shape of the positions
+    """
+    vert_factor, cent_x, cent_y, waist_rad_a, waist_rad_b, theta = paras[:6]
+    cos_t = np.cos(theta / 180 * np.pi)
+    sin_t = np.sin(theta / 180 * np.pi)
+    d_x = np.asarray(x_values) - cent_x
+    d_y = np.asarray(y_values) - cent_y
+    d_a = cos_t * d_x - sin_t * d_y
+    d_b = sin_t * d_x + cos_t * d_y
+    gau = np.exp(-2 * (d_a ** 2 / waist_rad_a ** 2 + d_b ** 2 / waist_rad_b ** 2))
+    fac_a = 4 * vert_factor * gau * d_a / waist_rad_a ** 2
+    fac_b = 4 * vert_factor * gau * d_b / waist_rad_b ** 2
+    return np.array([gau,
+                     cos_t * fac_a + sin_t * fac_b,  # cent_x
+                     -sin_t * fac_a + cos_t * fac_b,  # cent_y
+                     fac_a * d_a / waist_rad_a,
+                     fac_b * d_b / waist_rad_b,
+                     (fac_a * d_b - fac_b * d_a) * np.pi / 180])  # theta
+
+
 class GaussEll2D(FitModel):
     """Elliptic 2D Gaussian with long axis a rotated by theta (degrees)
     with respect to x-axis (positive theta goes up to negative y-values)
@@ -937,37 +1087,12 @@ class GaussEll2D(FitModel):
 
     def f(self, x_values, y_values, paras):
         """offset is the last in paras"""
-        if not isinstance(x_values, np.ndarray):
-            x_values = np.array(x_values)
-        if not isinstance(y_values, np.ndarray):
-            y_values = np.array(y_values)
-
-        z_values = np.ones(x_values.shape) * np.nan
+        return elliptic_gaussian(x_values, y_values, paras[:6], paras[6])
 
-        vert_factor = paras[0]
-        cent_x = paras[1]
-        cent_y = paras[2]
-        waist_rad_a = paras[3]
-        waist_rad_b = paras[4]
-        theta = paras[5]  # in degrees
-        offset = paras[6]
-
-        rot_matr = np.array([[np.cos(theta /180*np.pi), -np.sin(theta /180*np.pi)],
-                             [np.sin(theta /180*np.pi), np.cos(theta /180*np.pi)]])
-
-        for li in range(x_values.shape[0]):  # Treat data line by line
-            # Represent the center (xc,yc) in the theta-rotated (a,b) coord system
-            # cent_x, cent_y --> cent_a, cent_b
-            cent_ab = rot_matr @ np.array([cent_x, cent_y])
-
-            # Represent the positions of a line in the (a,b) coord system:
-            li_posis_ab = rot_matr @ np.array([x_values[li], y_values[li]])
-            # Calculate the values of a line in the (a,b) coord system using the simple formula
-            z_values[li] = (vert_factor *
-                            np.exp(-2 * (li_posis_ab[0] - cent_ab[0]) ** 2 / waist_rad_a ** 2) *
-                            np.exp(-2 * (li_posis_ab[1] - cent_ab[1]) ** 2 / waist_rad_b ** 2)
-                            + offset)
-        return z_values
+    def f_jac(self, x_values, y_values, paras):
+        """Derivatives of f with respect to the 7 paras (the offset is the last)"""
+        return np.concatenate([elliptic_gaussian_jac(x_values, y_values, paras),
+                               np.ones((1,) + np.broadcast(x_values, y_values).shape)])
 
     def guess(self, x_values, y_values, z_values):
         """for 'bumps' only     ******** ATTENTION WAS NEVER TESTED ***********
@@ -1023,8 +1148,11 @@ class GaussEll2D_cst_offs(FitModel):
 
     def f(self, x_values, y_values, paras, offset=0):
         """offset is given separately (not in paras)"""
-        all_paras = np.array(list(paras) + [offset])
-        return gaussEll2D.f(x_values, y_values, all_paras)
+        return elliptic_gaussian(x_values, y_values, paras, offset)
+
+    def f_jac(self, x_values, y_values, paras, offset=0):
+        """Derivatives of f with respect to the 6 paras (they do not depend on the offset)"""
+        return elliptic_gaussian_jac(x_values, y_values, paras)
 
     def guess(self, x_values, y_values, z_values, offset=0):
         """Attn never tested!!! For 'bumps' only. Offset is given separately (not in paras)"""
@@ -1034,6 +1162,93 @@ class GaussEll2D_cst_offs(FitModel):
 gaussEll2D_cst_offs = GaussEll2D_cst_offs()
 
 
+def batch_leastsq(model, p_ini, x, y, z, valid=None, max_iter=200, ftol=1.49012e-08, xtol=1.49012e-08, **kwargs):
+    """Levenberg-Marquardt fit of a 2D model (with f and f_jac) to the data of many frames at once
+    p_ini: initial parameters, array (frames, number of parameters)
+    x, y, z: the data, arrays (frames, points), padded where valid is False
+    valid: None (all points) or boolean array (frames, points), the points used for every frame
+    kwargs: passed to model.f and model.f_jac (e.g. offset)
+    The residuals and Jacobians of the frames that are not yet converged are calculated as stacked
+    arrays. Every frame has its own damping and stops with the tests of leastsq: actual and predicted
+    relative cost reduction below ftol (also for a rejected step) or relative accepted step below xtol.
+    return: p_fit (frames, parameters),
+        status (frames,) like the ier of leastsq: 1 (ftol), 2 (xtol), 3 (both), 5 (max_iter reached),
+            0 (less points than parameters, not fitted),
+        cov (frames, parameters, parameters): inverse of J^T J at p_fit (like cov_x of leastsq), nan if singular
+        info: dict like the infodict of leastsq: "nfev" (frames,) the number of evaluations of the residuals,
+            "fvec" (frames, points) the residuals at p_fit (0 where valid is False)
+    """
+    p_fit = np.array(p_ini, dtype=float)
+    n_frames, n_paras = p_fit.shape
+    if valid is None:
+        valid = np.ones(np.shape(z), dtype=bool)
+
+    def resid(idx, paras):
+        diff = model.f(x[idx], y[idx], paras.T[:, :, None], **kwargs) - z[idx]
+        return np.where(valid[idx], diff, 0)
+
+    def jac(idx, paras):
+        return np.where(valid[idx], model.f_jac(x[idx], y[idx], paras.T[:, :, None], **kwargs), 0)
+
+    status = np.zeros(n_frames, dtype=int)
+    active = np.flatnonzero(valid.sum(axis=1) >= n_paras)
+    res = np.zeros(np.shape(z))
+    jacs = np.zeros((n_paras,) + np.shape(z))
+    res[active] = resid(active, p_fit[active])
+    jacs[:, active] = jac(active, p_fit[active])
+    cost = (res ** 2).sum(axis=1)
+    n_eval = np.zeros(n_frames, dtype=int)
+    n_eval[active] = 1
+    damping = np.full(n_frames, 1e-3)
+    scale = np.full((n_frames, n_paras), np.finfo(float).tiny)  # largest J^T J diagonal so far, as MINPACK
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        jtj = np.einsum('pfn,qfn->fpq', jacs[:, active], jacs[:, active])
+        grad = np.einsum('pfn,fn->fp', jacs[:, active], res[active])
+        scale[active] = np.maximum(scale[active], np.einsum('fpp->fp', jtj))
+        diag = scale[active]
+        damped = jtj + damping[active, None, None] * diag[:, :, None] * np.eye(n_paras)
+        try:
+            step = -np.linalg.solve(damped, grad[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:  # rare, one singular frame
+            step = -(np.linalg.pinv(damped) @ grad[:, :, None])[:, :, 0]
+        p_new = p_fit[active] + step
+        with np.errstate(over='ignore', invalid='ignore'):  # too large steps are rejected
+            res_new = resid(active, p_new)
+            cost_new = (res_new ** 2).sum(axis=1)
+        n_eval[active] += 1
+        better = cost_new < cost[active]  # False for nan too
+        # relative actual and predicted cost reductions of MINPACK (lmder): their ftol test holds for rejected
+        # steps too, so a frame that starts at its minimum converges
+        cost_old = cost[active]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            act_red = np.where(cost_new < 100 * cost_old, 1 - cost_new / cost_old, -1)
+            pre_red = (np.einsum('fp,fpq,fq->f', step, jtj, step)
+                       + 2 * damping[active] * (diag * step ** 2).sum(axis=1)) / cost_old
+            ratio = np.where(pre_red > 0, act_red / pre_red, 0)
+        small_cost = (cost_old == 0) | ((np.abs(act_red) <= ftol) & (pre_red <= ftol) & (ratio <= 2))
+        small_step = better & (np.sqrt((diag * step ** 2).sum(axis=1))  # rejected steps shrink with damping
+                               <= xtol * np.sqrt((diag * p_fit[active] ** 2).sum(axis=1)))
+        accepted = active[better]
+        p_fit[accepted] = p_new[better]
+        res[accepted] = res_new[better]
+        cost[accepted] = cost_new[better]
+        jacs[:, accepted] = jac(accepted, p_fit[accepted])
+        damping[accepted] /= 10
+        damping[active[~better]] *= 10
+        status[active] = small_cost + 2 * small_step
+        active = active[status[active] == 0]
+    status[active] = 5
+
+    cov = np.full((n_frames, n_paras, n_paras), np.nan)
+    fitted = np.flatnonzero(status > 0)
+    jtj = np.einsum('pfn,qfn->fpq', jacs[:, fitted], jacs[:, fitted])
+    regular = np.linalg.matrix_rank(jtj) == n_paras
+    cov[fitted[regular]] = np.linalg.inv(jtj[regular])
+    return p_fit, status, cov, {"nfev": n_eval, "fvec": res}
+
+
 class Exponential(FitModel):
     """single exponential increase or decrease.
     Recall that a * exp(b*(x-x0)) + c  =  a/exp(b*x0) * exp(b*x) + c
@@ -0,0 +1,392 @@
+"""
+Container for the image stack of one measurement (all frames of a wcf file or of a folder)
+
+The frames are kept in the dtype of the files (uint8, uint16, ...). Only the frame
+that is analyzed is converted to float (frame_float), after cropping, so the
+stack needs 4 (uint16) to 8 (uint8) times less memory than a float64 stack.
+
+The stack is stored frame-major: data has the shape (frames, height, width) and
+is C-contiguous, so every frame is one contiguous block of memory. Use the
+accessors (frame, set_frame, n_frames, height, width) instead of indexing data.
+
+The per-frame statistics (StackStats) are computed in one pass over the stack
+and kept on the ImageStack until a frame is modified.
+
+FileImageStack has the same accessors, but reads the frames from a file only
+when they are requested (multi-page tiff, hdf5, wcf or folder in lazy mode, see
+stack_readers.py). The frames read are kept in a CachedFrameReader: a least
+recently used cache with a memory budget, filled in advance around the
+displayed frame by a background thread (prefetch).
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+stats_chunk_bytes = 2**24  # frames are reduced in chunks of about 16 MB (stay in cache, small temporaries)
+frame_cache_bytes = 2**29  # default memory budget of the frame cache of a FileImageStack (512 MB)
+prefetch_radius = 2  # frames read in advance before and after the requested one
+
+
+class StackStats:
+    """Per-frame statistics of an ImageStack (arrays of length number of frames)
+    frame_max, frame_min, frame_mean: maximum, minimum and mean pixel value of each frame
+    sat_count: number of pixels above sat_limit in each frame
+    sat_limit: the value used for sat_count
+    dark_limit: frames with a maximum below this value are considered dark
+    dark: bool array, True for the dark frames
+    """
+
+    def __init__(self, frame_max, frame_min, frame_mean, sat_count, sat_limit):
+        self.frame_max = frame_max
+        self.frame_min = frame_min
+        self.frame_mean = frame_mean
+        self.sat_count = sat_count
+        self.sat_limit = sat_limit
+        med_max = np.median(frame_max)
+        self.dark_limit = med_max - 3 * (frame_max.max() - med_max)
+        self.dark = frame_max < self.dark_limit
+
+    @property
+    def vmax(self):
+        """the maximum value of the whole stack"""
+        return self.frame_max.max()
+
+    @property
+    def sat_pix_count(self):
+        """number of saturated pixels in the whole stack"""
+        return int(self.sat_count.sum())
+
+    @property
+    def sat_im_count(self):
+        """number of frames that contain saturated pixels"""
+        return int(np.count_nonzero(self.sat_count))
+
+    @property
+    def dark_frames(self):
+        """indices (0 based) of the dark frames"""
+        return np.flatnonzero(self.dark)
+
+
+class ImageStack:
+    """Stack of images in their native dtype
+    data: array of shape (number of frames, height, width) (copied if not C-contiguous)
+    sat_value: the maximum integer value in the images (default: from the dtype)
+    """
+
+    def __init__(self, data, sat_value=None):
+        self.data = np.ascontiguousarray(data)
+        if sat_value is None:
+            if np.issubdtype(data.dtype, np.integer):
+                sat_value = np.iinfo(data.dtype).max
+            else:
+                sat_value = 1.0
+        self.sat_value = sat_value
+        self._stats = None  # StackStats, computed on demand
+
+    def __repr__(self):
+        return "{}(frames={:d}, height={:d}, width={:d}, dtype={}, {:.1f} MB)".format(
+            type(self).__name__, self.n_frames, self.height, self.width, self.dtype, self.nbytes / 1e6)
+
+    def __len__(self):
+        """number of frames"""
+        return self.n_frames
+
+    @property
+    def n_frames(self):
+        return self.data.shape[0]
+
+    @property
+    def height(self):
+        return self.data.shape[1]
+
+    @property
+    def width(self):
+        return self.data.shape[2]
+
+    @property
+    def frame_shape(self):
+        """(height, width) of one frame"""
+        return self.data.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def frame(self, idx):
+        """Return the frame idx (0 based) as a contiguous view in the native dtype"""
+        return self.data[idx]
+
+    def set_frame(self, idx, im):
+        """Replace the frame idx by im (cast to the native dtype)"""
+        self.data[idx] = im
+        self._stats = None  # has to be computed again
+
+    def frame_float(self, idx, rows=slice(None), cols=slice(None), dtype=np.float64):
+        """Return a float copy of the frame idx, cropped to rows and cols (slices)
+        Only the cropped part is converted.
+        """
+        return self.data[idx, rows, cols].astype(dtype)  # astype always makes a copy
+
+    def crop(self, rows, cols):
+        """Return an ImageStack of the rows and cols (slices) of this one.
+        The cropped frames are copied to keep them contiguous.
+        """
+        return ImageStack(self.data[:, rows, cols], self.sat_value)
+
+    def copy(self):
+        new = ImageStack(self.data.copy(), self.sat_value)
+        new._stats = self._stats  # same pixels, same statistics
+        return new
+
+    def prefetch(self, idx, radius=prefetch_radius):
+        """Nothing to do, all frames are in memory (see FileImageStack)"""
+        pass
+
+    def stats(self, sat_limit):
+        """Return the StackStats of the stack (cached)
+        sat_limit: pixels above this value are counted as saturated
+        All statistics are reduced in one pass over the stack, chunk by chunk.
+        """
+        if self._stats is not None and self._stats.sat_limit == sat_limit:
+            return self._stats
+        n = self.n_frames
+        frame_max = np.empty(n, dtype=self.dtype)
+        frame_min = np.empty(n, dtype=self.dtype)
+        frame_mean = np.empty(n)
+        sat_count = np.empty(n, dtype=np.int64)
+        for start, block in self._frame_blocks():
+            stop = start + block.shape[0]
+            frame_max[start:stop] = block.max(axis=1)
+            frame_min[start:stop] = block.min(axis=1)
+            frame_mean[start:stop] = block.mean(axis=1, dtype=np.float64)
+            sat_count[start:stop] = np.count_nonzero(block > sat_limit, axis=1)
+        self._stats = StackStats(frame_max, frame_min, frame_mean, sat_count, sat_limit)
+        return self._stats
+
+    def _frame_blocks(self):
+        """yield (index of the first frame, array (frames, pixels)) for chunks of about stats_chunk_bytes"""
+        flat = self.data.reshape(self.n_frames, -1)  # view, because data is contiguous
+        chunk = max(1, stats_chunk_bytes // max(1, flat[0].nbytes))  # frames per chunk
+        for start in range(0, self.n_frames, chunk):
+            yield start, flat[start:start + chunk]
+
+
+class CachedFrameReader:
+    """Reader with a least recently used cache of the frames
+    reader: object with n_frames, frame_shape, dtype and read_frame(idx) (see stack_readers.py)
+    max_bytes: memory budget of the cache. The oldest frames are removed when it is exceeded.
+
+    read_frame can be called from the GUI while prefetch reads in a background
+    thread: the reader itself is only used by one thread at a time.
+    """
+
+    def __init__(self, reader, max_bytes=frame_cache_bytes):
+        self.reader = reader
+        self.max_bytes = max_bytes
+        self.n_frames = reader.n_frames
+        self.frame_shape = reader.frame_shape
+        self.dtype = reader.dtype
+        self.nbytes = 0  # bytes in the cache
+        self._frames = OrderedDict()  # frame index -> frame, the last one is the most recently used
+        self._cache_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._pending = set()  # indices submitted for prefetch
+        self._pool = None  # started on the first prefetch
+
+    def _get(self, idx):
+        with self._cache_lock:
+            im = self._frames.get(idx)
+            if im is not None:
+                self._frames.move_to_end(idx)
+            return im
+
+    def _put(self, idx, im):
+        with self._cache_lock:
+            if idx in self._frames:
+                return
+            self._frames[idx] = im
+            self.nbytes += im.nbytes
+            while self.nbytes > self.max_bytes and len(self._frames) > 1:
+                _, old = self._frames.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def read_frame(self, idx):
+        """Return the frame idx from the cache, read it if necessary (do not modify the returned array)"""
+        im = self._get(idx)
+        if im is None:
+            with self._read_lock:
+                im = self._get(idx)  # may have been read by prefetch in the meantime
+                if im is None:
+                    im = np.asarray(self.reader.read_frame(idx))
+                    self._put(idx, im)
+        return im
+
+    def prefetch(self, indices):
+        """Read the frames of indices in a background thread (if they are not yet in the cache)"""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1)
+        for idx in indices:
+            with self._cache_lock:
+                if idx in self._frames or idx in self._pending:
+                    continue
+                self._pending.add(idx)
+            self._pool.submit(self._prefetch_one, idx)
+
+    def _prefetch_one(self, idx):
+        try:
+            self.read_frame(idx)
+        finally:
+            with self._cache_lock:
+                self._pending.discard(idx)
+
+    def clear(self):
+        with self._cache_lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+        self.clear()
+        if hasattr(self.reader, "close"):
+            self.reader.close()
+
+
+def _range_slice(r):
+    """slice that selects the same indices as the range r"""
+    return slice(r.start, r.stop, r.step)
+
+
+class FileImageStack(ImageStack):
+    """Stack of images read frame by frame from a file
+    reader: object with n_frames, frame_shape, dtype and read_frame(idx) (see stack_readers.py)
+    sat_value: the maximum integer value in the images (default: from the dtype)
+    rows, cols: slices of the frames of the file that are kept (crop)
+    cache_bytes: memory budget of the frame cache (if reader is not yet a CachedFrameReader)
+
+    Nothing is read before a frame is requested. Frames replaced with set_frame
+    (e.g. by the median filter) are kept in memory, in addition to the cache.
+    Cropped stacks and copies share the reader and its cache.
+    """
+
+    def __init__(self, reader, sat_value=None, rows=slice(None), cols=slice(None), cache_bytes=frame_cache_bytes):
+        if not isinstance(reader, CachedFrameReader):
+            reader = CachedFrameReader(reader, cache_bytes)
+        self.reader = reader
+        full_height, full_width = reader.frame_shape
+        self._rows = range(full_height)[rows]
+        self._cols = range(full_width)[cols]
+        self._modified = {}  # frame index -> frame replaced by set_frame
+        if sat_value is None:
+            if np.issubdtype(reader.dtype, np.integer):
+                sat_value = np.iinfo(reader.dtype).max
+            else:
+                sat_value = 1.0
+        self.sat_value = sat_value
+        self._stats = None
+
+    @property
+    def data(self):
+        """all frames as an array (frames, height, width). This reads the whole stack into memory!"""
+        return np.stack([self.frame(idx) for idx in range(self.n_frames)])
+
+    @property
+    def n_frames(self):
+        return self.reader.n_frames
+
+    @property
+    def height(self):
+        return len(self._rows)
+
+    @property
+    def width(self):
+        return len(self._cols)
+
+    @property
+    def frame_shape(self):
+        return self.height, self.width
+
+    @property
+    def dtype(self):
+        return self.reader.dtype
+
+    @property
+    def nbytes(self):
+        """size of the stack if it was in memory"""
+        return self.n_frames * self.height * self.width * self.dtype.itemsize
+
+    def frame(self, idx):
+        """Return the frame idx (0 based), read from the file, in the native dtype"""
+        if idx in self._modified:
+            return self._modified[idx]
+        im = self.reader.read_frame(idx)
+        return np.ascontiguousarray(im[_range_slice(self._rows), _range_slice(self._cols)])
+
+    def set_frame(self, idx, im):
+        """Replace the frame idx by im (cast to the native dtype, kept in memory)"""
+        self._modified[idx] = np.array(im, dtype=self.dtype).reshape(self.frame_shape)
+        self._stats = None  # has to be computed again
+
+    def frame_float(self, idx, rows=slice(None), cols=slice(None), dtype=np.float64):
+        return self.frame(idx)[rows, cols].astype(dtype)
+
+    def crop(self, rows, cols):
+        """Return a FileImageStack of the rows and cols (slices) of this one (nothing is read)"""
+        new = FileImageStack(self.reader, self.sat_value,
+                             _range_slice(self._rows[rows]), _range_slice(self._cols[cols]))
+        new._modified = {idx: np.ascontiguousarray(im[rows, cols]) for idx, im in self._modified.items()}
+        return new
+
+    def copy(self):
+        """Return a FileImageStack on the same reader (the modified frames are copied)"""
+        new = FileImageStack(self.reader, self.sat_value, _range_slice(self._rows), _range_slice(self._cols))
+        new._modified = {idx: im.copy() for idx, im in self._modified.items()}
+        new._stats = self._stats
+        return new
+
+    def prefetch(self, idx, radius=prefetch_radius):
+        """Read the frames around idx in the background (e.g. while the frame idx is displayed)"""
+        self.reader.prefetch([i for i in range(idx - radius, idx + radius + 1)
+                              if 0 <= i < self.n_frames and i not in self._modified])
+
+    def _frame_blocks(self):
+        """yield the frames one by one (read ahead by prefetch)"""
+        for idx in range(self.n_frames):
+            self.prefetch(idx + prefetch_radius, radius=prefetch_radius)
+            yield idx, self.frame(idx).reshape(1, -1)
+
+
+if __name__ == "__main__":
+    from time import time as tic
+
+    st = ImageStack(np.random.default_rng().integers(0, 2**16, size=(64, 1020, 1196), dtype=np.uint16))
+    print(st, "float64 stack would be {:.1f} MB".format(st.data.size * 8 / 1e6))
+    t1 = tic()
+    fr = st.frame_float(10, slice(100, 400), slice(200, 500))
+    print("cropped float frame:", fr.shape, fr.dtype, "took {:.6f} s".format(tic() - t1))
+    t1 = tic()
+    sta = st.stats(0.95 * st.sat_value)
+    print("stack statistics took {:.6f} s:".format(tic() - t1), sta.vmax, sta.sat_pix_count, sta.dark_frames)
+    t1 = tic()
+    st.stats(0.95 * st.sat_value)
+    print("cached statistics took {:.6f} s".format(tic() - t1))
+    print(st.crop(slice(10, -10), slice(5, -5)))
+
+    class ArrayReader:  # stands for a reader of stack_readers.py
+        def __init__(self, arr):
+            (self.arr, self.n_frames, self.frame_shape, self.dtype) = (arr, arr.shape[0], arr.shape[1:], arr.dtype)
+
+        def read_frame(self, idx):
+            return self.arr[idx]
+
+    fst = FileImageStack(ArrayReader(st.data), cache_bytes=2**26).crop(slice(10, -10), slice(5, -5))
+    print(fst, "same frame:", np.array_equal(fst.frame(3), st.data[3, 10:-10, 5:-5]),
+          "same stats:", np.array_equal(fst.stats(0.95 * st.sat_value).frame_max,
+                                        st.crop(slice(10, -10), slice(5, -5)).stats(0.95 * st.sat_value).frame_max))
+    print("frames in the cache: {:d}, {:.1f} MB".format(len(fst.reader._frames), fst.reader.nbytes / 1e6))
@@ -0,0 +1,205 @@
+"""
+Set of masked pixels of the frames of a stack (e.g. hot pixels or dust)
+
+PixelMask stores the mask as a boolean array of the frame shape (True = masked)
+instead of a list of (x, y) tuples: adding or removing a rectangle is one slice
+assignment, the number of masked pixels is a count_nonzero and the mask is
+applied to an image or to a selection mask without a Python loop.
+
+The coordinates are (x, y) = (column, row) like the ROIs of the GUIs, the borders
+of a rectangle are inside. The array grows if pixels outside of it are added.
+
+For the analysis (beam_engine.py) the masked pixels are filled by normalized
+convolution (inpaint_operator): every masked pixel gets the Gaussian weighted
+mean of the unmasked pixels around it. The weights are a sparse matrix that is
+computed once per mask and image part, filling a frame is then a single
+sparse matrix-vector product (fill_masked). Only the parts used last are kept
+(mask_parts_cached), the auto crop moves the part with the beam.
+"""
+from collections import OrderedDict
+import numpy as np
+from scipy import ndimage as ndi
+from scipy import sparse
+
+# in the inferno colormap: light color on the middle values, dark color elsewhere
+inferno_limits = (0.35, 0.82)
+inferno_col_vals = (0.66, 1)
+inpaint_radius = 3  # half width of the window of the normalized convolution (pixels)
+mask_parts_cached = 8  # image parts (with their inpaint operator) kept by PixelMask.analysis_part
+
+
+def inpaint_operator(mask, radius=inpaint_radius):
+    """Return (rows, cols, weights) to fill the pixels of an image where mask is True
+    rows, cols: positions of the masked pixels
+    weights: sparse matrix (masked pixels, all pixels) such that image[rows, cols] = weights @ image.ravel()
+    Every masked pixel gets the Gaussian weighted mean (sigma = radius / 2) of the unmasked pixels
+    in the (2*radius + 1)^2 window around it. A masked pixel without unmasked pixels in its window
+    gets the value of the nearest unmasked pixel. If all pixels are masked, nothing is filled.
+    """
+    height, width = mask.shape
+    n_pix = height * width
+    rows, cols = np.nonzero(mask)
+    if rows.size == 0 or rows.size == n_pix:
+        return rows[:0], cols[:0], sparse.csr_matrix((0, n_pix))
+    d = np.arange(-radius, radius + 1)
+    dy, dx = [a.ravel() for a in np.meshgrid(d, d, indexing="ij")]
+    kernel = np.exp(-(dx ** 2 + dy ** 2) / (2 * (radius / 2) ** 2))
+    nb_rows = rows[:, None] + dy  # the window of every masked pixel
+    nb_cols = cols[:, None] + dx
+    inside = (nb_rows >= 0) & (nb_rows < height) & (nb_cols >= 0) & (nb_cols < width)
+    nb_rows = np.clip(nb_rows, 0, height - 1)
+    nb_cols = np.clip(nb_cols, 0, width - 1)
+    weights = np.where(inside & ~mask[nb_rows, nb_cols], kernel, 0)
+    norm = weights.sum(axis=1)
+    isolated = norm == 0
+    if np.any(isolated):  # inside a large masked region: use the nearest unmasked pixel
+        near_rows, near_cols = ndi.distance_transform_edt(mask, return_distances=False, return_indices=True)
+        weights[isolated] = 0
+        weights[isolated, 0] = 1
+        nb_rows[isolated, 0] = near_rows[rows[isolated], cols[isolated]]
+        nb_cols[isolated, 0] = near_cols[rows[isolated], cols[isolated]]
+        norm[isolated] = 1
+    weights /= norm[:, None]
+    used = weights > 0
+    weights = sparse.csr_matrix((weights[used], (np.nonzero(used)[0], (nb_rows * width + nb_cols)[used])),
+                                shape=(rows.size, n_pix))
+    return rows, cols, weights
+
+
+def fill_masked(images, operator):
+    """Fill the masked pixels of images (one float image or a stack (frames, height, width)) in place
+    operator: (rows, cols, weights) of inpaint_operator for the image shape
+    """
+    rows, cols, weights = operator
+    if rows.size:
+        flat = images.reshape(-1, images.shape[-2] * images.shape[-1])
+        images[..., rows, cols] = (weights @ flat.T).T.reshape(images.shape[:-2] + (rows.size,))
+
+
+class PixelMask:
+    """Masked pixels of frames of shape (height, width)"""
+
+    def __init__(self, shape=(0, 0)):
+        self.array = np.zeros(shape, dtype=bool)
+        self._parts = OrderedDict()  # cache of analysis_part, the last one is the most recently used
+
+    @classmethod
+    def from_pixels(cls, x, y, shape=(0, 0)):
+        """Return the mask of the pixels (x[i], y[i])"""
+        mask = cls(shape)
+        mask.add_pixels(x, y)
+        return mask
+
+    def __len__(self):
+        return int(np.count_nonzero(self.array))
+
+    def _grow(self, height, width):
+        """Enlarge the array to at least (height, width)"""
+        old_h, old_w = self.array.shape
+        if height > old_h or width > old_w:
+            self.array = np.pad(self.array, ((0, max(height - old_h, 0)), (0, max(width - old_w, 0))))
+
+    def set_rect(self, ulx, lrx, uly, lry, value=True):
+        """Mask (value True) or unmask (value False) the pixels of the rectangle"""
+        ulx, uly = max(ulx, 0), max(uly, 0)
+        if lrx < ulx or lry < uly:
+            return
+        if value:
+            self._grow(lry + 1, lrx + 1)
+        self.array[uly:lry + 1, ulx:lrx + 1] = value
+        self._parts.clear()
+
+    def add_rect(self, ulx, lrx, uly, lry):
+        self.set_rect(ulx, lrx, uly, lry, True)
+
+    def remove_rect(self, ulx, lrx, uly, lry):
+        self.set_rect(ulx, lrx, uly, lry, False)
+
+    def add_pixels(self, x, y):
+        """Mask the pixels (x[i], y[i]), negative coordinates are ignored"""
+        x = np.asarray(x, dtype=np.intp).ravel()
+        y = np.asarray(y, dtype=np.intp).ravel()
+        keep = (x >= 0) & (y >= 0)
+        x, y = x[keep], y[keep]
+        if x.size:
+            self._grow(y.max() + 1, x.max() + 1)
+            self.array[y, x] = True
+            self._parts.clear()
+
+    def pixels(self):
+        """Return the arrays (x, y) of the masked pixels, sorted by column, then row"""
+        x, y = np.nonzero(self.array.T)
+        return x, y
+
+    def crop_view(self, x0, y0, shape):
+        """Return the mask of the part of shape (height, width) of the frame that starts at (x0, y0)
+        (e.g. a cropped image), False where the part is outside of the array.
+        """
+        view = np.zeros(shape, dtype=bool)
+        fy0, fx0 = max(y0, 0), max(x0, 0)
+        fy1 = min(y0 + shape[0], self.array.shape[0])
+        fx1 = min(x0 + shape[1], self.array.shape[1])
+        if fy1 > fy0 and fx1 > fx0:
+            view[fy0 - y0:fy1 - y0, fx0 - x0:fx1 - x0] = self.array[fy0:fy1, fx0:fx1]
+        return view
+
+    def analysis_part(self, x0, y0, shape):
+        """Return (part, operator): crop_view(x0, y0, shape) (read only) and its inpaint_operator
+        The last mask_parts_cached parts are cached until the mask is modified.
+        """
+        key = (x0, y0, tuple(shape))
+        if key in self._parts:
+            self._parts.move_to_end(key)
+        else:
+            part = self.crop_view(x0, y0, shape)
+            part.setflags(write=False)
+            self._parts[key] = (part, inpaint_operator(part))
+            while len(self._parts) > mask_parts_cached:
+                self._parts.popitem(last=False)
+        return self._parts[key]
+
+    def overlay(self, image, x0=0, y0=0):
+        """Return a copy of image (the part of the frame that starts at (x0, y0)) in which
+        the masked pixels are visible in the inferno colormap
+        """
+        shown = image.copy()
+        sel = self.crop_view(x0, y0, image.shape)
+        if not sel.any():
+            return shown
+        mini_val = np.min(image)
+        span = np.max(image) - mini_val
+        rel = image[sel] / span
+        light = (inferno_limits[0] < rel) & (rel < inferno_limits[1])
+        shown[sel] = np.where(light, inferno_col_vals[1] * span + mini_val, inferno_col_vals[0] * span + mini_val)
+        return shown
+
+
+if __name__ == "__main__":
+    # Compare with the list of tuples for a large rectangle
+    from time import time as tic
+
+    t1 = tic()
+    masked = []
+    points_new = [(xCoo, yCoo) for xCoo in range(100, 600) for yCoo in range(50, 450)]
+    masked = list(set(masked + points_new))
+    masked = list(set(masked) - set((xCoo, yCoo) for xCoo in range(200, 300) for yCoo in range(50, 450)))
+    print("list of tuples: {:d} pixels in {:.3f} s".format(len(masked), tic() - t1))
+
+    t1 = tic()
+    mask = PixelMask((600, 800))
+    mask.add_rect(100, 599, 50, 449)
+    mask.remove_rect(200, 299, 50, 449)
+    print("PixelMask     : {:d} pixels in {:.6f} s".format(len(mask), tic() - t1))
+
+    image = np.random.default_rng(0).random((600, 800))
+    t1 = tic()
+    shown = mask.overlay(image[10:, 20:], 20, 10)
+    print("overlay of a crop in {:.6f} s".format(tic() - t1))
+
+    mask.add_pixels(np.random.default_rng(1).integers(0, 800, 500), np.arange(500))  # hot pixels
+    t1 = tic()
+    part, operator = mask.analysis_part(0, 0, image.shape)
+    print("inpainting weights of {:d} pixels in {:.3f} s".format(len(mask), tic() - t1))
+    t1 = tic()
+    fill_masked(image, operator)
+    print("filled in {:.6f} s".format(tic() - t1))
@@ -0,0 +1,260 @@
+"""
+Readers that build an image stack from files other than wcf (see wcf_reader.py)
+
+read_image_folder: all single-frame images (tif, png, jpg) of a folder that
+have the same size and type as a chosen file. The files are decoded by a pool
+of threads (the decoders release the GIL) directly into a preallocated
+(frames, height, width) array. The progress is given to a callback function,
+so this module does not depend on the GUI.
+
+TiffPagesReader, Hdf5Reader: a whole stack in one file (multi-page TIFF,
+OME-TIFF, HDF5 dataset). The file is kept open and a frame is decoded only
+when read_frame is called (one page or the chunks of one frame). They are used
+through image_stack.FileImageStack. open_stack_file chooses the reader.
+
+FolderReader, ArrayReader: the same interface for a folder of images and for a
+mapped wcf file (lazy mode of the GUI, nothing is read before it is shown).
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import matplotlib.pyplot as plt
+from PIL import Image  # installed with matplotlib, used to read the image headers
+
+try:
+    import tifffile  # faster tiff decoding, reads the header without the pixels
+except ImportError:
+    tifffile = None
+try:
+    import h5py  # only needed for hdf5 files
+except ImportError:
+    h5py = None
+
+image_extensions = (".tif", ".tiff", ".png", ".jpg", ".jpeg")
+tiff_extensions = (".tif", ".tiff")  # includes .ome.tif(f)
+hdf5_extensions = (".h5", ".hdf5", ".hdf")
+
+
+def is_tiff(f_name):
+    return os.path.splitext(f_name)[1].lower() in tiff_extensions
+
+
+def image_header(f_name):
+    """Return (shape, kind) of an image file without decoding the pixels.
+    kind is the dtype (tifffile) or the PIL mode, images of equal shape and kind
+    can be put into the same stack.
+    """
+    if tifffile is not None and is_tiff(f_name):
+        with tifffile.TiffFile(f_name) as tif:
+            page = tif.pages[0]
+            return tuple(page.shape), str(page.dtype)
+    with Image.open(f_name) as im:  # lazy: only the header is read
+        bands = len(im.getbands())
+        shape = (im.height, im.width) if bands == 1 else (im.height, im.width, bands)
+        return shape, im.mode
+
+
+def imread(f_name):
+    """Read one image in its native dtype"""
+    if tifffile is not None and is_tiff(f_name):
+        return tifffile.imread(f_name, key=0)
+    return plt.imread(f_name)
+
+
+def list_image_files(dirname, extensions=image_extensions):
+    """Return the sorted list of paths of the image files in dirname (no sub folders)"""
+    filenames = next(os.walk(dirname))[2]
+    return [os.path.join(dirname, fn) for fn in sorted(filenames)
+            if os.path.splitext(fn)[1].lower() in extensions]
+
+
+def list_stack_files(f_name):
+    """Return the paths of the images of the folder of f_name with the same shape and type
+    (compared in the headers, nothing is decoded). f_name is the first one.
+    Raises ValueError if the header of f_name is not readable.
+    """
+    try:
+        ref_header = image_header(f_name)
+    except Exception as err:  # the decoders raise many different errors
+        raise ValueError("Not a readable image: " + f_name) from err
+    dirname = os.path.dirname(os.path.abspath(f_name))
+    ext = os.path.splitext(f_name)[1].lower()
+    same_family = tiff_extensions if ext in tiff_extensions else (ext,)
+    file_names = [f_name]
+    for this_file in list_image_files(dirname, same_family):
+        if os.path.normcase(os.path.abspath(this_file)) == os.path.normcase(os.path.abspath(f_name)):
+            continue  # Do not read again the chosen file
+        try:
+            if image_header(this_file) == ref_header:
+                file_names.append(this_file)
+        except Exception:  # not readable, ignore it
+            pass
+    return file_names
+
+
+def read_image_folder(f_name, progress=None, max_workers=None):
+    """Read all images of the folder of f_name that match f_name in shape and type
+    f_name: path of the chosen image (it becomes the first frame)
+    progress: None or function progress(done, total), called in the calling thread
+    max_workers: number of decoding threads (None: default of ThreadPoolExecutor)
+
+    return: stack (array of shape (frames, height, width) in the dtype of f_name),
+        list of the file names of the frames
+    Raises ValueError if f_name is not a readable image.
+    """
+    try:
+        first = imread(f_name)
+    except Exception as err:  # the decoders raise many different errors
+        raise ValueError("Not a readable image: " + f_name) from err
+    file_names = list_stack_files(f_name)
+
+    stack = np.empty((len(file_names),) + first.shape, dtype=first.dtype)
+    stack[0] = first
+    good = np.ones(len(file_names), dtype=bool)
+
+    def decode_into(idx):
+        im = imread(file_names[idx])
+        if im.shape != first.shape or im.dtype != first.dtype:
+            return False
+        stack[idx] = im
+        return True
+
+    total = len(file_names)
+    if progress is not None:
+        progress(1, total)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(decode_into, idx): idx for idx in range(1, total)}
+        for done, future in enumerate(as_completed(futures), start=2):
+            try:
+                good[futures[future]] = future.result()
+            except Exception:  # header was ok, but the decoding failed
+                good[futures[future]] = False
+            if progress is not None:
+                progress(done, total)
+
+    if not good.all():  # rare: remove the frames that could not be decoded
+        stack = stack[good]
+        file_names = [fn for fn, ok in zip(file_names, good) if ok]
+    return stack, file_names
+
+
+class TiffPagesReader:
+    """Frames of a multi-page TIFF or OME-TIFF file (needs tifffile)
+    The frames are the pages of the first series, all dimensions except the
+    last two (height, width) are flattened to the frame index.
+    """
+
+    def __init__(self, f_name):
+        if tifffile is None:
+            raise ValueError("tifffile is needed to read multi-page tiff files")
+        self.f_name = f_name
+        self._tif = tifffile.TiffFile(f_name)
+        series = self._tif.series[0]
+        self._pages = series.pages  # pages are read (decoded) only on access
+        self.frame_shape = tuple(series.shape[-2:])
+        self.n_frames = len(self._pages)
+        self.dtype = np.dtype(series.dtype)
+
+    def read_frame(self, idx):
+        return self._pages[idx].asarray()
+
+    def close(self):
+        self._tif.close()
+
+
+class Hdf5Reader:
+    """Frames of a dataset in a HDF5 file (needs h5py)
+    dataset: name of a 3D dataset (frames, height, width). If None, the first
+        3D dataset of the file is used.
+    Only the chunks of the requested frame are read.
+    """
+
+    def __init__(self, f_name, dataset=None):
+        if h5py is None:
+            raise ValueError("h5py is needed to read hdf5 files")
+        self.f_name = f_name
+        self._h5 = h5py.File(f_name, "r")
+        if dataset is None:
+            found = []
+
+            def find_3d(name, obj):
+                if isinstance(obj, h5py.Dataset) and obj.ndim == 3 and not found:
+                    found.append(name)
+            self._h5.visititems(find_3d)
+            if not found:
+                self._h5.close()
+                raise ValueError("No 3D dataset in " + f_name)
+            dataset = found[0]
+        self._ds = self._h5[dataset]
+        self.frame_shape = tuple(self._ds.shape[1:])
+        self.n_frames = self._ds.shape[0]
+        self.dtype = np.dtype(self._ds.dtype)
+
+    def read_frame(self, idx):
+        return self._ds[idx]
+
+    def close(self):
+        self._h5.close()
+
+
+class FolderReader:
+    """Frames of a folder of images, one file per frame (see list_stack_files)
+    The first file is decoded to get the frame shape and dtype.
+    """
+
+    def __init__(self, file_names):
+        self.file_names = file_names
+        first = imread(file_names[0])
+        self.frame_shape = first.shape
+        self.n_frames = len(file_names)
+        self.dtype = first.dtype
+
+    def read_frame(self, idx):
+        im = imread(self.file_names[idx])
+        if im.shape != self.frame_shape:  # the header was ok, but not the pixels
+            raise ValueError("Image of a different size: " + self.file_names[idx])
+        return im.astype(self.dtype, copy=False)
+
+
+class ArrayReader:
+    """Frames of an array (frames, height, width), e.g. the np.memmap of a wcf file"""
+
+    def __init__(self, frames):
+        self._frames = frames
+        self.frame_shape = frames.shape[1:]
+        self.n_frames = frames.shape[0]
+        self.dtype = frames.dtype
+
+    def read_frame(self, idx):
+        return np.array(self._frames[idx])  # copy: reads the frame from the file
+
+
+def open_stack_file(f_name):
+    """Return a reader (TiffPagesReader or Hdf5Reader) if f_name contains a stack, None if not
+    (e.g. a single-frame tiff that is part of a folder stack).
+    Raises ValueError if the file type needs a missing module or is not readable.
+    """
+    ext = os.path.splitext(f_name)[1].lower()
+    try:
+        if ext in hdf5_extensions:
+            return Hdf5Reader(f_name)
+        if ext in tiff_extensions and tifffile is not None:
+            reader = TiffPagesReader(f_name)
+            if reader.n_frames > 1:
+                return reader
+            reader.close()
+    except (OSError, KeyError) as err:
+        raise ValueError("Not a readable stack file: " + f_name) from err
+    return None
+
+
+if __name__ == "__main__":
+    # Read the tif test folder of the repository
+    from time import time as tic
+
+    test_file = os.path.join(os.path.dirname(__file__), "..", "tests", "tif_data_210118_BP_f15cm", "01_zm10_00")
+    test_file = list_image_files(test_file)[0]
+    t1 = tic()
+    st, fns = read_image_folder(test_file, progress=lambda done, total: print(done, "/", total, end="\r"))
+    print("\n{:d} frames {} {} read in {:.3f} s".format(len(fns), st.shape[1:], st.dtype, tic() - t1))
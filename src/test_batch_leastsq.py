@@ -0,0 +1,34 @@
+import numpy as np
+from fitting_module_v2 import batch_leastsq, gaussEll2D_cst_offs
+
+
+def ell_gauss_frames(n_frames=20, noise=10, seed=1):
+    """x, y, z (frames, points) of elliptic Gaussian beams on 60x60 pixels and their parameters"""
+    xx, yy = np.meshgrid(np.arange(60.), np.arange(60.))
+    x = np.tile(xx.ravel(), (n_frames, 1))
+    y = np.tile(yy.ravel(), (n_frames, 1))
+    paras = np.array([[3000, 30 + k * 0.1, 29, 8, 5, 20 + k] for k in range(n_frames)], dtype=float)
+    z = gaussEll2D_cst_offs.f(x, y, paras.T[:, :, None], offset=100)
+    z = z + np.random.default_rng(seed).normal(0, noise, z.shape)
+    return x, y, z, paras
+
+
+def test_restart_from_minimum():
+    """A fit that starts at its minimum stops at once with a converged status (like leastsq)"""
+    x, y, z, paras = ell_gauss_frames(noise=0)
+    p_fit, status, _, info = batch_leastsq(gaussEll2D_cst_offs, paras, x, y, z, offset=100)
+    assert set(status) <= {1, 2, 3}, status
+    assert info["nfev"].max() <= 5, info["nfev"]
+
+    x, y, z, paras = ell_gauss_frames(noise=10)
+    p_fit, status, _, info = batch_leastsq(gaussEll2D_cst_offs, 1.05 * paras, x, y, z, offset=100)
+    assert set(status) <= {1, 2, 3}, status
+    p_restart, status, _, info = batch_leastsq(gaussEll2D_cst_offs, p_fit, x, y, z, offset=100)
+    assert set(status) <= {1, 2, 3}, status
+    assert info["nfev"].max() <= 5, info["nfev"]
+    assert np.allclose(p_restart, p_fit, rtol=1e-6, atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_restart_from_minimum()
+    print("restart from the minimum: OK")
@@ -0,0 +1,222 @@
+"""
+Reader for Dataray wcf files (a stack of 64 uint16 images taken in identical conditions)
+
+The file is mapped with numpy.memmap: the frames are views on the file and
+nothing is decoded pixel by pixel. Converting or copying the returned array
+is left to the caller.
+
+Only the frame size is read from the file header (read_wcf_info), the header
+layout is not documented. The number of frames, the bit depth and the header
+length are the fixed values of the Dataray files (wcf_frame_number, wcf_bit_depth,
+wcf_header_length), they are not read from the file. The file size has to be
+consistent with them and with the frame size, otherwise the file is rejected.
+The results are cached, so a folder of wcf files can be checked without reading
+any frame.
+"""
+import os
+from functools import lru_cache
+import numpy as np
+
+wcf_header_length = 934 + 5592
+#  934 was found by trial and error in comparison to Dataray software
+#  5592 can be read in the first header
+wcf_frame_number = 64
+wcf_bit_depth = 16  # 2 bytes per pixel
+wcf_crop_margin = 2  # pixel (because the nominal image size contains a saturated pixel)
+wcf_min_side = 8  # pixel, smaller integers in the header are not taken for a frame size
+wcf_tolerance = 1000  # pixel per frame, the data block may be followed by a few bytes
+wcf_info_cache_size = 1024  # files
+
+# Sensor sizes (width, height). Used to check the header values and as fallback.
+std_image_reslS = [(64, 64), (128, 128), (256, 256), (384, 384), (512, 512),
+                   (752, 752), (1024, 1024), (1200, 1024)]
+
+
+class WcfInfo:
+    """Geometry of the frames in a wcf file
+    frames: number of frames
+    width, height: nominal frame size in pixels (including the crop margin)
+    bit_depth: bits per pixel
+    header_length: number of bytes before the first frame
+    size_source: where width and height come from, "header" or "sensor table"
+    frames, bit_depth and header_length are the fixed Dataray values, not read from the file.
+    """
+
+    def __init__(self, frames, width, height, bit_depth=wcf_bit_depth, header_length=wcf_header_length,
+                 size_source="header"):
+        self.frames = frames
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.header_length = header_length
+        self.size_source = size_source
+
+    def __repr__(self):
+        return ("WcfInfo(frames={:d}, width={:d}, height={:d}, bit_depth={:d}, header_length={:d}, "
+                "size_source={!r})").format(self.frames, self.width, self.height, self.bit_depth,
+                                            self.header_length, self.size_source)
+
+    def __eq__(self, other):
+        """Files with equal WcfInfo can be analyzed with the same settings"""
+        if not isinstance(other, WcfInfo):
+            return NotImplemented
+        return ((self.frames, self.width, self.height, self.bit_depth, self.header_length) ==
+                (other.frames, other.width, other.height, other.bit_depth, other.header_length))
+
+    @property
+    def sat_value(self):
+        """the maximum integer value in the images"""
+        return 2 ** self.bit_depth - 1
+
+
+def frame_size_candidates(header, pix_per_frame, tolerance=wcf_tolerance):
+    """Return the neighbouring integer pairs of the header that can be the frame size.
+    All uint16 and uint32 pairs (at every byte alignment) are tested: their product
+    has to match pix_per_frame within tolerance pixels without being larger.
+    return: dict (first, second) -> deviation in pixels, in the order of the header
+    """
+    candidates = {}
+    for dtype in ["<u2", "<u4"]:
+        itemsize = np.dtype(dtype).itemsize
+        for align in range(itemsize):
+            n_items = (len(header) - align) // itemsize
+            vals = np.frombuffer(header, dtype=dtype, count=n_items, offset=align).astype(np.int64)
+            dev = pix_per_frame - vals[:-1] * vals[1:]
+            ok = (vals[:-1] >= wcf_min_side) & (vals[1:] >= wcf_min_side) & (dev >= 0) & (dev < tolerance)
+            for idx in np.flatnonzero(ok):
+                candidates.setdefault((int(vals[idx]), int(vals[idx + 1])), float(dev[idx]))
+    return candidates
+
+
+def find_frame_size_in_header(header, pix_per_frame, tolerance=wcf_tolerance):
+    """Look for the frame size (width, height) in the header bytes.
+    The header layout is not documented, but it contains the frame size as two
+    neighbouring integers (frame_size_candidates). The candidates are cross-checked:
+    - a candidate that is a known sensor (std_image_reslS, in either order) is taken,
+      with the orientation of the table
+    - otherwise the best matching candidates have to be the same two numbers in the
+      same order, which are taken as (width, height)
+    None if nothing fits or if the header is ambiguous (different pairs or both orders).
+    """
+    candidates = frame_size_candidates(header, pix_per_frame, tolerance)
+    known = [(candidates.get(size, candidates.get(size[::-1])), size) for size in std_image_reslS
+             if size in candidates or size[::-1] in candidates]
+    if known:
+        return min(known)[1]
+    if not candidates:
+        return None
+    best_dev = min(candidates.values())
+    best = [pair for pair, dev in candidates.items() if dev == best_dev]
+    if len(best) != 1:
+        return None
+    return best[0]
+
+
+def payload_fits(file_size, width, height, frames=wcf_frame_number, header_length=wcf_header_length,
+                 tolerance=wcf_tolerance):
+    """True if a file of file_size bytes holds the frames of width x height pixels after the
+    header, followed by less than tolerance pixels per frame
+    """
+    frame_bytes = width * height * wcf_bit_depth // 8
+    trailer = file_size - header_length - frames * frame_bytes
+    return 0 <= trailer < frames * tolerance * wcf_bit_depth // 8
+
+
+@lru_cache(maxsize=wcf_info_cache_size)
+def cached_wcf_info(path, file_size, mtime_ns, frames, header_length):
+    """WcfInfo of the file at path, cached on (path, size, modification time, frames, header_length)"""
+    bytes_per_pix = wcf_bit_depth // 8
+    pix_per_frame = (file_size - header_length) / frames / bytes_per_pix
+    if pix_per_frame <= 0:
+        raise ValueError("File too short for a wcf file: " + path)
+    with open(path, mode="rb") as f:
+        header = f.read(header_length)
+
+    size = find_frame_size_in_header(header, pix_per_frame)
+    size_source = "header"
+    if size is None:  # fall back to the rounded kpixel estimate of the known sensors
+        pix_num_est = int(np.round(pix_per_frame / 1000))  # kpixels
+        size_source = "sensor table"
+        for (width, height) in std_image_reslS:
+            if int(np.round(width * height / 1000)) == pix_num_est:
+                size = (width, height)
+                break
+    if size is None:
+        raise ValueError("No unambiguous frame size in the wcf header: " + path)
+    if not payload_fits(file_size, size[0], size[1], frames, header_length):
+        raise ValueError("File size does not match {:d} frames of {:d}x{:d} pixels: {}".format(
+            frames, size[0], size[1], path))
+    return WcfInfo(frames, size[0], size[1], wcf_bit_depth, header_length, size_source)
+
+
+def read_wcf_info(f_name, frames=wcf_frame_number, header_length=wcf_header_length):
+    """Return the WcfInfo of the file f_name (cached per file, see cached_wcf_info).
+    Raises ValueError if no consistent frame size can be found.
+    """
+    stat = os.stat(f_name)
+    return cached_wcf_info(os.path.normcase(os.path.abspath(f_name)), stat.st_size, stat.st_mtime_ns,
+                           frames, header_length)
+
+
+def read_wcf_stack(f_name, width=None, height=None, frames=wcf_frame_number,
+                   offset=wcf_header_length, crop_margin=wcf_crop_margin):
+    """Map the frames of a wcf file without copying them.
+    f_name: path of the wcf file
+    width, height: nominal frame size in pixels (before removing crop_margin).
+        If omitted, the geometry is read from the header (read_wcf_info).
+    frames: number of frames in the file
+    offset: number of header bytes before the first frame
+    crop_margin: number of pixels removed on each side (as a view)
+
+    return: uint16 array of shape (frames, height - 2*crop_margin, width - 2*crop_margin)
+    The array is read only and backed by the file (np.memmap).
+    Raises ValueError if the file is too short for the requested geometry.
+    """
+    if width is None or height is None:
+        info = read_wcf_info(f_name)
+        (width, height, frames, offset) = (info.width, info.height, info.frames, info.header_length)
+    stack = np.memmap(f_name, dtype="<u2", mode="r", offset=offset,
+                      shape=(frames, height, width))  # "<u2" is little endian uint16 ("H" of struct)
+    if crop_margin > 0:
+        stack = stack[:, crop_margin:-crop_margin, crop_margin:-crop_margin]
+    return stack
+
+
+if __name__ == "__main__":
+    # Write small synthetic wcf files and read them back
+    import tempfile
+    from time import time as tic
+
+    def write_wcf(data, header_pairs):
+        header_bytes = bytearray(wcf_header_length)
+        for pos, pair in header_pairs:
+            header_bytes[pos:pos + 8] = np.array(pair, dtype="<u4").tobytes()
+        with tempfile.NamedTemporaryFile(suffix=".wcf", delete=False) as fi:
+            fi.write(header_bytes)
+            fi.write(data.tobytes())
+        return fi.name
+
+    w, h = 200, 150  # not a size of the std_image_reslS list
+    data = np.random.default_rng().integers(0, 2**16, size=(wcf_frame_number, h, w), dtype="<u2")
+    name = write_wcf(data, [(100, [w, h])])
+    t1 = tic()
+    print(read_wcf_info(name))
+    st = read_wcf_stack(name)
+    print("shape:", st.shape, "same data:", np.array_equal(st, data[:, 2:-2, 2:-2]))
+    print("Header and mapping took {:.6f} s".format(tic() - t1))
+    del st
+    os.remove(name)
+
+    # The header holds the sensor size as (height, width): taken in the orientation of the table
+    name = write_wcf(np.zeros(0, dtype="<u2"), [(100, [1024, 1200])])
+    with open(name, "r+b") as fi:
+        fi.truncate(wcf_header_length + wcf_frame_number * 1200 * 1024 * 2)  # sparse file
+    print("transposed sensor size:", read_wcf_info(name))
+    os.remove(name)
+    # Two different pairs match equally well: rejected instead of guessed
+    name = write_wcf(np.zeros((wcf_frame_number, 30, 40), dtype="<u2"), [(100, [40, 30]), (200, [60, 20])])
+    try:
+        print(read_wcf_info(name))
+    except ValueError as err:
+        print("ambiguous header:", err)
+    os.remove(name)